@@ -0,0 +1,252 @@
+"""Download access events, buffered per process and written off the request path
+
+Every download served records one event (time, IP, status, bytes sent,
+Range header, user agent) in an in-memory buffer, or with
+ANALYTICS_SPOOL_DIR appends it as a JSON line to this process's spool
+file, so the request never waits on the database. A background thread
+writes the events every ANALYTICS_FLUSH_INTERVAL seconds, or as soon as
+ANALYTICS_BATCH_SIZE are waiting, with multi-row INSERTs into
+access_events, and adds them to the hourly per-share totals in
+share_access_hourly in the same transaction. The dashboard reads only
+those totals.
+
+The in-memory buffer keeps at most ANALYTICS_BUFFER_SIZE events and
+drops the oldest while the database cannot keep up (a batch whose write
+failed is held apart, to be retried first); whatever is still buffered
+when a process is killed is lost. Spool files survive crashes:
+files left by processes that no longer exist are taken over by the next
+writer that flushes in the same directory.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from flask import current_app
+
+from app import db
+from models import AccessEvent, ShareAccessHourly
+
+# Order of the values in an event tuple and in a spool file line
+EVENT_FIELDS = ('share_id', 'file_id', 'owner_id', 'occurred_at', 'ip', 'status', 'bytes_sent',
+                'range_header', 'user_agent', 'counted')
+
+
+def write_events(events, batch_size=500):
+    """Insert event tuples and add them to the hourly per-share totals, in one transaction"""
+    hourly = {}
+    for start in range(0, len(events), batch_size):
+        rows = [dict(zip(EVENT_FIELDS, event)) for event in events[start:start + batch_size]]
+        db.session.execute(db.insert(AccessEvent), rows)
+        for row in rows:
+            key = (row['share_id'], row['occurred_at'].replace(minute=0, second=0, microsecond=0))
+            totals = hourly.setdefault(key, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += int(row['counted'])
+            totals[2] += row['bytes_sent']
+    # Sorted, so concurrent writers take row locks in the same order
+    for (share_id, hour), (requests, downloads, bytes_sent) in sorted(hourly.items()):
+        ShareAccessHourly.add(share_id, hour, requests, downloads, bytes_sent)
+    db.session.commit()
+
+
+def _pid_of(name):
+    prefix = name.split('.', 1)[0]
+    return int(prefix) if prefix.isdigit() else None
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AccessLog:
+    """One process's event buffer and the thread that writes it"""
+
+    def __init__(self, app, batch_size=500, flush_interval=2.0, buffer_size=100000, spool_dir=''):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_dir = spool_dir
+        self.events = deque(maxlen=buffer_size)
+        # A batch whose write failed, retried before anything newer
+        self.retry = []
+        self.dropped = 0
+        self._reset()
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+        # A forked worker starts with an empty buffer and its own thread and spool file
+        os.register_at_fork(after_in_child=self._forked)
+        atexit.register(self.close)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._spool_fd = None
+        self._spooled = 0
+
+    def _forked(self):
+        if self._spool_fd is not None:
+            os.close(self._spool_fd)
+        self.events.clear()
+        self.retry = []
+        self._reset()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='access-log-writer', daemon=True)
+                self._thread.start()
+
+    def record(self, event):
+        """Queue an event tuple (see EVENT_FIELDS)"""
+        if self._thread is None:
+            self._start()
+        if self.spool_dir:
+            line = json.dumps(event, default=datetime.isoformat) + '\n'
+            with self._lock:
+                if self._spool_fd is None:
+                    self._spool_fd = os.open(self._spool_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                os.write(self._spool_fd, line.encode())
+                self._spooled += 1
+                waiting = self._spooled
+        else:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+            waiting = len(self.events)
+        if waiting >= self.batch_size:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.error(f"Access log write failed: {str(e)}")
+
+    def flush(self):
+        """Write the events recorded so far; returns how many were written"""
+        with self._flush_lock:
+            if self.dropped:
+                self.app.logger.warning(f"Access log buffer full: dropped {self.dropped} events")
+                self.dropped = 0
+            if self.spool_dir:
+                return self._flush_spool()
+            written = 0
+            if self.retry:
+                write_events(self.retry, self.batch_size)
+                written, self.retry = len(self.retry), []
+            for _ in range(0, len(self.events), self.batch_size):
+                batch = [self.events.popleft() for _ in range(min(self.batch_size, len(self.events)))]
+                try:
+                    write_events(batch, self.batch_size)
+                except Exception:
+                    # Not back into the buffer: when full, that would push out newer events uncounted
+                    self.retry = batch
+                    raise
+                written += len(batch)
+            return written
+
+    def _spool_path(self):
+        return os.path.join(self.spool_dir, f'{os.getpid()}.jsonl')
+
+    def _claim_spool_files(self):
+        """Close this process's spool file and take over those of dead processes; returns the files to write"""
+        pid = os.getpid()
+        with self._lock:
+            if self._spool_fd is not None:
+                os.close(self._spool_fd)
+                self._spool_fd = None
+                self._spooled = 0
+                os.replace(self._spool_path(), os.path.join(self.spool_dir, f'{pid}.{time.time_ns()}.batch'))
+        for name in os.listdir(self.spool_dir):
+            owner = _pid_of(name)
+            if owner is None or owner == pid or _process_exists(owner):
+                continue
+            # Renaming is the claim, so two writers never take the same file
+            try:
+                os.replace(os.path.join(self.spool_dir, name),
+                           os.path.join(self.spool_dir, f'{pid}.{time.time_ns()}.batch'))
+            except FileNotFoundError:
+                continue
+        return sorted(os.path.join(self.spool_dir, name) for name in os.listdir(self.spool_dir)
+                      if name.startswith(f'{pid}.') and name.endswith('.batch'))
+
+    def _flush_spool(self):
+        written = 0
+        for path in self._claim_spool_files():
+            events = []
+            with open(path) as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # The last line of a process killed mid-write
+                        continue
+                    event[EVENT_FIELDS.index('occurred_at')] = datetime.fromisoformat(
+                        event[EVENT_FIELDS.index('occurred_at')])
+                    events.append(tuple(event))
+            # One transaction per file: a failed write leaves the file to be retried whole
+            try:
+                write_events(events, self.batch_size)
+            except Exception:
+                db.session.rollback()
+                raise
+            os.remove(path)
+            written += len(events)
+        return written
+
+    def close(self):
+        """Write whatever is still buffered; runs at interpreter exit and ASGI shutdown"""
+        if self._thread is None:
+            return
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.error(f"Access log write failed at exit: {str(e)}")
+
+
+def get_access_log():
+    """Return the application's AccessLog, or None when analytics are off"""
+    extensions = current_app.extensions
+    if 'access_log' not in extensions:
+        config = current_app.config
+        extensions['access_log'] = AccessLog(
+            current_app._get_current_object(),
+            batch_size=config['ANALYTICS_BATCH_SIZE'],
+            flush_interval=config['ANALYTICS_FLUSH_INTERVAL'],
+            buffer_size=config['ANALYTICS_BUFFER_SIZE'],
+            spool_dir=config['ANALYTICS_SPOOL_DIR']
+        ) if config['ANALYTICS_ENABLED'] else None
+    return extensions['access_log']
+
+
+def record_access(share, status, bytes_sent, counted, ip=None, range_header=None, user_agent=None):
+    """Log one download of a share (a FileShare or ShareSnapshot) without touching the database"""
+    access_log = get_access_log()
+    if access_log is None:
+        return
+    access_log.record((
+        share.id, share.file_id, share.user_id, datetime.now(timezone.utc),
+        ip[:45] if ip else None, status, bytes_sent or 0,
+        range_header[:100] if range_header else None,
+        user_agent[:255] if user_agent else None,
+        bool(counted),
+    ))
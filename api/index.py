@@ -1,4 +1,4 @@
-from app import app
+from main import app
 from vercel_python_wsgi import VercelWSGI
 
 handler = VercelWSGI(app)
@@ -1,91 +1,262 @@
 import os
 import logging
-from datetime import timedelta
+import time
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_jwt_extended import JWTManager, set_access_cookies
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging; DEBUG logs every SQL pool checkout and request line,
+# which costs real throughput, so it is opt-in via LOG_LEVEL
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 
 class Base(DeclarativeBase):
     pass
 
 db = SQLAlchemy(model_class=Base)
 
-# Create the app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key")
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
-
-# JWT Configuration
-app.config["JWT_SECRET_KEY"] = os.environ.get("JWT_SECRET_KEY", "jwt-secret-key")
-app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(hours=24)
-app.config["JWT_TOKEN_LOCATION"] = ["cookies"]
-app.config["JWT_COOKIE_SECURE"] = False  # Set to True in production with HTTPS
-app.config["JWT_COOKIE_CSRF_PROTECT"] = False  # Simplified for development
-jwt = JWTManager(app)
-
-# Database configuration
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///secureshare.db")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
-
-# File upload configuration
-app.config["MAX_CONTENT_LENGTH"] = 100 * 1024 * 1024  # 100MB max file size
-app.config["UPLOAD_FOLDER"] = "uploads"
-
-# Initialize extensions
-db.init_app(app)
-jwt.init_app(app)
-
-# Create upload folder if it doesn't exist
-os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-
-# Import and register blueprints
-from routes.upload import upload_bp
-from routes.download import download_bp
-from routes.auth import auth_bp
-
-app.register_blueprint(upload_bp)
-app.register_blueprint(download_bp)
-app.register_blueprint(auth_bp)
-
-# Main routes
-from flask import render_template, redirect, url_for
-from flask_jwt_extended import jwt_required, get_jwt_identity
-
-@app.route('/')
-def index():
-    return render_template('index.html')
-
-@app.route('/dashboard')
-def dashboard():
-    from flask import session
-    from models import FileShare, User
-    
-    # Check if user is logged in via session
-    if 'user_id' not in session:
-        from flask import flash
-        flash('Please login to access dashboard', 'error')
-        return redirect(url_for('auth.login'))
-    
-    user_id = session['user_id']
-    user = User.query.get(user_id)
-    files = FileShare.query.filter_by(user_id=user_id).order_by(FileShare.created_at.desc()).all()
-    return render_template('dashboard.html', user=user, files=files)
-
-
-
-with app.app_context():
-    # Import models to ensure tables are created
-    import models
-    db.create_all()
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+
+def create_app(config=None):
+    """Build the Flask app; ``config`` overrides settings read from the environment
+
+    Importing this module only defines ``db``, so models and CLI helpers
+    can use it without building an app. Blueprints, models and optional
+    extensions are imported here, and no DDL is issued: the schema is
+    managed by `flask --app main migrate`.
+    """
+    started = time.perf_counter()
+    app = Flask(__name__)
+    app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key")
+    # Reverse proxies in front of the app: how many X-Forwarded-For hops to
+    # trust for the client address that rate limits and the access log use
+    # (0 when clients connect directly). asgi.py resolves it the same way.
+    app.config["PROXY_X_FOR"] = int(os.environ.get("PROXY_X_FOR", 1))
+
+    # Signed-in users: the session cookie carries their ID and username, and
+    # each process caches user records for USER_CACHE_TTL seconds, so pages
+    # need no per-request user query. A change made in one process reaches
+    # the others within that time.
+    app.config["USER_CACHE_SIZE"] = int(os.environ.get("USER_CACHE_SIZE", 10000))
+    app.config["USER_CACHE_TTL"] = int(os.environ.get("USER_CACHE_TTL", 60))
+
+    # Database configuration
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///secureshare.db")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+    }
+
+    # File upload configuration
+    app.config["MAX_CONTENT_LENGTH"] = 100 * 1024 * 1024  # 100MB max file size
+    app.config["UPLOAD_FOLDER"] = "uploads"
+
+    # Where stored files live: empty (UPLOAD_FOLDER on local disk), file:///abs/path,
+    # or s3://bucket/prefix (needs boto3; S3_ENDPOINT_URL selects MinIO or another
+    # S3-compatible server). UPLOAD_FOLDER still holds in-progress uploads.
+    app.config["STORAGE_URL"] = os.environ.get("STORAGE_URL", "")
+    app.config["S3_ENDPOINT_URL"] = os.environ.get("S3_ENDPOINT_URL", "")
+    app.config["S3_REGION"] = os.environ.get("S3_REGION", "")
+
+    # At-rest encryption: a 32-byte master key, base64url encoded (generate with
+    # `python -c "import secrets, base64; print(base64.urlsafe_b64encode(secrets.token_bytes(32)).decode())"`).
+    # Each new blob gets its own data key, sealed with it; files are encrypted in
+    # ENCRYPTION_CHUNK_SIZE frames so Range requests decrypt only what they need.
+    # Needs the cryptography package. Blobs stored without a key stay readable.
+    app.config["ENCRYPTION_KEY"] = os.environ.get("ENCRYPTION_KEY", "")
+    app.config["ENCRYPTION_CIPHER"] = os.environ.get("ENCRYPTION_CIPHER", "aes-gcm")
+    app.config["ENCRYPTION_CHUNK_SIZE"] = int(os.environ.get("ENCRYPTION_CHUNK_SIZE", 64 * 1024))
+
+    # Storage compression: "zstd" (needs zstandard, else falls back to gzip),
+    # "gzip", or empty to store files as uploaded. Already-compressed types and
+    # high-entropy content are skipped; files under COMPRESSION_MIN_SIZE too.
+    app.config["COMPRESSION_CODEC"] = os.environ.get("COMPRESSION_CODEC", "")
+    app.config["COMPRESSION_MIN_SIZE"] = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+
+    # Redirect downloads to short-lived presigned URLs when the backend supports
+    # them, so file bytes never pass through the web workers
+    app.config["STORAGE_PRESIGNED_DOWNLOADS"] = os.environ.get("STORAGE_PRESIGNED_DOWNLOADS", "").lower() in ("1", "true", "yes")
+    app.config["STORAGE_PRESIGN_TTL"] = int(os.environ.get("STORAGE_PRESIGN_TTL", 300))
+
+    # Total size for resumable chunked uploads; each PATCH is still bounded by MAX_CONTENT_LENGTH
+    app.config["MAX_UPLOAD_SIZE"] = int(os.environ.get("MAX_UPLOAD_SIZE", 2 * 1024 * 1024 * 1024))
+
+    # Batch uploads (POST /api/batches): files per request, total request size
+    # and threads staging and storing files in parallel
+    app.config["BATCH_MAX_FILES"] = int(os.environ.get("BATCH_MAX_FILES", 1000))
+    app.config["BATCH_MAX_CONTENT_LENGTH"] = int(os.environ.get("BATCH_MAX_CONTENT_LENGTH", 1024 * 1024 * 1024))
+    app.config["BATCH_UPLOAD_WORKERS"] = int(os.environ.get("BATCH_UPLOAD_WORKERS", 8))
+
+    # Deflate level for compressible files in collection ZIP downloads. Members
+    # are compressed per download, so the default favours speed; 0 stores every
+    # member, which also lets the archive be sent with a Content-Length
+    app.config["ZIP_DEFLATE_LEVEL"] = int(os.environ.get("ZIP_DEFLATE_LEVEL", 1))
+
+    # Per-user quotas in bytes, 0 for unlimited; `flask --app main quota <user>`
+    # shows usage and sets a user's own. Storage counts every share at its full
+    # size plus resumable uploads in progress. Egress charges each counted
+    # download at the file's size and resets every EGRESS_QUOTA_PERIOD
+    # (day, week or month).
+    app.config["STORAGE_QUOTA_BYTES"] = int(os.environ.get("STORAGE_QUOTA_BYTES", 0))
+    app.config["EGRESS_QUOTA_BYTES"] = int(os.environ.get("EGRESS_QUOTA_BYTES", 0))
+    app.config["EGRESS_QUOTA_PERIOD"] = os.environ.get("EGRESS_QUOTA_PERIOD", "month")
+
+    # Resumed or parallel range requests within this window count as one download
+    app.config["DOWNLOAD_GRANT_TTL"] = int(os.environ.get("DOWNLOAD_GRANT_TTL", 6 * 60 * 60))
+
+    # Share metadata cache for /d/<file_id> and /info/<file_id>. SHARE_CACHE_URL
+    # adds a shared tier: redis://host:6379/0, or fake:// for an in-process stand-in
+    app.config["SHARE_CACHE_SIZE"] = int(os.environ.get("SHARE_CACHE_SIZE", 10000))
+    app.config["SHARE_CACHE_TTL"] = int(os.environ.get("SHARE_CACHE_TTL", 30))
+    app.config["SHARE_CACHE_NEGATIVE_TTL"] = int(os.environ.get("SHARE_CACHE_NEGATIVE_TTL", 5))
+    app.config["SHARE_CACHE_URL"] = os.environ.get("SHARE_CACHE_URL", "")
+
+    # Password hashing: a Werkzeug method ("scrypt:32768:8:1", "pbkdf2:sha256:600000")
+    # or "argon2[:time_cost:memory_kib:parallelism]" (needs argon2-cffi). Hashes made
+    # with other parameters are upgraded on the next successful login.
+    app.config["PASSWORD_HASH_METHOD"] = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+    app.config["PASSWORD_VERIFY_WORKERS"] = int(os.environ.get("PASSWORD_VERIFY_WORKERS", 2))
+    app.config["PASSWORD_VERIFY_QUEUE"] = int(os.environ.get("PASSWORD_VERIFY_QUEUE", 8))
+
+    # Rate limits as "<count>/<second|minute|hour|day>". Each process keeps its
+    # own token buckets unless RATE_LIMIT_URL names a shared store
+    # (redis://host:6379/1, or fake:// for an in-process stand-in), in which
+    # case all workers count against the same sliding windows
+    app.config["RATE_LIMITS"] = {
+        "verify_per_ip": os.environ.get("VERIFY_RATE_PER_IP", "20/minute"),
+        "verify_per_target": os.environ.get("VERIFY_RATE_PER_TARGET", "60/minute"),
+        "missing_per_ip": os.environ.get("MISSING_RATE_PER_IP", "30/minute"),
+        "register_per_ip": os.environ.get("REGISTER_RATE_PER_IP", "10/hour"),
+        "upload_per_user": os.environ.get("UPLOAD_RATE_PER_USER", "120/minute"),
+    }
+    app.config["RATE_LIMIT_URL"] = os.environ.get("RATE_LIMIT_URL", "")
+
+    # Per-share egress shaping for hot links, in bytes per second (0 is off).
+    # Under uvicorn each transfer is paced; sync workers send at full speed and
+    # charge the whole response, turning new transfers away with 429 while the
+    # link is more than SHARE_EGRESS_MAX_DELAY seconds behind. Per process.
+    app.config["SHARE_EGRESS_RATE"] = int(os.environ.get("SHARE_EGRESS_RATE", 0))
+    app.config["SHARE_EGRESS_BURST"] = int(os.environ.get("SHARE_EGRESS_BURST", 0))
+    app.config["SHARE_EGRESS_MAX_DELAY"] = float(os.environ.get("SHARE_EGRESS_MAX_DELAY", 10))
+
+    # Prometheus metrics on /metrics. Request latency is recorded for every
+    # request; per-request SQL counts and timings only for METRICS_SAMPLE_RATE of
+    # them. With several worker processes, point METRICS_DIR at a directory they
+    # share (emptied on deploy) so /metrics reports all of them. /metrics is
+    # only served with METRICS_TOKEN set, to requests bearing that token.
+    app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+    app.config["METRICS_SAMPLE_RATE"] = float(os.environ.get("METRICS_SAMPLE_RATE", 1.0))
+    app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR", "")
+    app.config["METRICS_FLUSH_INTERVAL"] = int(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+    app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN", "")
+
+    # Download analytics: each download is logged to access_events (time, IP,
+    # status, bytes, Range, user agent) and totalled per share and hour for the
+    # dashboard. Events are buffered in memory, or appended to a per-process file
+    # in ANALYTICS_SPOOL_DIR so they survive a crash, and written in bulk by a
+    # background thread every ANALYTICS_FLUSH_INTERVAL seconds, never by the request.
+    app.config["ANALYTICS_ENABLED"] = os.environ.get("ANALYTICS_ENABLED", "1").lower() in ("1", "true", "yes")
+    app.config["ANALYTICS_FLUSH_INTERVAL"] = float(os.environ.get("ANALYTICS_FLUSH_INTERVAL", 2))
+    app.config["ANALYTICS_BATCH_SIZE"] = int(os.environ.get("ANALYTICS_BATCH_SIZE", 500))
+    app.config["ANALYTICS_BUFFER_SIZE"] = int(os.environ.get("ANALYTICS_BUFFER_SIZE", 100000))
+    app.config["ANALYTICS_SPOOL_DIR"] = os.environ.get("ANALYTICS_SPOOL_DIR", "")
+
+    # Previews on /info/<file_id>: image thumbnails (needs Pillow), first PDF page
+    # (needs pdftoppm), video poster frames (needs ffmpeg) and text snippets.
+    # Uploads queue a job in a SQLite file on this host; PREVIEW_WORKERS > 0 renders
+    # them in a pool of that many processes started by each web process, otherwise
+    # run `flask --app main previews work`. Derivatives are stored beside their blob
+    # and served with Cache-Control max-age PREVIEW_CACHE_MAX_AGE.
+    app.config["PREVIEWS_ENABLED"] = os.environ.get("PREVIEWS_ENABLED", "1").lower() in ("1", "true", "yes")
+    app.config["PREVIEW_QUEUE_PATH"] = os.environ.get("PREVIEW_QUEUE_PATH", os.path.join(app.instance_path, "preview-queue.sqlite"))
+    app.config["PREVIEW_WORKERS"] = int(os.environ.get("PREVIEW_WORKERS", 0))
+    app.config["PREVIEW_SIZE"] = int(os.environ.get("PREVIEW_SIZE", 512))
+    app.config["PREVIEW_MAX_SOURCE_BYTES"] = int(os.environ.get("PREVIEW_MAX_SOURCE_BYTES", 100 * 1024 * 1024))
+    app.config["PREVIEW_TIMEOUT"] = int(os.environ.get("PREVIEW_TIMEOUT", 30))
+    app.config["PREVIEW_CACHE_MAX_AGE"] = int(os.environ.get("PREVIEW_CACHE_MAX_AGE", 365 * 24 * 60 * 60))
+
+    # Shares listed per dashboard page
+    app.config["DASHBOARD_PAGE_SIZE"] = int(os.environ.get("DASHBOARD_PAGE_SIZE", 50))
+
+    # Expiry reaper: REAPER_INTERVAL > 0 runs it in a background thread of each
+    # process; otherwise run `flask --app main reap --loop` as a separate worker
+    app.config["REAPER_INTERVAL"] = int(os.environ.get("REAPER_INTERVAL", 0))
+    app.config["REAPER_BATCH_SIZE"] = int(os.environ.get("REAPER_BATCH_SIZE", 500))
+    app.config["REAPER_MAX_BATCHES"] = int(os.environ.get("REAPER_MAX_BATCHES", 100))
+    app.config["UPLOAD_SESSION_TTL"] = int(os.environ.get("UPLOAD_SESSION_TTL", 24 * 60 * 60))
+
+    # Connections opened at startup, so the first requests skip connecting
+    # and the dialect's first-connect queries; 0 leaves the pool empty and
+    # also skips configuring the ORM mappers up front
+    app.config["DB_POOL_PREWARM"] = int(os.environ.get("DB_POOL_PREWARM", 1))
+
+    if config:
+        app.config.update(config)
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_X_FOR"], x_proto=1, x_host=1)
+
+    # Initialize extensions
+    db.init_app(app)
+
+    from metrics import init_metrics
+
+    init_metrics(app)
+
+    # Create upload folder if it doesn't exist
+    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+
+    # Import and register blueprints
+    from routes.upload import upload_bp
+    from routes.download import download_bp
+    from routes.auth import auth_bp
+    from routes.dashboard import index, dashboard
+
+    app.register_blueprint(upload_bp)
+    app.register_blueprint(download_bp)
+    app.register_blueprint(auth_bp)
+    app.add_url_rule('/', 'index', index)
+    app.add_url_rule('/dashboard', 'dashboard', dashboard)
+
+    from reaper import reap_command, start_reaper_thread
+    from quotas import quota_command
+    from migrations import migrate_command
+    from storagescan import storage_cli
+    from previews import previews_cli
+
+    app.cli.add_command(reap_command)
+    app.cli.add_command(quota_command)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(storage_cli)
+    app.cli.add_command(previews_cli)
+
+    prewarm_database(app)
+    start_reaper_thread(app)
+    app.logger.debug(f"App created in {(time.perf_counter() - started) * 1000:.1f} ms")
+    return app
+
+
+def prewarm_database(app):
+    """Configure the ORM mappers and park DB_POOL_PREWARM open connections in the pool
+
+    Both would otherwise happen inside the first request. A process forked
+    after this (gunicorn --preload) inherits the configured mappers but must
+    not share the parent's sockets, so children drop the inherited
+    connections without closing them and connect on first use.
+    """
+    from sqlalchemy.orm import configure_mappers
+
+    count = app.config["DB_POOL_PREWARM"]
+    with app.app_context():
+        engine = db.engine
+    os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+    if count <= 0:
+        return
+    configure_mappers()
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(engine.connect())
+    except Exception as e:
+        app.logger.warning(f"Could not pre-warm the database pool: {str(e)}")
+    finally:
+        for connection in connections:
+            connection.close()
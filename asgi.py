@@ -0,0 +1,457 @@
+"""ASGI entry point for serving large transfers without a worker per connection
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 2
+
+Downloads (/d/<file_id>) and resumable upload chunks
+(PATCH /api/uploads/<upload_id>) are handled natively here: file I/O and
+database calls run on the default thread pool for a few milliseconds at a
+time, so a slow client costs one coroutine instead of a whole sync worker.
+Every other request, and any download that needs a page rendered
+(password form, expired link, limit reached), falls through to the
+regular Flask app.
+"""
+import asyncio
+import fcntl
+import json
+import re
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from werkzeug.http import (dump_cookie, dump_options_header, http_date, parse_cookie, parse_etags,
+                           parse_list_header)
+
+from main import app as flask_app
+from app import db
+from analytics import get_access_log, record_access
+from cache import get_share, invalidate_share
+from models import UploadSession
+from quotas import QuotaExceeded
+from ratelimit import egress_retry_after, get_egress_shaper, lookup_allowed, shape_egress
+from routes.download import continues_download, issue_download_grant
+from routes.upload import CONTENT_MISMATCH_MESSAGE, _take_hasher, _keep_hasher, _drop_hasher
+from sniffing import SNIFF_LENGTH, ContentSniffer, ContentTypeMismatch
+from storage import get_storage
+from metrics import metrics_enabled, observe_request, observe_transfer
+from encryption import open_for_reading
+from compression import select_representation
+from streaming import (STREAM_BLOCK_SIZE, content_disposition, if_range_matches,
+                       multipart_layout, resolve_ranges)
+
+_flask_asgi = WsgiToAsgi(flask_app)
+
+DOWNLOAD_PATH = re.compile(r'^/d/([^/.]+)$')
+UPLOAD_CHUNK_PATH = re.compile(r'^/api/uploads/([^/]+)$')
+
+
+async def flask_asgi(scope, receive, send):
+    """Hand a request to the Flask app, whose own hooks then record its metrics"""
+    timing = scope.get('sfv.timing')
+    if timing is not None:
+        timing['handled'] = False
+    return await _flask_asgi(scope, receive, send)
+
+
+async def timed(endpoint, direction, handler, scope, receive, send, *args):
+    """Run a native handler, recording the metrics Flask's hooks would"""
+    if not metrics_enabled():
+        return await handler(scope, receive, send, *args)
+    started = time.perf_counter()
+    timing = {'handled': True, 'status': 500, 'sent': 0}
+    scope = dict(scope, **{'sfv.timing': timing})
+
+    async def counting_send(message):
+        if message['type'] == 'http.response.start':
+            timing['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            timing['sent'] += len(message.get('body', b''))
+        await send(message)
+
+    try:
+        return await handler(scope, receive, counting_send, *args)
+    finally:
+        if timing['handled']:
+            elapsed = time.perf_counter() - started
+            observe_request(endpoint, scope['method'], timing['status'], elapsed)
+            if direction == 'download' and timing['status'] in (200, 206) and scope['method'] != 'HEAD':
+                observe_transfer('download', timing['sent'], elapsed)
+            elif direction == 'upload' and timing['status'] < 400:
+                observe_transfer('upload', int(_headers(scope).get('content-length') or 0), elapsed)
+
+
+def _in_app_context(fn, *args):
+    with flask_app.app_context():
+        return fn(*args)
+
+
+async def run_in_app(fn, *args):
+    """Run blocking (database) work on the thread pool inside an app context"""
+    return await asyncio.to_thread(_in_app_context, fn, *args)
+
+
+def _headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1')
+            for name, value in scope['headers']}
+
+
+def client_address(scope):
+    """The client IP the Flask app sees through ProxyFix, trusting PROXY_X_FOR hops of X-Forwarded-For"""
+    trusted = flask_app.config['PROXY_X_FOR']
+    forwarded = ','.join(value.decode('latin-1') for name, value in scope['headers'] if name == b'x-forwarded-for')
+    if trusted and forwarded:
+        values = parse_list_header(forwarded)
+        if len(values) >= trusted:
+            return values[-trusted]
+    return scope['client'][0] if scope.get('client') else None
+
+
+def load_session(headers):
+    """Decode the signed Flask session cookie, or return an empty dict"""
+    value = parse_cookie(headers.get('cookie', '')).get(flask_app.config['SESSION_COOKIE_NAME'])
+    if value is None:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+    try:
+        return dict(serializer.loads(value, max_age=max_age))
+    except BadSignature:
+        return {}
+
+
+def session_cookie(session_data):
+    """Build a Set-Cookie header carrying an updated Flask session"""
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    value = dump_cookie(
+        flask_app.config['SESSION_COOKIE_NAME'],
+        serializer.dumps(session_data),
+        path=flask_app.config['SESSION_COOKIE_PATH'] or flask_app.config['APPLICATION_ROOT'],
+        domain=flask_app.config['SESSION_COOKIE_DOMAIN'],
+        secure=flask_app.config['SESSION_COOKIE_SECURE'],
+        httponly=flask_app.config['SESSION_COOKIE_HTTPONLY'],
+        samesite=flask_app.config['SESSION_COOKIE_SAMESITE'],
+    )
+    return value.encode('latin-1')
+
+
+async def send_json(send, status, body, headers=()):
+    payload = json.dumps(body).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(payload)).encode())] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def watch_disconnect(receive, disconnected):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+async def send_object_range(send, storage, key, start, stop, disconnected, shaper=None, file_id=None):
+    """Stream bytes [start, stop) of a stored object, reading on the thread pool
+
+    With a shaper, every block is charged to the share's egress rate and
+    the stream pauses while the link is over it.
+    """
+    blocks = storage.get_range_stream(key, start, stop, STREAM_BLOCK_SIZE)
+    try:
+        while not disconnected.is_set():
+            chunk = await asyncio.to_thread(next, blocks, None)
+            if chunk is None:
+                break
+            # uvicorn applies transport back-pressure here, so a slow reader
+            # never makes us buffer more than a block or two
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            pause = shape_egress(shaper, file_id, len(chunk))
+            if pause:
+                await asyncio.sleep(pause)
+    finally:
+        blocks.close()
+
+
+def _reserve_download(share):
+    try:
+        reserved = share.reserve_download()
+    except QuotaExceeded:
+        # Flask renders the quota page
+        return None
+    invalidate_share(share.file_id)
+    return reserved
+
+
+async def serve_download(scope, receive, send, file_id):
+    """Async equivalent of download.download_file for links that need no page"""
+    headers = _headers(scope)
+    session_data = load_session(headers)
+    client_ip = client_address(scope)
+    with flask_app.app_context():
+        allowed = lookup_allowed(client_ip)
+    if not allowed:
+        return await flask_asgi(scope, receive, send)
+    share = await run_in_app(get_share, file_id)
+    if share is None or share.is_expired() or share.storage_key is None:
+        # Flask renders the page and counts the miss
+        return await flask_asgi(scope, receive, send)
+
+    has_grant = continues_download(session_data, share, headers.get('range'), headers.get('if-range'))
+    if not has_grant and (share.password_hash or share.is_download_limit_reached()):
+        return await flask_asgi(scope, receive, send)
+
+    # Presigned redirects carry no file bytes; let Flask issue them
+    if flask_app.config['STORAGE_PRESIGNED_DOWNLOADS']:
+        return await flask_asgi(scope, receive, send)
+
+    with flask_app.app_context():
+        busy = scope['method'] == 'GET' and egress_retry_after(file_id)
+        shaper = get_egress_shaper()
+        storage, content_encoding, etag = select_representation(
+            open_for_reading(get_storage(), share), share,
+            headers.get('accept-encoding'), headers.get('range'))
+    if busy:
+        # Flask renders the 429 page for a link over its egress rate
+        return await flask_asgi(scope, receive, send)
+    try:
+        stored = await asyncio.to_thread(storage.stat, share.storage_key)
+    except FileNotFoundError:
+        return await flask_asgi(scope, receive, send)
+
+    extra_headers = []
+    counted = scope['method'] == 'GET' and not has_grant
+    if counted:
+        if await run_in_app(_reserve_download, share) is None:
+            return await flask_asgi(scope, receive, send)
+        issue_download_grant(session_data, file_id, flask_app.config['DOWNLOAD_GRANT_TTL'])
+        extra_headers.append((b'set-cookie', session_cookie(session_data)))
+
+    length = stored.size
+    mimetype = share.served_mime_type
+    last_modified = stored.modified
+    disposition, names = content_disposition(share.original_filename)
+    disposition_value = dump_options_header(disposition, names)
+
+    response_headers = [
+        (b'content-disposition', disposition_value.encode('latin-1')),
+        (b'accept-ranges', b'bytes'),
+        (b'etag', f'"{etag}"'.encode()),
+        (b'last-modified', http_date(last_modified).encode()),
+        (b'cache-control', b'private, no-transform'),
+    ] + extra_headers
+    if share.content_encoding:
+        response_headers.append((b'vary', b'Accept-Encoding'))
+        if content_encoding:
+            response_headers.append((b'content-encoding', content_encoding.encode()))
+
+    async def start(status, content_type, content_length=None, more=()):
+        extra = [(b'content-type', content_type.encode('latin-1'))] + list(more)
+        if content_length is not None:
+            extra.append((b'content-length', str(content_length).encode()))
+        if scope['method'] != 'HEAD':
+            with flask_app.app_context():
+                record_access(share, status, content_length, counted, ip=client_ip,
+                              range_header=headers.get('range'), user_agent=headers.get('user-agent'))
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': response_headers + extra})
+
+    if parse_etags(headers.get('if-none-match')).contains(etag):
+        await start(304, mimetype)
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    ranges = None
+    if if_range_matches(headers.get('if-range'), etag, last_modified):
+        ranges = resolve_ranges(headers.get('range'), length)
+
+    if ranges == []:
+        await start(416, mimetype, 0, [(b'content-range', f'bytes */{length}'.encode())])
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(watch_disconnect(receive, disconnected))
+    try:
+        if ranges is None:
+            await start(200, mimetype, length)
+            if scope['method'] != 'HEAD':
+                await send_object_range(send, storage, share.storage_key, 0, length, disconnected,
+                                        shaper, file_id)
+        elif len(ranges) == 1:
+            first, stop = ranges[0]
+            await start(206, mimetype, stop - first,
+                        [(b'content-range', f'bytes {first}-{stop - 1}/{length}'.encode())])
+            if scope['method'] != 'HEAD':
+                await send_object_range(send, storage, share.storage_key, first, stop, disconnected,
+                                        shaper, file_id)
+        else:
+            boundary, part_headers, trailer, body_length = multipart_layout(ranges, length, mimetype)
+            await start(206, f'multipart/byteranges; boundary={boundary}', body_length)
+            if scope['method'] != 'HEAD':
+                for (first, stop), part_header in zip(ranges, part_headers):
+                    await send({'type': 'http.response.body', 'body': part_header, 'more_body': True})
+                    await send_object_range(send, storage, share.storage_key, first, stop, disconnected,
+                                            shaper, file_id)
+                await send({'type': 'http.response.body', 'body': trailer, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+
+
+def _load_upload(upload_id):
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None:
+        return None
+    return SimpleNamespace(id=upload.id, user_id=upload.user_id, file_path=upload.file_path,
+                           original_filename=upload.original_filename,
+                           upload_offset=upload.upload_offset, upload_length=upload.upload_length)
+
+
+def _advance_offset(upload_id, offset, new_offset):
+    updated = db.session.execute(
+        db.update(UploadSession)
+        .where(UploadSession.id == upload_id, UploadSession.upload_offset == offset)
+        .values(upload_offset=new_offset, updated_at=datetime.now(timezone.utc))
+    ).rowcount
+    db.session.commit()
+    return updated
+
+
+def _write_and_hash(f, hasher, chunk):
+    f.write(chunk)
+    hasher.update(chunk)
+
+
+def _lock_upload_file(path, offset):
+    f = open(path, 'r+b')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    f.seek(offset)
+    f.truncate()
+    return f
+
+
+async def receive_chunk(scope, receive, send, upload_id):
+    """Async equivalent of upload.upload_chunk: stream the body to disk"""
+    headers = _headers(scope)
+    user_id = load_session(headers).get('user_id')
+    upload = await run_in_app(_load_upload, upload_id) if user_id is not None else None
+    if upload is None or upload.user_id != user_id:
+        # Let Flask produce the usual 401/404 responses
+        return await flask_asgi(scope, receive, send)
+
+    try:
+        offset = int(headers.get('upload-offset', ''))
+    except ValueError:
+        return await send_json(send, 400, {'error': 'Upload-Offset header is required'})
+    if offset != upload.upload_offset:
+        return await send_json(send, 409, {'error': 'Upload-Offset does not match the server offset'})
+
+    remaining = upload.upload_length - offset
+    content_length = headers.get('content-length')
+    if content_length is not None and int(content_length) > remaining:
+        return await send_json(send, 413, {'error': 'Chunk extends past the declared upload length'})
+
+    f = await asyncio.to_thread(_lock_upload_file, upload.file_path, offset)
+    if f is None:
+        return await send_json(send, 423, {'error': 'Another chunk is being written for this upload'})
+
+    try:
+        hasher = await asyncio.to_thread(_take_hasher, upload)
+        # The first chunk is held back and checked against the extension before it is written
+        sniffer = ContentSniffer(upload.original_filename, upload.upload_length) if offset == 0 else None
+        head = b''
+        written = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                # Keep whatever arrived so the client can resume from there
+                break
+            chunk = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if written + len(head) + len(chunk) > remaining:
+                await asyncio.to_thread(f.truncate, offset)
+                _drop_hasher(upload.id)
+                return await send_json(send, 413, {'error': 'Chunk extends past the declared upload length'})
+            if sniffer is not None:
+                head += chunk
+                if len(head) < SNIFF_LENGTH and more_body:
+                    continue
+                chunk, head = head, b''
+                try:
+                    sniffer(chunk[:SNIFF_LENGTH])
+                except ContentTypeMismatch:
+                    await asyncio.to_thread(f.truncate, offset)
+                    _drop_hasher(upload.id)
+                    return await send_json(send, 415, {'error': CONTENT_MISMATCH_MESSAGE})
+                sniffer = None
+            if chunk:
+                await asyncio.to_thread(_write_and_hash, f, hasher, chunk)
+                written += len(chunk)
+            if not more_body:
+                break
+
+        await asyncio.to_thread(f.flush)
+        new_offset = offset + written
+        updated = await run_in_app(_advance_offset, upload.id, offset, new_offset)
+    finally:
+        f.close()
+
+    if not updated:
+        _drop_hasher(upload.id)
+        return await send_json(send, 409, {'error': 'Upload-Offset does not match the server offset'})
+
+    _keep_hasher(upload.id, new_offset, hasher)
+    await send({
+        'type': 'http.response.start',
+        'status': 204,
+        'headers': [
+            (b'upload-offset', str(new_offset).encode()),
+            (b'upload-length', str(upload.upload_length).encode()),
+            (b'cache-control', b'no-store'),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # uvicorn ends the process by re-raising SIGTERM, which skips atexit
+            with flask_app.app_context():
+                access_log = get_access_log()
+            if access_log is not None:
+                await asyncio.to_thread(access_log.close)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    method = scope['method']
+    if method in ('GET', 'HEAD'):
+        match = DOWNLOAD_PATH.match(path)
+        if match:
+            return await timed('download.download_file', 'download', serve_download,
+                               scope, receive, send, match.group(1))
+    elif method == 'PATCH':
+        match = UPLOAD_CHUNK_PATH.match(path)
+        if match:
+            return await timed('upload.upload_chunk', 'upload', receive_chunk,
+                               scope, receive, send, match.group(1))
+    return await flask_asgi(scope, receive, send)
@@ -0,0 +1,157 @@
+"""Measure what download analytics cost the request and how fast the writer drains them
+
+Usage:
+    python benchmarks/access_log.py [--events 20000] [--downloads 2000]
+
+Part one is the cost of logging one download as the request sees it:
+a synchronous INSERT plus hourly-total update and COMMIT (what writing
+each event inline would cost), against analytics.AccessLog.record into
+the in-memory buffer and into a spool file. Part two times
+analytics.write_events, the background writer's bulk path, in events per
+second and SQL statements per event. Part three replays GET /d/<id> (a
+Range request continuing a download, so nothing else is written) with
+ANALYTICS_ENABLED off and on.
+
+All against SQLite in a temporary directory; times are the best of
+ROUNDS runs.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+ROUNDS = 5
+
+
+def best_us(fn, count):
+    """Best-of-rounds microseconds per call"""
+    best = None
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        for i in range(count):
+            fn(i)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best / count * 1e6, 2)
+
+
+def seed_share():
+    from app import db
+    from blobstore import new_staging_path, store_staged_file
+    from models import FileShare, ShareSnapshot, User
+
+    user = User(username='bench', email='bench@example.com')
+    user.set_password('bench-password')
+    db.session.add(user)
+    db.session.flush()
+    payload = os.urandom(64 * 1024)
+    staging_path = new_staging_path()
+    with open(staging_path, 'wb') as f:
+        f.write(payload)
+    sha256 = store_staged_file(staging_path, hashlib.sha256(payload).hexdigest(), len(payload))
+    share = FileShare(filename='bench.bin', original_filename='bench.bin', file_size=len(payload),
+                      sha256=sha256, user_id=user.id)
+    db.session.add(share)
+    db.session.commit()
+    return ShareSnapshot.from_share(share)
+
+
+def event_for(share, i):
+    return (share.id, share.file_id, share.user_id, datetime.now(timezone.utc), f'203.0.113.{i % 250}',
+            206, 65536, 'bytes=0-65535', 'bench/1.0', False)
+
+
+def recording(app, share, count, workdir):
+    from app import db
+    from analytics import AccessLog, EVENT_FIELDS
+    from models import AccessEvent, ShareAccessHourly
+
+    def inline(i):
+        event = event_for(share, i)
+        db.session.add(AccessEvent(**dict(zip(EVENT_FIELDS, event))))
+        ShareAccessHourly.add(share.id, event[3].replace(minute=0, second=0, microsecond=0), 1, 0, event[6])
+        db.session.commit()
+
+    # A flush interval longer than the run, so only record() is timed
+    memory = AccessLog(app, batch_size=count * ROUNDS + 1, flush_interval=3600, buffer_size=count * ROUNDS)
+    spool = AccessLog(app, batch_size=count * ROUNDS + 1, flush_interval=3600,
+                      spool_dir=os.path.join(workdir, 'spool'))
+    report = {
+        'sync_insert_commit_us': best_us(inline, max(count // 20, 1)),
+        'buffer_record_us': best_us(lambda i: memory.record(event_for(share, i)), count),
+        'spool_record_us': best_us(lambda i: spool.record(event_for(share, i)), count),
+    }
+    memory.events.clear()
+    spool.flush()
+    return report
+
+
+def writing(app, share, count, batch_size):
+    from sqlalchemy import event
+
+    from app import db
+    from analytics import write_events
+
+    statements = []
+    event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(1))
+    events = [event_for(share, i) for i in range(count)]
+    best = None
+    for _ in range(ROUNDS):
+        statements.clear()
+        started = time.perf_counter()
+        for start in range(0, count, batch_size):
+            write_events(events[start:start + batch_size], batch_size)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {'batch_size': batch_size, 'events_per_s': round(count / best),
+            'sql_per_event': round(len(statements) / count, 3)}
+
+
+def downloads(app, share, count):
+    client = app.test_client()
+    path = f'/d/{share.file_id}'
+    # Count the download once so the timed requests ride on the grant
+    client.get(path).close()
+    report = {}
+    for enabled in (False, True):
+        app.config['ANALYTICS_ENABLED'] = enabled
+        app.extensions.pop('access_log', None)
+
+        def get(i):
+            client.get(path, headers={'Range': 'bytes=0-1023'}).close()
+        report['analytics_on_us' if enabled else 'analytics_off_us'] = best_us(get, count)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--downloads', type=int, default=2000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sfv-bench-')
+    os.chdir(workdir)
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.db'))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    from main import app
+    from migrations import migrate
+
+    with app.app_context():
+        migrate()
+        share = seed_share()
+        report = {
+            'record_per_event': recording(app, share, args.events, workdir),
+            'writer': writing(app, share, args.events, app.config['ANALYTICS_BATCH_SIZE']),
+        }
+    report['download_request'] = downloads(app, share, args.downloads)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
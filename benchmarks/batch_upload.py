@@ -0,0 +1,145 @@
+"""Compare sharing many small files one request at a time against one batch
+
+Usage:
+    python benchmarks/batch_upload.py [--files 1000] [--size 2048]
+        [--workers 4] [--server gunicorn|werkzeug]
+
+The single-file path posts each file to /upload (without following the
+redirect to the dashboard); the batch path sends every file in one
+multipart request to /api/batches. Both run against a fresh user on a
+throwaway SQLite database unless DATABASE_URL is set.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+from io import BytesIO
+
+from werkzeug.datastructures import FileStorage, MultiDict
+from werkzeug.test import encode_multipart
+
+from download_limit_race import REPO_ROOT, free_port, start_server
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def seed_user():
+    from app import db
+    from main import app
+    from migrations import migrate
+    from models import User
+
+    with app.app_context():
+        migrate()
+        user = User(username='bench', email='bench@example.com')
+        user.set_password('bench-password')
+        db.session.add(user)
+        db.session.commit()
+
+
+def login(opener, base_url):
+    """Log in and return the session cookie header
+
+    Later requests resend this cookie rather than the updated one, so the
+    flash messages queued by each /upload don't pile up in the session.
+    """
+    jar = http.cookiejar.CookieJar()
+    body = b'username=bench&password=bench-password'
+    request = urllib.request.Request(f'{base_url}/login', data=body)
+    try:
+        opener.open(request)
+    except urllib.error.HTTPError as e:
+        if e.code != 302:
+            raise
+        jar.extract_cookies(e, request)
+    return '; '.join(f'{cookie.name}={cookie.value}' for cookie in jar)
+
+
+def post_multipart(opener, cookie, url, fields):
+    boundary, body = encode_multipart(MultiDict(fields))
+    request = urllib.request.Request(url, data=body, headers={
+        'Content-Type': f'multipart/form-data; boundary={boundary}',
+        'Cookie': cookie,
+    })
+    try:
+        with opener.open(request, timeout=600) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def make_files(count, size, prefix):
+    # Distinct contents, so every file is stored rather than deduplicated
+    return [(f'{prefix}{i}.txt', f'{prefix} file {i} '.encode().ljust(size, b'.')) for i in range(count)]
+
+
+def file_field(name, content):
+    return ('files', FileStorage(BytesIO(content), filename=name, content_type='text/plain'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=2048)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--server', choices=['gunicorn', 'werkzeug'], default='gunicorn')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sfv-bench-')
+    os.chdir(workdir)
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.db'))
+    # One upload per file is the point of the comparison; don't throttle it
+    os.environ.setdefault('UPLOAD_RATE_PER_USER', '1000000/second')
+    sys.path.insert(0, REPO_ROOT)
+
+    seed_user()
+    port = free_port()
+    stop = start_server(args.server, port, args.workers)
+    base_url = f'http://127.0.0.1:{port}'
+
+    try:
+        opener = urllib.request.build_opener(NoRedirect())
+        cookie = login(opener, base_url)
+
+        single_files = make_files(args.files, args.size, 'single')
+        started = time.perf_counter()
+        single_ok = 0
+        for name, content in single_files:
+            status, _ = post_multipart(opener, cookie, f'{base_url}/upload', [('file', file_field(name, content)[1])])
+            single_ok += status == 302
+        single_s = time.perf_counter() - started
+
+        batch_files = make_files(args.files, args.size, 'batch')
+        started = time.perf_counter()
+        status, body = post_multipart(opener, cookie, f'{base_url}/api/batches',
+                                      [file_field(name, content) for name, content in batch_files]
+                                      + [('collection', '1')])
+        batch_s = time.perf_counter() - started
+        batch_ok = json.loads(body).get('count', 0) if status == 201 else 0
+    finally:
+        stop()
+
+    report = {
+        'server': args.server,
+        'database': os.environ['DATABASE_URL'].split(':', 1)[0],
+        'files': args.files,
+        'file_size': args.size,
+        'single': {'stored': single_ok, 'elapsed_s': round(single_s, 3),
+                   'files_per_s': round(args.files / single_s, 1)},
+        'batch': {'stored': batch_ok, 'status': status, 'elapsed_s': round(batch_s, 3),
+                  'files_per_s': round(args.files / batch_s, 1)},
+        'speedup': round(single_s / batch_s, 1),
+    }
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if single_ok == batch_ok == args.files else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Compare streaming a collection ZIP against building it in a temp file first
+
+Usage:
+    python benchmarks/collection_zip.py [--files 20] [--size 10485760]
+        [--level 1]
+
+Half the files are text-like (deflated at --level), half random bytes
+standing in for media (stored). For the streaming archive and for
+zipfile writing a temporary archive that is then read back, the script
+reports time to first byte, total time, throughput, peak Python heap and
+the temporary disk space used.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from storage import LocalStorage
+from streaming import STREAM_BLOCK_SIZE
+from zipstream import DEFLATED, STORED, ZipEntry, deflated_data, iter_zip, stored_data
+
+
+def make_files(storage, count, size):
+    files = []
+    line = b'2024-05-01 12:00:00 INFO worker handled request in 12.5 ms\n'
+    for i in range(count):
+        name = f'file{i}.txt' if i % 2 == 0 else f'file{i}.mp4'
+        with open(storage.local_path(name), 'wb') as f:
+            for _ in range(0, size, 1024 * 1024):
+                block = min(1024 * 1024, size - f.tell())
+                f.write((line * (block // len(line) + 1))[:block] if i % 2 == 0 else os.urandom(block))
+        files.append(name)
+    return files
+
+
+def streamed(storage, files, size, level):
+    entries = []
+    for name in files:
+        chunks = lambda name=name: storage.get_range_stream(name, 0, size)
+        if name.endswith('.txt') and level:
+            entries.append(ZipEntry(name, datetime.now(), size, None, DEFLATED,
+                                    lambda chunks=chunks: deflated_data(chunks(), level)))
+        else:
+            entries.append(ZipEntry(name, datetime.now(), size, size, STORED,
+                                    lambda chunks=chunks: stored_data(chunks())))
+    return iter_zip(entries), 0
+
+
+def temp_archive(storage, files, size, level):
+    fd, path = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name in files:
+            compress = zipfile.ZIP_DEFLATED if name.endswith('.txt') and level else zipfile.ZIP_STORED
+            archive.write(storage.local_path(name), name, compress_type=compress, compresslevel=level or None)
+    disk = os.path.getsize(path)
+
+    def body():
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(STREAM_BLOCK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+        finally:
+            os.remove(path)
+    return body(), disk
+
+
+def measure(name, build, storage, files, size, level):
+    tracemalloc.start()
+    started = time.perf_counter()
+    body, disk = build(storage, files, size, level)
+    first_byte = None
+    total = 0
+    for chunk in body:
+        if first_byte is None:
+            first_byte = time.perf_counter() - started
+        total += len(chunk)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'mode': name,
+        'archive_bytes': total,
+        'first_byte_ms': round(first_byte * 1000, 1),
+        'elapsed_s': round(elapsed, 3),
+        'input_mb_per_s': round(len(files) * size / (1024 * 1024) / elapsed, 1),
+        'peak_heap_mb': round(peak / (1024 * 1024), 2),
+        'temp_disk_mb': round(disk / (1024 * 1024), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--size', type=int, default=10 * 1024 * 1024)
+    parser.add_argument('--level', type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sfv-bench-')
+    try:
+        storage = LocalStorage(workdir)
+        files = make_files(storage, args.files, args.size)
+        report = {
+            'files': args.files,
+            'file_size': args.size,
+            'deflate_level': args.level,
+            'results': [
+                measure('streamed', streamed, storage, files, args.size, args.level),
+                measure('temp-file', temp_archive, storage, files, args.size, args.level),
+            ],
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Compare two loadtest.py result files and fail on regressions
+
+Usage:
+    python benchmarks/compare.py baseline.json candidate.json
+        [--threshold 0.2] [--min-ms 1]
+
+For every database and scenario present in both files, a scenario
+regresses when its p50 or p99 latency grows by more than --threshold
+(a fraction) and by more than --min-ms milliseconds, when its
+throughput drops by more than --threshold, or when it has errors the
+baseline did not. Skipped databases are ignored. Prints a table and
+exits with status 1 if anything regressed.
+"""
+import argparse
+import json
+import sys
+
+
+def change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / before
+
+
+def compare_scenario(base, cand, threshold, min_ms):
+    """List of reasons the candidate scenario is a regression"""
+    reasons = []
+    for key in ('p50_ms', 'p99_ms'):
+        delta = change(base.get(key), cand.get(key))
+        if delta is not None and delta > threshold and cand[key] - base[key] > min_ms:
+            reasons.append(f'{key} +{delta:.0%}')
+    delta = change(base.get('requests_per_s'), cand.get('requests_per_s'))
+    if delta is not None and delta < -threshold:
+        reasons.append(f'requests_per_s {delta:.0%}')
+    if cand.get('errors', 0) > base.get('errors', 0):
+        reasons.append(f'errors {base.get("errors", 0)} -> {cand["errors"]}')
+    return reasons
+
+
+def format_change(base, cand, key):
+    delta = change(base.get(key), cand.get(key))
+    return f'{cand.get(key)} ({delta:+.0%})' if delta is not None else str(cand.get(key))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--min-ms', type=float, default=1.0)
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    rows = []
+    regressions = 0
+    for database, base_db in baseline['databases'].items():
+        cand_db = candidate['databases'].get(database)
+        if not cand_db or 'results' not in base_db or 'results' not in cand_db:
+            continue
+        for scenario, base in base_db['results'].items():
+            cand = cand_db['results'].get(scenario)
+            if cand is None:
+                continue
+            reasons = compare_scenario(base, cand, args.threshold, args.min_ms)
+            regressions += bool(reasons)
+            rows.append((f'{database}/{scenario}', format_change(base, cand, 'p50_ms'),
+                         format_change(base, cand, 'p99_ms'), format_change(base, cand, 'requests_per_s'),
+                         'REGRESSED: ' + ', '.join(reasons) if reasons else 'ok'))
+
+    header = ('scenario', 'p50 ms', 'p99 ms', 'req/s', 'verdict')
+    widths = [max(len(str(row[i])) for row in [header, *rows]) for i in range(len(header))]
+    for row in [header, *rows]:
+        print('  '.join(str(value).ljust(width) for value, width in zip(row, widths)).rstrip())
+    print(f'\n{len(rows)} scenarios compared, {regressions} regressed '
+          f'(threshold {args.threshold:.0%}, min {args.min_ms} ms)')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Weigh compression CPU cost against bytes saved for typical upload contents
+
+Usage:
+    python benchmarks/compression_cost.py [--size 20971520] [--codec zstd gzip]
+
+For each synthetic corpus (log text, CSV, a legacy binary document,
+random bytes standing in for media and archives) and each codec and
+level, reports compression and decompression throughput per core, the
+fraction of bytes saved and the CPU milliseconds spent per MB saved. The
+entropy sample that decides whether to compress at all is timed too.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from compression import (ENTROPY_THRESHOLD, _zstd, compressor, iter_decompressed,
+                         sample_file, shannon_entropy)
+
+LEVELS = {'zstd': [1, 3, 6, 9, 19], 'gzip': [1, 5, 6, 9]}
+BLOCK = 64 * 1024
+
+
+def log_corpus(size):
+    rng = random.Random(1)
+    lines = []
+    total = 0
+    while total < size:
+        line = (f'2024-05-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d} '
+                f'{rng.choice(["INFO", "WARN", "DEBUG"])} worker-{rng.randint(1, 16)} '
+                f'handled request {rng.randint(0, 10**6)} in {rng.random() * 100:.2f} ms\n')
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def csv_corpus(size):
+    rng = random.Random(2)
+    rows = ['id,name,amount,currency,created\n']
+    total = len(rows[0])
+    while total < size:
+        row = f'{len(rows)},customer-{rng.randint(1, 5000)},{rng.random() * 1000:.2f},EUR,2024-01-{rng.randint(1, 28):02d}\n'
+        rows.append(row)
+        total += len(row)
+    return ''.join(rows).encode()[:size]
+
+
+def document_corpus(size):
+    # Legacy .doc/.xls files: text runs mixed with structured binary records
+    rng = random.Random(3)
+    parts = []
+    total = 0
+    while total < size:
+        part = rng.choice([os.urandom(rng.randint(16, 256)), b'\x00' * rng.randint(64, 1024),
+                           ('Quarterly report paragraph %d. ' % rng.randint(0, 999)).encode() * 8])
+        parts.append(part)
+        total += len(part)
+    return b''.join(parts)[:size]
+
+
+CORPORA = {
+    'log.txt': log_corpus,
+    'table.csv': csv_corpus,
+    'report.doc': document_corpus,
+    'video.mp4': os.urandom,
+}
+
+
+def compress(codec, level, data):
+    engine = compressor(codec, level)
+    out = [engine.compress(data[i:i + BLOCK]) for i in range(0, len(data), BLOCK)]
+    out.append(engine.flush())
+    return b''.join(out)
+
+
+def cpu_seconds(fn, *args):
+    started = time.process_time()
+    result = fn(*args)
+    return time.process_time() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=20 * 1024 * 1024)
+    parser.add_argument('--codec', nargs='+', choices=sorted(LEVELS), default=['zstd', 'gzip'])
+    args = parser.parse_args()
+    codecs = [codec for codec in args.codec if codec != 'zstd' or _zstd() is not None]
+    mb = args.size / (1024 * 1024)
+
+    results = []
+    for name, make in CORPORA.items():
+        data = make(args.size)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            sample_s, entropy = cpu_seconds(lambda: shannon_entropy(sample_file(f.name, len(data))))
+
+        for codec in codecs:
+            for level in LEVELS[codec]:
+                compress_s, packed = cpu_seconds(compress, codec, level, data)
+                blocks = [packed[i:i + BLOCK] for i in range(0, len(packed), BLOCK)]
+                decompress_s, _ = cpu_seconds(lambda: sum(len(c) for c in iter_decompressed(codec, blocks)))
+                saved_mb = (len(data) - len(packed)) / (1024 * 1024)
+                results.append({
+                    'corpus': name,
+                    'entropy_bits': round(entropy, 2),
+                    'would_skip': entropy > ENTROPY_THRESHOLD,
+                    'sample_ms': round(sample_s * 1000, 2),
+                    'codec': codec,
+                    'level': level,
+                    'saved_fraction': round(1 - len(packed) / len(data), 3),
+                    'compress_mb_per_s': round(mb / max(compress_s, 1e-9), 1),
+                    'decompress_mb_per_s': round(mb / max(decompress_s, 1e-9), 1),
+                    'cpu_ms_per_mb_saved': round(compress_s * 1000 / saved_mb, 2) if saved_mb > 0 else None,
+                })
+
+    print(json.dumps({'size': args.size, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
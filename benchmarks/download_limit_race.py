@@ -0,0 +1,151 @@
+"""Fire N parallel downloads at one limited link and check the limit holds
+
+Usage:
+    python benchmarks/download_limit_race.py [--requests 200] [--limit 5]
+        [--workers 4] [--server gunicorn|werkzeug]
+
+The app runs against a throwaway SQLite database in a temporary directory
+unless DATABASE_URL is set (e.g. to a PostgreSQL instance). Exactly
+``--limit`` requests must receive the file; the rest must be refused.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server did not start on port {port}')
+
+
+def seed_share(payload, download_limit):
+    """Create a user and one limited share, returning its file ID"""
+    from app import db
+    from main import app
+    from migrations import migrate
+    from models import User, FileShare
+    from blobstore import new_staging_path, store_staged_file
+    import hashlib
+
+    with app.app_context():
+        migrate()
+        user = User(username='bench', email='bench@example.com')
+        user.set_password('bench-password')
+        db.session.add(user)
+        db.session.flush()
+
+        staging_path = new_staging_path()
+        with open(staging_path, 'wb') as f:
+            f.write(payload)
+        sha256 = store_staged_file(staging_path, hashlib.sha256(payload).hexdigest(), len(payload))
+        share = FileShare(
+            filename='bench.bin',
+            original_filename='bench.bin',
+            file_size=len(payload),
+            sha256=sha256,
+            download_limit=download_limit,
+            user_id=user.id
+        )
+        db.session.add(share)
+        db.session.commit()
+        return share.file_id
+
+
+def start_server(kind, port, workers):
+    if kind == 'gunicorn':
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}',
+             '--workers', str(workers), '--log-level', 'warning', 'main:app'],
+            env={**os.environ, 'PYTHONPATH': REPO_ROOT},
+        )
+        wait_for_port(port)
+        return proc.terminate
+
+    from werkzeug.serving import make_server
+    from main import app
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    wait_for_port(port)
+    return server.shutdown
+
+
+def fetch(url, expected_size):
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            body = response.read()
+            disposition = response.headers.get('Content-Disposition', '')
+    except Exception:
+        return False
+    return disposition.startswith('attachment') and len(body) == expected_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--limit', type=int, default=5)
+    parser.add_argument('--size', type=int, default=64 * 1024)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--server', choices=['gunicorn', 'werkzeug'], default='gunicorn')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sfv-bench-')
+    os.chdir(workdir)
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.db'))
+    sys.path.insert(0, REPO_ROOT)
+
+    payload = os.urandom(args.size)
+    file_id = seed_share(payload, args.limit)
+    port = free_port()
+    stop = start_server(args.server, port, args.workers)
+    url = f'http://127.0.0.1:{port}/d/{file_id}'
+
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda _: fetch(url, args.size), range(args.requests)))
+        elapsed = time.perf_counter() - started
+    finally:
+        stop()
+
+    served = sum(results)
+    report = {
+        'server': args.server,
+        'database': os.environ['DATABASE_URL'].split(':', 1)[0],
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'download_limit': args.limit,
+        'served': served,
+        'refused': args.requests - served,
+        'elapsed_s': round(elapsed, 3),
+        'requests_per_s': round(args.requests / elapsed, 1),
+        'ok': served == args.limit,
+    }
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['ok'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Compare plaintext, whole-file and chunked encryption throughput per core
+
+Usage:
+    python benchmarks/encryption_throughput.py [--size 104857600]
+        [--chunk-size 65536] [--cipher aes-gcm|chacha20-poly1305]
+
+Everything runs on one thread, so MB/s figures are per core. For each
+mode the script reports the write (store) and full read rate, the latency
+of a 1 MiB Range read from the middle of the file and the peak Python
+heap allocated while storing the file.
+"""
+import argparse
+import json
+import os
+import secrets
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from encryption import CIPHERS, DataKey, DecryptingStorage, _aead, encrypt_file
+from storage import LocalStorage
+
+RANGE_LENGTH = 1024 * 1024
+
+
+def timed(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def drain(iterator):
+    for _ in iterator:
+        pass
+
+
+class PlaintextMode:
+    name = 'plaintext'
+
+    def __init__(self, storage, source, size):
+        self.storage, self.source, self.size = storage, source, size
+
+    def store(self):
+        shutil.copyfile(self.source, self.storage.local_path('plain'))
+
+    def read(self, start, stop):
+        drain(self.storage.get_range_stream('plain', start, stop))
+
+
+class WholeFileMode:
+    """One AEAD call over the entire file, as a naive implementation would do"""
+    name = 'whole-file'
+
+    def __init__(self, storage, source, size, cipher):
+        self.storage, self.source, self.size = storage, source, size
+        self.aead = _aead(cipher, secrets.token_bytes(32))
+        self.nonce = secrets.token_bytes(12)
+
+    def store(self):
+        with open(self.source, 'rb') as f:
+            sealed = self.aead.encrypt(self.nonce, f.read(), None)
+        with open(self.storage.local_path('whole'), 'wb') as f:
+            f.write(sealed)
+
+    def read(self, start, stop):
+        # Any range needs the whole ciphertext authenticated first
+        with open(self.storage.local_path('whole'), 'rb') as f:
+            self.aead.decrypt(self.nonce, f.read(), None)[start:stop]
+
+
+class ChunkedMode:
+    name = 'chunked'
+
+    def __init__(self, storage, source, size, cipher, chunk_size):
+        self.storage, self.source, self.size = storage, source, size
+        self.data_key = DataKey(secrets.token_bytes(32), cipher, chunk_size)
+        self.reader = DecryptingStorage(storage, self.data_key, size)
+
+    def store(self):
+        encrypt_file(self.source, self.storage.local_path('chunked'), self.data_key, self.size)
+
+    def read(self, start, stop):
+        drain(self.reader.get_range_stream('chunked', start, stop))
+
+
+def measure(mode, size):
+    mb = size / (1024 * 1024)
+    store_s = timed(mode.store)
+    read_s = timed(lambda: mode.read(0, size))
+    middle = size // 2
+    range_s = timed(lambda: mode.read(middle, min(middle + RANGE_LENGTH, size)))
+    return {
+        'mode': mode.name,
+        'store_mb_per_s': round(mb / store_s, 1),
+        'read_mb_per_s': round(mb / read_s, 1),
+        'range_1mib_ms': round(range_s * 1000, 2),
+        'store_peak_heap_mb': round(peak_memory(mode.store) / (1024 * 1024), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=100 * 1024 * 1024)
+    parser.add_argument('--chunk-size', type=int, default=64 * 1024)
+    parser.add_argument('--cipher', choices=sorted(CIPHERS), default='aes-gcm')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sfv-bench-')
+    try:
+        storage = LocalStorage(workdir)
+        source = os.path.join(workdir, 'source')
+        with open(source, 'wb') as f:
+            for _ in range(0, args.size, 1024 * 1024):
+                f.write(os.urandom(min(1024 * 1024, args.size - f.tell())))
+
+        cipher = CIPHERS[args.cipher]
+        modes = [
+            PlaintextMode(storage, source, args.size),
+            WholeFileMode(storage, source, args.size, cipher),
+            ChunkedMode(storage, source, args.size, cipher, args.chunk_size),
+        ]
+        report = {
+            'size': args.size,
+            'cipher': args.cipher,
+            'chunk_size': args.chunk_size,
+            'results': [measure(mode, args.size) for mode in modes],
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
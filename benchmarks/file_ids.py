@@ -0,0 +1,103 @@
+"""Measure file-ID generation and the size and speed of the file_id index
+
+Usage:
+    python benchmarks/file_ids.py [--rows 1000000] [--ids 100000]
+
+Generation compares the old per-character secrets.choice loop with
+utils.generate_file_id (one token_bytes call per ID) and
+utils.generate_file_ids (one call per batch of 1000), in microseconds
+per ID.
+
+The index part loads --rows IDs into two SQLite tables with a unique
+index each, one storing the 12-character text and one the 9-byte keys
+models.CompactID stores, and reports the index size (from dbstat), its
+bytes per row, the size extrapolated to 10M rows, and the time of a
+point lookup by ID.
+"""
+import argparse
+import json
+import os
+import random
+import secrets
+import sqlite3
+import string
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+ROUNDS = 5
+
+from utils import file_id_key, generate_file_id, generate_file_ids  # noqa: E402
+
+
+def legacy_file_id():
+    alphabet = string.ascii_letters + string.digits
+    return ''.join(secrets.choice(alphabet) for _ in range(12))
+
+
+def best_us(fn, count):
+    """Best-of-rounds microseconds per ID, fn(count) producing count IDs"""
+    best = None
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        fn(count)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best / count * 1e6, 3)
+
+
+def generation(count):
+    return {
+        'legacy_choice_loop_us': best_us(lambda n: [legacy_file_id() for _ in range(n)], count),
+        'token_bytes_us': best_us(lambda n: [generate_file_id() for _ in range(n)], count),
+        'batch_of_1000_us': best_us(lambda n: [generate_file_ids(1000) for _ in range(n // 1000)], count),
+    }
+
+
+def index(rows):
+    path = os.path.join(tempfile.mkdtemp(prefix='sfv-bench-'), 'ids.db')
+    connection = sqlite3.connect(path)
+    ids = [file_id for _ in range(rows // 1000) for file_id in generate_file_ids(1000)]
+    probes = random.sample(ids, min(len(ids), 10000))
+    report = {'rows': len(ids)}
+    for name, column_type, encode in (('text', 'VARCHAR(32)', str), ('binary', 'BLOB', file_id_key)):
+        connection.execute(f'CREATE TABLE {name} (id INTEGER PRIMARY KEY, file_id {column_type} NOT NULL)')
+        connection.execute(f'CREATE UNIQUE INDEX ix_{name} ON {name} (file_id)')
+        connection.executemany(f'INSERT INTO {name} (file_id) VALUES (?)', ((encode(i),) for i in ids))
+        connection.commit()
+        connection.execute('VACUUM')
+        size = connection.execute('SELECT sum(pgsize) FROM dbstat WHERE name = ?', (f'ix_{name}',)).fetchone()[0]
+        keys = [encode(i) for i in probes]
+        query = f'SELECT id FROM {name} WHERE file_id = ?'
+        best = None
+        for _ in range(ROUNDS):
+            started = time.perf_counter()
+            for key in keys:
+                connection.execute(query, (key,)).fetchone()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        report[name] = {
+            'index_bytes': size,
+            'bytes_per_row': round(size / len(ids), 1),
+            'index_mb_at_10m_rows': round(size / len(ids) * 10_000_000 / 1e6, 1),
+            'lookup_us': round(best / len(keys) * 1e6, 2),
+        }
+    connection.close()
+    os.remove(path)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--ids', type=int, default=100000)
+    args = parser.parse_args()
+
+    report = {'generation': generation(args.ids), 'index': index(args.rows)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,465 @@
+"""Load-test upload, download and auth paths under gunicorn and save the results
+
+Usage:
+    python benchmarks/loadtest.py [--database sqlite postgres] [--workers 4]
+        [--concurrency 8] [--shares 10000] [--quick] [--seed 1]
+        [--output results.json]
+
+For each database the app is started under gunicorn against a fresh
+schema seeded with synthetic users and shares, then each scenario runs a
+fixed number of requests from --concurrency client threads:
+
+    upload_<size>        POST /upload, 1 KB to 100 MB, unique content each time
+    download_<size>      GET /d/<id>, whole file
+    download_range       GET /d/<id> with a random 64 KiB Range of the large file
+    download_password    POST /d/<id> with the password (one hash verification each)
+    login                POST /login
+    dashboard            GET /dashboard for a user with --shares shares
+
+Every scenario reports p50/p90/p99 latency, requests per second and MB/s;
+errors (unexpected status codes) are counted, not timed. The database
+"postgres" uses BENCH_POSTGRES_URL if set, otherwise a throwaway cluster
+started with initdb/pg_ctl from PATH; without either (or without
+psycopg2) it is recorded as skipped. --quick caps sizes and request
+counts for CI. Compare two result files with benchmarks/compare.py.
+"""
+import argparse
+import http.client
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from download_limit_race import REPO_ROOT, free_port, start_server
+
+KB = 1024
+MB = 1024 * 1024
+
+UPLOAD_SIZES = [KB, MB, 10 * MB, 100 * 1000 * 1000]
+DOWNLOAD_SIZES = [KB, MB, 100 * 1000 * 1000]
+RANGE_LENGTH = 64 * KB
+QUICK_MAX_SIZE = 10 * MB
+
+PASSWORD = 'bench-password'
+SHARE_PASSWORD = 'bench-share-password'
+
+# Enough requests for a stable p99 on small requests; large transfers are
+# capped by bytes moved instead
+BASE_REQUESTS = 400
+BYTES_PER_SCENARIO = 2000 * MB
+QUICK_REQUESTS = 100
+QUICK_BYTES_PER_SCENARIO = 200 * MB
+
+
+def size_label(size):
+    if size >= 1000 * 1000:
+        return f'{round(size / (1000 * 1000))}MB'
+    if size >= 1000:
+        return f'{round(size / 1000)}KB'
+    return f'{size}B'
+
+
+def request_count(size, base, budget):
+    return max(10, min(base, budget // max(size, 1)))
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def write_random_file(path, size, rng):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            block = min(MB, remaining)
+            f.write(rng.randbytes(block))
+            remaining -= block
+
+
+# --- seeding (runs in the child process, against DATABASE_URL) -------------
+
+def seed(workdir, run_id, shares, download_sizes, rng):
+    """Create users, stored files and shares; returns what the scenarios need"""
+    import hashlib
+
+    from app import db
+    from main import app
+    from migrations import migrate
+    from blobstore import new_staging_path, store_staged_file
+    from models import Blob, FileShare, User, UserStats
+
+    def store(size, password=None):
+        path = os.path.join(workdir, f'payload-{size}')
+        if not os.path.exists(path):
+            write_random_file(path, size, rng)
+        with open(path, 'rb') as f:
+            sha256 = hashlib.file_digest(f, 'sha256').hexdigest()
+        staging_path = new_staging_path()
+        shutil.copyfile(path, staging_path)
+        sha256 = store_staged_file(staging_path, sha256, size, filename='bench.pdf')
+        share = FileShare(filename='bench.pdf', original_filename='bench.pdf', file_size=size,
+                          sha256=sha256, user_id=user.id)
+        share.set_password(password)
+        db.session.add(share)
+        UserStats.adjust(user.id, file_count=1, total_bytes=size)
+        return share.file_id, sha256
+
+    with app.app_context():
+        migrate()
+        user = User(username=f'bench-{run_id}', email=f'bench-{run_id}@example.com')
+        user.set_password(PASSWORD)
+        db.session.add(user)
+        db.session.flush()
+
+        smallest = min(download_sizes)
+        stored = {size: store(size) for size in download_sizes}
+        protected, _ = store(4 * KB, password=SHARE_PASSWORD)
+
+        # The dashboard user: many small shares with a realistic status mix
+        owner = User(username=f'owner-{run_id}', email=f'owner-{run_id}@example.com')
+        owner.set_password(PASSWORD)
+        db.session.add(owner)
+        db.session.flush()
+        sha256 = stored[smallest][1]
+        now = datetime.now(timezone.utc)
+        rows = []
+        for i in range(shares):
+            kind = rng.random()
+            limit = 5 if kind < 0.2 else None
+            count = rng.randint(0, 5) if limit else rng.randint(0, 50)
+            rows.append({
+                'file_id': FileShare.generate_file_id(),
+                'filename': f'file{i}.pdf',
+                'original_filename': f'file{i}.pdf',
+                'file_size': smallest,
+                'sha256': sha256,
+                'download_limit': limit,
+                'download_count': count,
+                'exhausted_at': now if limit and count >= limit else None,
+                'expires_at': now + timedelta(hours=rng.randint(-240, 240)) if kind > 0.6 else None,
+                'created_at': now - timedelta(minutes=shares - i),
+                'user_id': owner.id,
+            })
+        for start in range(0, len(rows), 1000):
+            db.session.execute(db.insert(FileShare), rows[start:start + 1000])
+        db.session.execute(db.update(Blob).where(Blob.sha256 == sha256)
+                           .values(ref_count=Blob.ref_count + shares))
+        # The owner's first counter change rebuilds the summary from file_shares
+        UserStats.adjust(owner.id, file_count=shares, total_bytes=shares * smallest)
+        db.session.commit()
+
+        return {
+            'user': user.username,
+            'owner': owner.username,
+            'downloads': {size: file_id for size, (file_id, _) in stored.items()},
+            'protected': protected,
+        }
+
+
+# --- HTTP client ------------------------------------------------------------
+
+class Client:
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, body=None, headers=None):
+        """Send a request and read the whole response; returns (status, body length, headers)"""
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            received = 0
+            while True:
+                chunk = response.read(256 * KB)
+                if not chunk:
+                    break
+                received += len(chunk)
+            return response.status, received, response
+        finally:
+            conn.close()
+
+    def login(self, username):
+        body = f'username={username}&password={PASSWORD}'.encode()
+        status, _, response = self.request('POST', '/login', body, {
+            'Content-Type': 'application/x-www-form-urlencoded'})
+        if status != 302:
+            raise RuntimeError(f'login failed with status {status}')
+        cookie = response.getheader('Set-Cookie').split(';', 1)[0]
+        return cookie
+
+
+def multipart_upload(path, size, index):
+    """(headers, body iterator) for an /upload of a payload file made unique by its first bytes"""
+    boundary = uuid.uuid4().hex
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="bench{index}.pdf"\r\n'
+            f'Content-Type: application/pdf\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+    # A PDF header, so the upload passes the content-type check, then random bytes
+    unique = (b'%PDF-1.7\n%' + uuid.uuid4().hex.encode())[:min(42, size)]
+
+    def body():
+        yield head
+        yield unique
+        with open(path, 'rb') as f:
+            f.seek(len(unique))
+            while True:
+                chunk = f.read(256 * KB)
+                if not chunk:
+                    break
+                yield chunk
+        yield tail
+
+    headers = {
+        'Content-Type': f'multipart/form-data; boundary={boundary}',
+        'Content-Length': str(len(head) + size + len(tail)),
+    }
+    return headers, body()
+
+
+def run_scenario(name, make_request, requests, concurrency, payload_bytes=0, warmup=3):
+    """Run ``requests`` calls of make_request(i) -> ok from a thread pool"""
+    for i in range(warmup):
+        make_request(-1 - i)
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            ok = make_request(i)
+        except (OSError, http.client.HTTPException):
+            ok = False
+        elapsed = time.perf_counter() - started
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return name, {
+        'requests': requests,
+        'errors': errors,
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p90_ms': ms(percentile(latencies, 0.90)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'requests_per_s': round(len(latencies) / wall, 2),
+        'mb_per_s': round(payload_bytes * len(latencies) / wall / MB, 2) if payload_bytes else None,
+    }
+
+
+def run_scenarios(port, seeded, args, workdir, rng):
+    client = Client(port)
+    base = QUICK_REQUESTS if args.quick else BASE_REQUESTS
+    budget = QUICK_BYTES_PER_SCENARIO if args.quick else BYTES_PER_SCENARIO
+    results = {}
+
+    def record(scenario):
+        name, result = scenario
+        results[name] = result
+        print(f'  {name}: p50 {result["p50_ms"]} ms, p99 {result["p99_ms"]} ms, '
+              f'{result["requests_per_s"]} req/s, {result["errors"]} errors', file=sys.stderr)
+
+    cookie = client.login(seeded['user'])
+    for size in args.upload_sizes:
+        path = os.path.join(workdir, f'upload-{size}')
+        write_random_file(path, size, rng)
+
+        def upload(i, path=path, size=size):
+            headers, body = multipart_upload(path, size, i)
+            headers['Cookie'] = cookie
+            status, _, _ = client.request('POST', '/upload', body, headers)
+            return status == 302
+        record(run_scenario(f'upload_{size_label(size)}', upload, request_count(size, base // 2, budget),
+                            args.concurrency, payload_bytes=size))
+
+    for size, file_id in sorted(seeded['downloads'].items()):
+        def download(i, file_id=file_id, size=size):
+            status, received, _ = client.request('GET', f'/d/{file_id}')
+            return status == 200 and received == size
+        record(run_scenario(f'download_{size_label(size)}', download, request_count(size, base, budget),
+                            args.concurrency, payload_bytes=size))
+
+    largest = max(seeded['downloads'])
+    large_id = seeded['downloads'][largest]
+    ranges = [rng.randrange(0, max(1, largest - RANGE_LENGTH)) for _ in range(base)]
+
+    def download_range(i):
+        start = ranges[i % len(ranges)]
+        status, received, _ = client.request('GET', f'/d/{large_id}', headers={
+            'Range': f'bytes={start}-{start + RANGE_LENGTH - 1}'})
+        return status == 206 and received == min(RANGE_LENGTH, largest - start)
+    record(run_scenario('download_range', download_range, base, args.concurrency,
+                        payload_bytes=RANGE_LENGTH))
+
+    password_body = f'password={SHARE_PASSWORD}'.encode()
+
+    def download_password(i):
+        status, received, response = client.request('POST', f'/d/{seeded["protected"]}', password_body, {
+            'Content-Type': 'application/x-www-form-urlencoded'})
+        return status == 200 and (response.getheader('Content-Disposition') or '').startswith('attachment')
+    record(run_scenario('download_password', download_password, base // 4, args.concurrency))
+
+    def login(i):
+        body = f'username={seeded["user"]}&password={PASSWORD}'.encode()
+        status, _, _ = client.request('POST', '/login', body, {
+            'Content-Type': 'application/x-www-form-urlencoded'})
+        return status == 302
+    record(run_scenario('login', login, base // 4, args.concurrency))
+
+    owner_cookie = client.login(seeded['owner'])
+
+    def dashboard(i):
+        status, _, _ = client.request('GET', '/dashboard', headers={'Cookie': owner_cookie})
+        return status == 200
+    record(run_scenario('dashboard', dashboard, base, args.concurrency))
+    return results
+
+
+# --- per-database child process --------------------------------------------
+
+def child(args):
+    workdir = tempfile.mkdtemp(prefix='sfv-load-')
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    rng = random.Random(args.seed)
+    run_id = uuid.uuid4().hex[:8]
+
+    seeded = seed(workdir, run_id, args.shares, args.download_sizes, rng)
+    port = free_port()
+    stop = start_server('gunicorn', port, args.workers)
+    try:
+        results = run_scenarios(port, seeded, args, workdir, rng)
+    finally:
+        stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps({'results': results}))
+
+
+def postgres_url(workdir):
+    """(url, stop) for BENCH_POSTGRES_URL or a throwaway local cluster"""
+    url = os.environ.get('BENCH_POSTGRES_URL')
+    if url:
+        return url, lambda: None
+    initdb, pg_ctl = shutil.which('initdb'), shutil.which('pg_ctl')
+    if not initdb or not pg_ctl:
+        raise RuntimeError('set BENCH_POSTGRES_URL or put initdb and pg_ctl on PATH')
+    datadir = os.path.join(workdir, 'pgdata')
+    port = free_port()
+    subprocess.run([initdb, '-D', datadir, '-U', 'bench', '--auth=trust', '-E', 'UTF8'],
+                   check=True, capture_output=True)
+    subprocess.run([pg_ctl, '-D', datadir, '-l', os.path.join(workdir, 'postgres.log'), '-w',
+                    '-o', f'-p {port} -k {workdir} -c listen_addresses=127.0.0.1', 'start'],
+                   check=True, capture_output=True)
+    stop = lambda: subprocess.run([pg_ctl, '-D', datadir, '-m', 'fast', 'stop'], capture_output=True)
+    return f'postgresql://bench@127.0.0.1:{port}/postgres', stop
+
+
+def run_database(database, args):
+    workdir = tempfile.mkdtemp(prefix='sfv-db-')
+    env = dict(os.environ, LOG_LEVEL='WARNING', METRICS_ENABLED='',
+               VERIFY_RATE_PER_IP='1000000/second', VERIFY_RATE_PER_TARGET='1000000/second',
+               UPLOAD_RATE_PER_USER='1000000/second')
+    stop = lambda: None
+    try:
+        if database == 'sqlite':
+            env['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+        else:
+            try:
+                if importlib.util.find_spec('psycopg2') is None:
+                    raise ImportError('psycopg2 is not installed')
+                env['DATABASE_URL'], stop = postgres_url(workdir)
+            except (ImportError, RuntimeError, subprocess.CalledProcessError) as e:
+                return {'skipped': str(e) or type(e).__name__}
+        command = [sys.executable, os.path.abspath(__file__), '--child', '--seed', str(args.seed),
+                   '--workers', str(args.workers), '--concurrency', str(args.concurrency),
+                   '--shares', str(args.shares),
+                   '--upload-sizes', *map(str, args.upload_sizes),
+                   '--download-sizes', *map(str, args.download_sizes)]
+        if args.quick:
+            command.append('--quick')
+        output = subprocess.run(command, env=env, stdout=subprocess.PIPE, text=True, check=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+    finally:
+        stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', nargs='+', choices=['sqlite', 'postgres'], default=['sqlite', 'postgres'])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--shares', type=int, default=10000)
+    parser.add_argument('--upload-sizes', type=int, nargs='+', default=UPLOAD_SIZES)
+    parser.add_argument('--download-sizes', type=int, nargs='+', default=DOWNLOAD_SIZES)
+    parser.add_argument('--quick', action='store_true', help=f'cap sizes at {QUICK_MAX_SIZE} bytes and run fewer requests')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report here as well as to stdout')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.quick:
+        args.upload_sizes = sorted({min(size, QUICK_MAX_SIZE) for size in args.upload_sizes})
+        args.download_sizes = sorted({min(size, QUICK_MAX_SIZE) for size in args.download_sizes})
+    if args.child:
+        return child(args)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'workers': args.workers,
+            'concurrency': args.concurrency,
+            'shares': args.shares,
+            'quick': args.quick,
+            'seed': args.seed,
+        },
+        'databases': {},
+    }
+    for database in args.database:
+        print(f'{database}:', file=sys.stderr)
+        report['databases'][database] = run_database(database, args)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
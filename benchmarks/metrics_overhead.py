@@ -0,0 +1,102 @@
+"""Measure what logging and metrics instrumentation cost per request
+
+Usage:
+    python benchmarks/metrics_overhead.py [--requests 1000]
+
+Each configuration runs in a fresh process against its own SQLite
+database, calling the WSGI app in-process (no sockets) so the numbers
+show the framework-side cost only: the dashboard (several queries) and a
+small file download. Configurations:
+
+    debug-log     LOG_LEVEL=DEBUG, the old default
+    baseline      LOG_LEVEL=INFO, metrics disabled
+    metrics       metrics enabled, every request sampled
+    metrics-10%   metrics enabled, METRICS_SAMPLE_RATE=0.1
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUNDS = 5
+
+CONFIGS = {
+    'debug-log': {'LOG_LEVEL': 'DEBUG'},
+    'baseline': {'LOG_LEVEL': 'INFO'},
+    'metrics': {'LOG_LEVEL': 'INFO', 'METRICS_ENABLED': '1'},
+    'metrics-10%': {'LOG_LEVEL': 'INFO', 'METRICS_ENABLED': '1', 'METRICS_SAMPLE_RATE': '0.1'},
+}
+
+
+def child(requests):
+    import io
+    import logging
+
+    sys.path.insert(0, REPO_ROOT)
+    os.chdir(tempfile.mkdtemp(prefix='sfv-bench-'))
+    from app import db
+    from main import app
+    from migrations import migrate
+    from models import User
+
+    with app.app_context():
+        migrate()
+        user = User(username='bench', email='bench@example.com')
+        user.set_password('bench-password')
+        db.session.add(user)
+        db.session.commit()
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench-password'})
+    client.post('/upload', data={'file': (io.BytesIO(b'x' * 4096), 'bench.txt')})
+    with client.session_transaction() as session:
+        message = [m for _, m in session.get('_flashes', []) if 'Share URL' in m][-1]
+    file_id = message.rsplit('/', 1)[1]
+    # Route the debug-level output somewhere cheap but still formatted
+    for handler in logging.getLogger().handlers:
+        handler.stream = open(os.devnull, 'w')
+
+    results = {}
+    for name, path in (('dashboard', '/dashboard'), ('download', f'/d/{file_id}')):
+        for _ in range(50):
+            client.get(path).close()
+        # Best of several rounds, as timeit does, to keep scheduler noise out
+        rounds = []
+        for _ in range(ROUNDS):
+            started = time.perf_counter()
+            for _ in range(requests):
+                response = client.get(path)
+                response.get_data()
+                response.close()
+            rounds.append(time.perf_counter() - started)
+        elapsed = min(rounds)
+        results[name] = {'requests_per_s': round(requests / elapsed, 1),
+                         'us_per_request': round(elapsed / requests * 1e6, 1)}
+    print(json.dumps(results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.requests)
+
+    report = {'requests': args.requests, 'results': {}}
+    for name, env in CONFIGS.items():
+        workdir = tempfile.mkdtemp(prefix='sfv-bench-')
+        env = {**os.environ, **env, 'DATABASE_URL': 'sqlite:///' + os.path.join(workdir, 'bench.db')}
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child',
+                                 '--requests', str(args.requests)],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        report['results'][name] = json.loads(output.strip().splitlines()[-1])
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Measure password verifications per second per core for each parameter set
+
+Usage:
+    python benchmarks/password_hashing.py [--seconds 2] [--method METHOD ...]
+
+Each method is a PASSWORD_HASH_METHOD value. Verification runs on a
+single thread, so the figure is per core; multiply by
+PASSWORD_VERIFY_WORKERS for the per-process ceiling.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+DEFAULT_METHODS = [
+    'scrypt:32768:8:1',
+    'scrypt:16384:8:1',
+    'pbkdf2:sha256:1000000',
+    'pbkdf2:sha256:600000',
+    'argon2:3:65536:4',
+    'argon2:2:19456:1',
+]
+
+
+def bench_method(method, seconds):
+    from passwords import hash_password, _check
+
+    try:
+        pwhash = hash_password('correct horse battery staple', method=method)
+    except ImportError as e:
+        return {'method': method, 'skipped': str(e)}
+
+    verifications = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline or verifications < 3:
+        assert _check(pwhash, 'correct horse battery staple')
+        verifications += 1
+    elapsed = time.perf_counter() - started
+    return {
+        'method': method,
+        'verifications': verifications,
+        'verifications_per_s_per_core': round(verifications / elapsed, 2),
+        'ms_per_verification': round(1000 * elapsed / verifications, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--method', action='append', dest='methods')
+    args = parser.parse_args()
+
+    from flask import Flask
+    app = Flask(__name__)
+    app.config['PASSWORD_HASH_METHOD'] = 'scrypt'
+    with app.app_context():
+        results = [bench_method(m, args.seconds) for m in (args.methods or DEFAULT_METHODS)]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Measure what preview generation adds to an upload and how fast workers drain the queue
+
+Usage:
+    python benchmarks/previews.py [--uploads 300] [--jobs 200] [--workers 2]
+
+Part one times POST /upload of a 64 KB text file with PREVIEWS_ENABLED
+off and on: with previews on, the request only adds a row to the SQLite
+job queue, so the two should be within noise of each other. Part two
+queues --jobs text files and, when Pillow is installed, as many 1600x900
+PNG images, and times previews.PreviewWorker draining them with a pool of
+--workers processes, in previews per second.
+
+All against SQLite and local storage in a temporary directory; upload
+times are the best of ROUNDS runs.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+ROUNDS = 5
+
+
+def text_payload(i):
+    return (b'bench upload %d, a line of text to fill the file\n' % i) * 1300
+
+
+def login(app):
+    from app import db
+    from models import User
+
+    with app.app_context():
+        user = User(username='bench', email='bench@example.com')
+        user.set_password('bench-password')
+        db.session.add(user)
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench-password'})
+    return client
+
+
+def uploads(app, client, count):
+    counter = iter(range(10 ** 9))
+    report = {}
+    for enabled in (False, True):
+        app.config['PREVIEWS_ENABLED'] = enabled
+        app.extensions.pop('preview_queue', None)
+        best = None
+        for _ in range(ROUNDS):
+            elapsed = 0.0
+            for _ in range(count):
+                payload = text_payload(next(counter))
+                started = time.perf_counter()
+                client.post('/upload', data={'file': (io.BytesIO(payload), 'bench.txt')}).close()
+                elapsed += time.perf_counter() - started
+                # Keep the success messages from piling up in the session cookie
+                with client.session_transaction() as session:
+                    session.pop('_flashes', None)
+            best = elapsed if best is None else min(best, elapsed)
+        report['previews_on_ms' if enabled else 'previews_off_ms'] = round(best / count * 1000, 3)
+    return report
+
+
+def queue_put_us(app, count):
+    from previews import PreviewQueue
+
+    queue = PreviewQueue(os.path.join(tempfile.mkdtemp(prefix='sfv-bench-'), 'queue.sqlite'))
+    best = None
+    for r in range(ROUNDS):
+        started = time.perf_counter()
+        for i in range(count):
+            queue.put([(f'{r:08x}{i:056x}', 'text/plain')])
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best / count * 1e6, 1)
+
+
+def draining(app, client, jobs, workers):
+    from previews import PreviewWorker, get_preview_queue
+
+    app.config['PREVIEWS_ENABLED'] = True
+    app.extensions.pop('preview_queue', None)
+    with app.app_context():
+        queue = get_preview_queue()
+        # Drop the jobs queued by the upload timings
+        queue._connection().execute('DELETE FROM preview_jobs')
+
+    batches = {'text': [(text_payload(10 ** 8 + i), f'bench{i}.txt') for i in range(jobs)]}
+    try:
+        from PIL import Image
+
+        images = []
+        for i in range(jobs):
+            buffer = io.BytesIO()
+            Image.new('RGB', (1600, 900), (i % 256, 80, 160)).save(buffer, 'PNG')
+            images.append((buffer.getvalue(), f'bench{i}.png'))
+        batches['image'] = images
+    except ImportError:
+        batches['image'] = None
+
+    report = {}
+    for kind, files in batches.items():
+        if files is None:
+            report[kind] = 'skipped: Pillow is not installed'
+            continue
+        for payload, name in files:
+            client.post('/upload', data={'file': (io.BytesIO(payload), name)}).close()
+            with client.session_transaction() as session:
+                session.pop('_flashes', None)
+        with app.app_context():
+            worker = PreviewWorker(app, get_preview_queue(), workers)
+            # Start the pool before timing, as a long-running worker would have
+            worker._get_pool().submit(int).result()
+            started = time.perf_counter()
+            worker.run(until_idle=True)
+            elapsed = time.perf_counter() - started
+            worker.close()
+        report[kind] = {'previews': len(files), 'previews_per_s': round(len(files) / elapsed, 1)}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--uploads', type=int, default=300)
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sfv-bench-')
+    os.chdir(workdir)
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.db'))
+    os.environ.setdefault('PREVIEW_QUEUE_PATH', os.path.join(workdir, 'preview-queue.sqlite'))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    from main import app
+    from migrations import migrate
+
+    with app.app_context():
+        migrate()
+    # No per-user upload limit while timing
+    app.config['RATE_LIMITS']['upload_per_user'] = '1000000/second'
+    client = login(app)
+    report = {
+        'upload_request': uploads(app, client, args.uploads),
+        'queue_put_us': queue_put_us(app, args.uploads),
+        'worker': draining(app, client, args.jobs, args.workers),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Measure what a rate-limit decision costs and what it saves against link enumeration
+
+Usage:
+    python benchmarks/rate_limiter.py [--decisions 200000] [--probes 2000]
+
+Part one times allow() and exhausted() per call for the in-process token
+buckets and for the sliding-window limiter on the fake shared store
+(RATE_LIMIT_URL=fake://; a real Redis adds one network round trip).
+Part two replays an enumeration scan, GET /d/<random id> from one IP,
+against the WSGI app in-process: once with the missing-ID limit out of
+the way and once with it tripped, reporting the time and SQL statements
+per probe.
+"""
+import argparse
+import json
+import os
+import secrets
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+ROUNDS = 5
+
+
+def time_calls(fn, count):
+    """Best-of-rounds microseconds per call"""
+    best = None
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        for i in range(count):
+            fn(i)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best / count * 1e6, 3)
+
+
+def decisions(app, count):
+    from cache import FakeSharedCache
+    from ratelimit import SlidingWindowLimiter, TokenBucketLimiter
+
+    keys = [f'203.0.113.{i % 250}' for i in range(1000)]
+    bucket = TokenBucketLimiter(1000000, 60)
+    window = SlidingWindowLimiter(FakeSharedCache(), 'bench', 1000000, 60)
+    with app.app_context():
+        return {
+            'token_bucket_allow_us': time_calls(lambda i: bucket.allow(keys[i % 1000]), count),
+            'token_bucket_exhausted_us': time_calls(lambda i: bucket.exhausted(keys[i % 1000]), count),
+            'token_bucket_reserve_us': time_calls(lambda i: bucket.reserve(keys[i % 1000], 65536), count),
+            'sliding_window_fake_allow_us': time_calls(lambda i: window.allow(keys[i % 1000]), count // 10),
+            'sliding_window_fake_exhausted_us': time_calls(lambda i: window.exhausted(keys[i % 1000]), count // 10),
+        }
+
+
+def enumeration(app, probes):
+    from sqlalchemy import event
+
+    from app import db
+
+    statements = []
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(1))
+    client = app.test_client()
+
+    def scan(limit):
+        app.config['RATE_LIMITS']['missing_per_ip'] = limit
+        app.extensions.pop('rate_limiters', None)
+        if limit.startswith('1/'):
+            client.get('/d/tripwire0000')
+        statements.clear()
+        ids = [secrets.token_urlsafe(9) for _ in range(probes)]
+        started = time.perf_counter()
+        codes = set()
+        for file_id in ids:
+            response = client.get(f'/d/{file_id}')
+            codes.add(response.status_code)
+            response.close()
+        elapsed = time.perf_counter() - started
+        return {'status_codes': sorted(codes), 'us_per_probe': round(elapsed / probes * 1e6, 1),
+                'sql_per_probe': round(len(statements) / probes, 2)}
+
+    return {'unlimited': scan('1000000000/minute'), 'limited': scan('1/hour')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--decisions', type=int, default=200000)
+    parser.add_argument('--probes', type=int, default=2000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sfv-bench-')
+    os.chdir(workdir)
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.db'))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    from main import app
+    from migrations import migrate
+
+    with app.app_context():
+        migrate()
+
+    report = {
+        'decisions': decisions(app, args.decisions),
+        'enumeration': enumeration(app, args.probes),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Count the SQL queries the dashboard and an upload make per request, with and without the user cache
+
+Usage:
+    python benchmarks/session_auth.py [--requests 300] [--shares 50]
+
+The caller's identity comes from the signed session cookie and the user
+record from identity.UserCache. With USER_CACHE_TTL=0 every request loads
+the user again, which is what the dashboard and profile pages used to do
+through User.query.get. For GET /dashboard (with --shares shares) and
+POST /upload of a 4 KB text file, reports the SQL statements per request,
+how many of them read the users table, and the time per request.
+
+All against SQLite and local storage in a temporary directory, calling
+the WSGI app in-process; times are the best of ROUNDS runs.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+ROUNDS = 5
+
+
+class QueryCounter:
+    """Counts statements sent to the database, and those reading the users table"""
+
+    def __init__(self):
+        self.queries = 0
+        self.user_queries = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.queries += 1
+        if 'FROM users' in statement:
+            self.user_queries += 1
+
+
+def login(app):
+    from app import db
+    from models import User
+
+    with app.app_context():
+        user = User(username='bench', email='bench@example.com')
+        user.set_password('bench-password')
+        db.session.add(user)
+        db.session.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'bench', 'password': 'bench-password'})
+    return client
+
+
+def upload(client, i):
+    payload = (b'bench upload %d, a line of text to fill the file\n' % i) * 80
+    client.post('/upload', data={'file': (io.BytesIO(payload), 'bench.txt')}).close()
+    # Keep the success messages from piling up in the session cookie
+    with client.session_transaction() as session:
+        session.pop('_flashes', None)
+
+
+def measure(app, counter, request, count):
+    best = None
+    for _ in range(ROUNDS):
+        counter.queries = counter.user_queries = 0
+        started = time.perf_counter()
+        for _ in range(count):
+            request()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        'queries_per_request': round(counter.queries / count, 2),
+        'user_queries_per_request': round(counter.user_queries / count, 2),
+        'ms_per_request': round(best / count * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--shares', type=int, default=50)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sfv-bench-')
+    os.chdir(workdir)
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.db'))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    from sqlalchemy import event
+
+    from app import db
+    from main import app
+    from migrations import migrate
+
+    with app.app_context():
+        migrate()
+        counter = QueryCounter()
+        event.listen(db.engine, 'before_cursor_execute', counter)
+    # Nothing but the request itself: no rate limit, preview queue or access log
+    app.config['RATE_LIMITS']['upload_per_user'] = '1000000/second'
+    app.config['PREVIEWS_ENABLED'] = False
+    app.config['ANALYTICS_ENABLED'] = False
+    client = login(app)
+    for i in range(args.shares):
+        upload(client, i)
+
+    uploads = iter(range(args.shares, 10 ** 9))
+    report = {}
+    for label, ttl in (('user_cache_off', 0), ('user_cache_on', 60)):
+        app.config['USER_CACHE_TTL'] = ttl
+        app.extensions.pop('user_cache', None)
+        # One request to fill the cache, as any earlier request would have
+        client.get('/dashboard').close()
+        report[label] = {
+            'dashboard': measure(app, counter, lambda: client.get('/dashboard').close(), args.requests),
+            'upload': measure(app, counter, lambda: upload(client, next(uploads)), args.requests),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
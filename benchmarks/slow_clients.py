@@ -0,0 +1,141 @@
+"""Compare how sync workers and the ASGI entry point cope with slow downloaders
+
+Usage:
+    python benchmarks/slow_clients.py [--slow-clients 32] [--size 33554432]
+        [--workers 4] [--duration 10] [--server gunicorn|uvicorn|both]
+
+Opens ``--slow-clients`` connections that download a large file while
+reading only a trickle per second, then measures the latency of quick
+probe requests issued at the same time. Under gunicorn sync workers each
+slow reader holds a worker, so probes queue or time out once the slow
+clients outnumber the workers; under ``uvicorn asgi:app`` they should not.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from download_limit_race import REPO_ROOT, free_port, seed_share, wait_for_port
+
+
+def start_server(kind, port, workers):
+    if kind == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}',
+                   '--workers', str(workers), '--timeout', '120', '--log-level', 'warning', 'main:app']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port),
+                   '--workers', str(workers), '--log-level', 'warning']
+    proc = subprocess.Popen(command, env={**os.environ, 'PYTHONPATH': REPO_ROOT})
+    wait_for_port(port)
+    return proc
+
+
+def slow_reader(port, path, stop, read_rate, received):
+    """Download path but read only read_rate bytes per second"""
+    sock = socket.socket()
+    # A tiny receive window makes the server feel the slow reader at once
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    try:
+        sock.connect(('127.0.0.1', port))
+        sock.sendall(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n'.encode())
+        sock.settimeout(1)
+        while not stop.is_set():
+            try:
+                chunk = sock.recv(read_rate // 10)
+            except socket.timeout:
+                continue
+            if not chunk:
+                break
+            received.append(len(chunk))
+            time.sleep(0.1)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+def probe(url, timeout):
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+    except Exception:
+        return None
+    return time.perf_counter() - started
+
+
+def run(kind, args, file_id, probe_path):
+    port = free_port()
+    proc = start_server(kind, port, args.workers)
+    stop = threading.Event()
+    received = []
+    readers = [threading.Thread(target=slow_reader, args=(port, f'/d/{file_id}', stop, args.read_rate, received),
+                                daemon=True)
+               for _ in range(args.slow_clients)]
+    try:
+        for reader in readers:
+            reader.start()
+        time.sleep(1)
+
+        latencies = []
+        timeouts = 0
+        deadline = time.time() + args.duration
+        while time.time() < deadline:
+            latency = probe(f'http://127.0.0.1:{port}{probe_path}', args.probe_timeout)
+            if latency is None:
+                timeouts += 1
+            else:
+                latencies.append(latency)
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        for reader in readers:
+            reader.join(timeout=2)
+        proc.terminate()
+        proc.wait()
+
+    latencies.sort()
+    return {
+        'server': kind,
+        'workers': args.workers,
+        'slow_clients': args.slow_clients,
+        'probes_ok': len(latencies),
+        'probes_timed_out': timeouts,
+        'probe_p50_ms': round(statistics.median(latencies) * 1000, 1) if latencies else None,
+        'probe_p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1) if latencies else None,
+        'slow_bytes_received': sum(received),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--slow-clients', type=int, default=32)
+    parser.add_argument('--size', type=int, default=32 * 1024 * 1024)
+    parser.add_argument('--read-rate', type=int, default=64 * 1024, help='Bytes per second per slow client.')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--probe-timeout', type=float, default=5)
+    parser.add_argument('--server', choices=['gunicorn', 'uvicorn', 'both'], default='both')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sfv-bench-')
+    os.chdir(workdir)
+    os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.db'))
+    sys.path.insert(0, REPO_ROOT)
+
+    file_id = seed_share(os.urandom(args.size), None)
+    probe_path = '/login'
+
+    kinds = ['gunicorn', 'uvicorn'] if args.server == 'both' else [args.server]
+    print(json.dumps([run(kind, args, file_id, probe_path) for kind in kinds], indent=2))
+
+
+if __name__ == '__main__':
+    main()
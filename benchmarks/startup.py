@@ -0,0 +1,157 @@
+"""Measure how long the app takes to start and to serve its first request
+
+Usage:
+    python benchmarks/startup.py [--workers 2] [--no-gunicorn]
+
+Cold start (serverless): each round is a fresh interpreter timing
+`import app` (Flask, SQLAlchemy and ``db``), `import main` (create_app:
+blueprints, models, extensions, pool pre-warm) and the first and second
+GET /d/<missing id>, which go to the database. It runs with
+DB_POOL_PREWARM=0 and 1; `process_ms` is spawn to exit as seen from
+outside.
+
+Preload fork: the app is built once, then each round forks a child that
+serves one request, as gunicorn --preload workers do. Reports the fork()
+call itself and the child's first request.
+
+Gunicorn: spawn to first 200 on / with --workers, with and without
+--preload. Skipped when gunicorn is not installed.
+
+Every figure is the best of ROUNDS runs, in milliseconds, against a
+SQLite database created with `flask --app main migrate`.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUNDS = 5
+MISSING_PATH = '/d/doesnotexist0'
+
+
+def ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+def best(runs):
+    return {key: min(run[key] for run in runs) for key in runs[0]}
+
+
+def cold_child():
+    started = time.perf_counter()
+    sys.path.insert(0, REPO_ROOT)
+    importlib.import_module('app')
+    imported = time.perf_counter()
+    from main import app
+    created = time.perf_counter()
+    client = app.test_client()
+    client.get(MISSING_PATH).close()
+    first = time.perf_counter()
+    client.get(MISSING_PATH).close()
+    second = time.perf_counter()
+    print(json.dumps({'import_app_ms': ms(imported - started), 'create_app_ms': ms(created - imported),
+                      'first_request_ms': ms(first - created), 'second_request_ms': ms(second - first),
+                      'in_process_ms': ms(first - started)}))
+
+
+def fork_child():
+    sys.path.insert(0, REPO_ROOT)
+    from main import app
+    app.test_client().get(MISSING_PATH).close()
+    runs = []
+    for _ in range(ROUNDS):
+        read_end, write_end = os.pipe()
+        started = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            forked = time.perf_counter()
+            app.test_client().get(MISSING_PATH).close()
+            os.write(write_end, str(time.perf_counter() - forked).encode())
+            os._exit(0)
+        fork_call = time.perf_counter() - started
+        os.close(write_end)
+        with os.fdopen(read_end) as f:
+            first_request = float(f.read())
+        os.waitpid(pid, 0)
+        runs.append({'fork_ms': ms(fork_call), 'child_first_request_ms': ms(first_request)})
+    print(json.dumps(best(runs)))
+
+
+def run_child(mode, env):
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', mode],
+                            env=env, capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    if mode == 'cold':
+        result['process_ms'] = ms(time.perf_counter() - started)
+    return result
+
+
+def gunicorn_ready(env, workers, preload):
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+               '--log-level', 'warning', 'main:app']
+    if preload:
+        command.insert(3, '--preload')
+    started = time.perf_counter()
+    proc = subprocess.Popen(command, env=env, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < 30:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1) as response:
+                    if response.status == 200:
+                        return ms(time.perf_counter() - started)
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError('gunicorn did not start')
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--no-gunicorn', action='store_true')
+    parser.add_argument('--child', choices=['cold', 'fork'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child == 'cold':
+        return cold_child()
+    if args.child == 'fork':
+        return fork_child()
+
+    workdir = tempfile.mkdtemp(prefix='sfv-bench-')
+    os.chdir(workdir)
+    env = {**os.environ, 'PYTHONPATH': REPO_ROOT, 'LOG_LEVEL': 'WARNING',
+           'DATABASE_URL': 'sqlite:///' + os.path.join(workdir, 'bench.db'),
+           'MISSING_RATE_PER_IP': '1000000/second'}
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'main', 'migrate'],
+                   env=env, capture_output=True, check=True)
+
+    report = {'cold_start': {}}
+    for prewarm in ('0', '1'):
+        runs = [run_child('cold', {**env, 'DB_POOL_PREWARM': prewarm}) for _ in range(ROUNDS)]
+        report['cold_start'][f'prewarm={prewarm}'] = best(runs)
+    report['preload_fork'] = run_child('fork', env)
+    if args.no_gunicorn or importlib.util.find_spec('gunicorn') is None:
+        report['gunicorn'] = 'skipped'
+    else:
+        report['gunicorn'] = {
+            f'workers={args.workers}': min(gunicorn_ready(env, args.workers, False) for _ in range(ROUNDS)),
+            f'workers={args.workers} --preload': min(gunicorn_ready(env, args.workers, True)
+                                                     for _ in range(ROUNDS)),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
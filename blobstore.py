@@ -0,0 +1,283 @@
+import hashlib
+import os
+import secrets
+import shutil
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from models import Blob, FileShare, Preview
+from cache import invalidate_share
+from storage import get_storage
+from streaming import hash_file_prefix
+from compression import compress_staged_file
+from encryption import encrypt_staged_file
+
+STAGING_DIR = '.staging'
+
+
+def sharded_key(name):
+    """Place an object name under two levels of directories taken from its leading hex digits
+
+    65536 shards keep every directory small enough for fast lookups at
+    millions of files, and spread S3 keys across prefixes.
+    """
+    return f'{name[:2]}/{name[2:4]}/{name}'
+
+
+def blob_key(sha256):
+    """New storage key for a blob with this SHA-256 hex digest
+
+    The random suffix keeps two workers storing the same content at once
+    from overwriting each other's object, which matters once objects are
+    encrypted under different data keys. The key is recorded on the row,
+    so blobs stored under the older flat layout stay readable.
+    """
+    return sharded_key(f'{sha256}.{secrets.token_hex(4)}')
+
+
+def new_staging_path():
+    """Reserve a temporary local path for an upload in progress
+
+    Uploads are written here first and handed to the storage backend once
+    their hash is known. With local storage the staging folder sits on the
+    same filesystem, so committing a new blob is a rename.
+    """
+    staging_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], STAGING_DIR)
+    os.makedirs(staging_folder, exist_ok=True)
+    return os.path.join(staging_folder, secrets.token_hex(16))
+
+
+def acquire_blob(sha256, size=None, count=1):
+    """Add ``count`` references to an existing blob
+
+    Returns True if the blob exists (and matches ``size`` when given).
+    The change joins the current transaction; the caller commits.
+    """
+    stmt = db.update(Blob).where(Blob.sha256 == sha256)
+    if size is not None:
+        stmt = stmt.where(Blob.size == size)
+    result = db.session.execute(stmt.values(ref_count=Blob.ref_count + count))
+    return result.rowcount == 1
+
+
+def store_staged_file(staging_path, sha256, size, filename=None, put_keys=None):
+    """Move a fully written staging file into the blob store
+
+    If identical content is already stored, the staging file is discarded
+    and the existing blob gains a reference instead. New content is
+    compressed (when it pays off for its type, judged by ``filename``)
+    and then encrypted before it is handed to the storage backend.
+
+    The staging file is gone once this returns, but the Blob row is only
+    added to the transaction. The key of an object uploaded here is
+    appended to ``put_keys``, for discard_put_keys should the caller's
+    commit fail.
+    """
+    if acquire_blob(sha256):
+        os.remove(staging_path)
+        return sha256
+
+    row = _encode_and_put(staging_path, sha256, size, filename, put_keys)
+    _insert_blob_rows([row], Counter({sha256: 1}))
+    return sha256
+
+
+def _encode_and_put(staging_path, sha256, size, filename, put_keys=None):
+    """Compress, encrypt and upload one staging file; returns its Blob row values"""
+    key = blob_key(sha256)
+    encoding, stored_size = compress_staged_file(staging_path, filename, size)
+    wrapped_key = encrypt_staged_file(staging_path, stored_size)
+    if put_keys is not None:
+        put_keys.append(key)
+    get_storage().put_file(key, staging_path)
+    return {'sha256': sha256, 'storage_key': key, 'wrapped_key': wrapped_key,
+            'encoding': encoding, 'stored_size': stored_size, 'size': size}
+
+
+def _insert_blob_rows(rows, counts):
+    """Insert new Blob rows with their reference counts in one statement
+
+    Content stored concurrently by another worker makes the bulk insert
+    fail; those rows are retried one by one and share the existing blob
+    instead, and the object uploaded here is deleted again.
+    """
+    for row in rows:
+        row['ref_count'] = counts[row['sha256']]
+    try:
+        with db.session.begin_nested():
+            db.session.execute(db.insert(Blob), rows)
+        return
+    except IntegrityError:
+        pass
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(db.insert(Blob), [row])
+        except IntegrityError:
+            if not acquire_blob(row['sha256'], count=row['ref_count']):
+                raise
+            get_storage().delete(row['storage_key'])
+
+
+def _run_in_app(app, fn, *args):
+    with app.app_context():
+        return fn(*args)
+
+
+def store_staged_files(staged, max_workers=4, put_keys=None):
+    """Store many staging files at once
+
+    ``staged`` is a list of (staging_path, sha256, size, filename). Known
+    content gains references, duplicates within the batch are stored
+    once, and new content is compressed, encrypted and uploaded on a
+    thread pool before all new Blob rows go in with a single insert.
+    Uploaded keys are appended to ``put_keys`` as in store_staged_file.
+    """
+    counts = Counter(sha256 for _, sha256, _, _ in staged)
+    known = db.session.execute(
+        db.select(Blob.sha256).where(Blob.sha256.in_(list(counts)))
+    ).scalars().all()
+    acquired = {sha256 for sha256 in known if acquire_blob(sha256, count=counts[sha256])}
+
+    new = {}
+    for staging_path, sha256, size, filename in staged:
+        if sha256 in acquired or sha256 in new:
+            os.remove(staging_path)
+        else:
+            new[sha256] = (staging_path, sha256, size, filename)
+
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        rows = list(pool.map(lambda item: _run_in_app(app, _encode_and_put, *item, put_keys), new.values()))
+    if rows:
+        _insert_blob_rows(rows, counts)
+
+
+def compression_ratios(sha256s):
+    """Original size over stored size per blob (1.0 when stored uncompressed)"""
+    rows = db.session.execute(
+        db.select(Blob.sha256, Blob.size, Blob.stored_size).where(Blob.sha256.in_(list(sha256s)))
+    ).all()
+    return {sha256: round(size / stored_size, 3) for sha256, size, stored_size in rows if stored_size}
+
+
+def compression_ratio(sha256):
+    return compression_ratios([sha256]).get(sha256)
+
+
+def release_blobs(counts):
+    """Drop references to several blobs, deleting rows that reach zero
+
+    ``counts`` maps SHA-256 digests to the number of references to drop.
+    Returns (keys, bytes) for the blobs garbage-collected in this
+    transaction, their previews' keys included; remove the objects with
+    remove_blob after committing.
+    """
+    for sha256, count in counts.items():
+        db.session.execute(
+            db.update(Blob).where(Blob.sha256 == sha256).values(ref_count=Blob.ref_count - count)
+        )
+    preview_keys = db.session.execute(
+        db.delete(Preview)
+        .where(Preview.sha256.in_(
+            db.select(Blob.sha256).where(Blob.sha256.in_(list(counts)), Blob.ref_count <= 0)))
+        .returning(Preview.storage_key)
+    ).scalars().all()
+    deleted = db.session.execute(
+        db.delete(Blob)
+        .where(Blob.sha256.in_(list(counts)), Blob.ref_count <= 0)
+        .returning(Blob.storage_key, Blob.size)
+    ).all()
+    return [key for key, _ in deleted] + preview_keys, sum(size for _, size in deleted)
+
+
+def release_blob(sha256):
+    """Drop a reference and delete the blob row once nothing points at it
+
+    Returns the keys of the objects to remove after the caller commits
+    (the blob's and its preview's), empty if the blob is still referenced.
+    """
+    keys, _ = release_blobs({sha256: 1})
+    return keys
+
+
+def remove_blob(key):
+    """Remove a garbage-collected blob from storage unless it was re-uploaded"""
+    if not key:
+        return
+    if db.session.execute(db.select(Blob.sha256).where(Blob.storage_key == key)).first() is not None:
+        return
+    get_storage().delete(key)
+
+
+def discard_put_keys(put_keys):
+    """Delete objects uploaded in a transaction that was rolled back
+
+    Call after the rollback. A key that a committed Blob row names is kept.
+    """
+    for key in put_keys:
+        try:
+            remove_blob(key)
+        except Exception as e:
+            current_app.logger.warning(f"Could not remove stored object {key}: {str(e)}")
+
+
+def has_legacy_file_paths():
+    """Whether file_shares still has the file_path column of uploads made before blob storage"""
+    return 'file_path' in {column['name'] for column in inspect(db.engine).get_columns('file_shares')}
+
+
+def adopt_legacy_files(batch_size=100):
+    """Store files uploaded before content-addressed storage as blobs; returns (adopted, missing)
+
+    Shares from then have a file_path (UPLOAD_FOLDER/<secure name>, relative
+    to the app's working directory) and no sha256. Each file is hashed,
+    copied to staging and stored like a new upload, or gains a reference
+    on an identical blob; the share is pointed at the blob, and the old
+    file is removed once that has committed. Shares whose file is gone
+    are left as they are and counted as missing.
+    """
+    if not has_legacy_file_paths():
+        return 0, 0
+    adopted = missing = 0
+    after = 0
+    while True:
+        rows = db.session.execute(
+            db.select(FileShare.id, FileShare.file_id, FileShare.original_filename,
+                      db.literal_column('file_shares.file_path').label('file_path'))
+            .where(FileShare.sha256.is_(None), FileShare.id > after)
+            .order_by(FileShare.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return adopted, missing
+        after = rows[-1].id
+        done = []
+        for row in rows:
+            if not row.file_path or not os.path.isfile(row.file_path):
+                current_app.logger.warning(f"Share {row.file_id} has no file at {row.file_path}; it cannot be adopted")
+                missing += 1
+                continue
+            size = os.path.getsize(row.file_path)
+            sha256 = hash_file_prefix(row.file_path, size, hashlib.sha256()).hexdigest()
+            staging_path = new_staging_path()
+            shutil.copyfile(row.file_path, staging_path)
+            store_staged_file(staging_path, sha256, size, row.original_filename)
+            db.session.execute(
+                db.update(FileShare).where(FileShare.id == row.id)
+                .values(sha256=sha256, compression_ratio=compression_ratio(sha256))
+            )
+            done.append(row)
+        db.session.commit()
+        invalidate_share(*(row.file_id for row in done))
+        for row in done:
+            try:
+                os.remove(row.file_path)
+            except FileNotFoundError:
+                pass
+        adopted += len(done)
@@ -0,0 +1,258 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask import current_app
+
+from app import db
+from models import FileShare, ShareSnapshot
+from utils import is_file_id
+
+# Stored for share IDs that do not exist, so scanners hitting random IDs
+# are answered from memory instead of the database
+MISSING = object()
+_MISSING_MARKER = {'missing': True}
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after a TTL"""
+
+    def __init__(self, maxsize=10000, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FakeSharedCache:
+    """In-process stand-in for the shared backend, used in tests and development
+
+    Values round-trip through bytes exactly like they would through Redis.
+    Covers the commands the share cache and the rate limiter use.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def mget(self, keys):
+        with self._lock:
+            return [self.get(key) for key in keys]
+
+    def setex(self, key, ttl, value):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+
+    def incrby(self, key, amount=1):
+        with self._lock:
+            value = int(self.get(key) or 0) + amount
+            expires = self._data[key][1] if key in self._data else float('inf')
+            self._data[key] = (str(value).encode('ascii'), expires)
+            return value
+
+    def expire(self, key, ttl):
+        with self._lock:
+            if self.get(key) is None:
+                return False
+            self._data[key] = (self._data[key][0], time.monotonic() + ttl)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """Queued commands run atomically on execute(), like a MULTI/EXEC pipeline"""
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self._backend, name)
+
+        def queue(*args):
+            self._commands.append((method, args))
+            return self
+        return queue
+
+    def execute(self):
+        with self._backend._lock:
+            results = [method(*args) for method, args in self._commands]
+        self._commands = []
+        return results
+
+
+def connect_shared_backend(url, setting='SHARE_CACHE_URL'):
+    """Create a shared store client for a redis:// or fake:// URL"""
+    if not url:
+        return None
+    if url.startswith('fake://'):
+        return FakeSharedCache()
+    try:
+        import redis
+    except ImportError:
+        current_app.logger.warning(f"{setting} is set but the redis package is not installed")
+        return None
+    return redis.Redis.from_url(url, socket_timeout=0.05, socket_connect_timeout=0.05)
+
+
+class ShareCache:
+    """Two-level cache of share metadata for the /d and /info hot path
+
+    Lookups hit the per-process LRU first, then the optional shared
+    backend, then the database. Unknown IDs are cached too (negatively),
+    for a shorter time. Entries are refreshed when the share expires.
+    """
+
+    key_prefix = 'share:'
+
+    def __init__(self, maxsize, ttl, negative_ttl, shared=None):
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.shared = shared
+
+    def _ttl_for(self, snapshot):
+        if snapshot is MISSING:
+            return self.negative_ttl
+        if snapshot.expires_at is None:
+            return self.ttl
+        # Refresh at the moment of expiry; once expired the snapshot only
+        # needs to live until the reaper deletes the row
+        expires_at = snapshot.expires_at
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        remaining = (expires_at - datetime.now(timezone.utc)).total_seconds()
+        if remaining <= 0:
+            return self.negative_ttl
+        return min(self.ttl, remaining)
+
+    def _shared_get(self, file_id):
+        if self.shared is None:
+            return None
+        try:
+            raw = self.shared.get(self.key_prefix + file_id)
+        except Exception as e:
+            current_app.logger.warning(f"Shared cache read failed: {str(e)}")
+            return None
+        if raw is None:
+            return None
+        data = json.loads(raw)
+        if data == _MISSING_MARKER:
+            return MISSING
+        return ShareSnapshot.from_dict(data)
+
+    def _shared_set(self, file_id, snapshot, ttl):
+        if self.shared is None:
+            return
+        data = _MISSING_MARKER if snapshot is MISSING else snapshot.to_dict()
+        try:
+            self.shared.setex(self.key_prefix + file_id, max(int(ttl), 1), json.dumps(data))
+        except Exception as e:
+            current_app.logger.warning(f"Shared cache write failed: {str(e)}")
+
+    def get(self, file_id):
+        """Return a ShareSnapshot for file_id, or None if no such share exists"""
+        snapshot = self.local.get(file_id)
+        if snapshot is None:
+            snapshot = self._shared_get(file_id)
+            if snapshot is None:
+                file_share = db.session.execute(
+                    db.select(FileShare).where(FileShare.file_id == file_id)
+                ).scalar_one_or_none()
+                snapshot = ShareSnapshot.from_share(file_share) if file_share else MISSING
+                self._shared_set(file_id, snapshot, self._ttl_for(snapshot))
+            self.local.set(file_id, snapshot, self._ttl_for(snapshot))
+        return None if snapshot is MISSING else snapshot
+
+    def invalidate(self, *file_ids):
+        """Forget cached metadata after a delete, counter change or expiry"""
+        for file_id in file_ids:
+            self.local.delete(file_id)
+        if self.shared is not None and file_ids:
+            try:
+                self.shared.delete(*[self.key_prefix + file_id for file_id in file_ids])
+            except Exception as e:
+                current_app.logger.warning(f"Shared cache invalidation failed: {str(e)}")
+
+
+def get_share_cache():
+    """Return the application's ShareCache, creating it on first use"""
+    cache = current_app.extensions.get('share_cache')
+    if cache is None:
+        config = current_app.config
+        cache = ShareCache(
+            maxsize=config['SHARE_CACHE_SIZE'],
+            ttl=config['SHARE_CACHE_TTL'],
+            negative_ttl=config['SHARE_CACHE_NEGATIVE_TTL'],
+            shared=connect_shared_backend(config['SHARE_CACHE_URL'])
+        )
+        current_app.extensions['share_cache'] = cache
+    return cache
+
+
+def get_share(file_id):
+    """Cached lookup of a share by its public ID
+
+    Strings that cannot be an ID are turned away before the cache, so
+    probing with junk fills neither the cache nor the query log.
+    """
+    if not is_file_id(file_id):
+        return None
+    return get_share_cache().get(file_id)
+
+
+def invalidate_share(*file_ids):
+    get_share_cache().invalidate(*file_ids)
@@ -0,0 +1,240 @@
+import math
+import os
+import zlib
+from collections import Counter
+
+from flask import current_app
+from werkzeug.http import parse_accept_header
+
+from storage import StorageBackend, StoredObject
+from streaming import STREAM_BLOCK_SIZE
+
+# Formats that are compressed already (including the zip-based Office formats)
+INCOMPRESSIBLE_EXTENSIONS = frozenset({
+    'zip', 'rar', '7z', 'gz', 'bz2', 'xz', 'zst',
+    'docx', 'xlsx', 'pptx',
+    'png', 'jpg', 'jpeg', 'gif', 'webp',
+    'mp3', 'mp4', 'avi', 'mov',
+})
+
+# (zstd level, gzip level) by extension. Legacy Office files compress fast
+# even at high levels; beyond 6, text costs far more CPU than it saves
+# (see benchmarks/compression_cost.py)
+LEVELS = {
+    'txt': (6, 6),
+    'doc': (9, 6),
+    'xls': (9, 6),
+    'ppt': (9, 6),
+}
+DEFAULT_LEVELS = (3, 5)
+
+# Sampled data above this many bits per byte is treated as incompressible
+ENTROPY_THRESHOLD = 7.5
+SAMPLE_SIZE = 16 * 1024
+SAMPLE_POINTS = 4
+
+# Keep the compressed copy only if it saves at least this fraction
+MIN_SAVING = 0.05
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def available_codec(codec):
+    """Resolve COMPRESSION_CODEC to a codec this process can run"""
+    if codec == 'zstd' and _zstd() is None:
+        current_app.logger.warning("COMPRESSION_CODEC is zstd but the zstandard package is not installed; using gzip")
+        return 'gzip'
+    return codec
+
+
+def shannon_entropy(data):
+    """Bits of entropy per byte of a sample"""
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+def sample_file(path, size):
+    """Read SAMPLE_POINTS evenly spaced slices of a file"""
+    if size <= SAMPLE_SIZE * SAMPLE_POINTS:
+        with open(path, 'rb') as f:
+            return f.read()
+    step = (size - SAMPLE_SIZE) // (SAMPLE_POINTS - 1)
+    parts = []
+    with open(path, 'rb') as f:
+        for i in range(SAMPLE_POINTS):
+            f.seek(i * step)
+            parts.append(f.read(SAMPLE_SIZE))
+    return b''.join(parts)
+
+
+def choose_level(codec, path, filename, size):
+    """Pick a compression level for a staged file, or None to store it raw"""
+    if size < current_app.config['COMPRESSION_MIN_SIZE']:
+        return None
+    ext = filename.rsplit('.', 1)[1].lower() if filename and '.' in filename else ''
+    if ext in INCOMPRESSIBLE_EXTENSIONS:
+        return None
+    if shannon_entropy(sample_file(path, size)) > ENTROPY_THRESHOLD:
+        return None
+    zstd_level, gzip_level = LEVELS.get(ext, DEFAULT_LEVELS)
+    return zstd_level if codec == 'zstd' else gzip_level
+
+
+def compressor(codec, level):
+    """Object with compress(chunk) and flush() producing a stream in ``codec`` format"""
+    if codec == 'zstd':
+        return _zstd().ZstdCompressor(level=level).compressobj()
+    # wbits=31 writes the gzip container, so the bytes can be sent as Content-Encoding: gzip
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+
+class _BlockReader:
+    """File-like read() over an iterator of byte blocks"""
+
+    def __init__(self, blocks):
+        self._blocks = iter(blocks)
+        self._pending = b''
+
+    def read(self, size=-1):
+        while not self._pending:
+            self._pending = next(self._blocks, None)
+            if self._pending is None:
+                self._pending = b''
+                return b''
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        return chunk
+
+
+def iter_decompressed(codec, blocks, block_size=STREAM_BLOCK_SIZE):
+    """Decompress a stream of blocks, yielding at most block_size bytes at a time
+
+    Output is bounded per step, so a tiny block of highly compressible data
+    never expands into one huge buffer.
+    """
+    if codec == 'zstd':
+        reader = _zstd().ZstdDecompressor().stream_reader(_BlockReader(blocks))
+        while True:
+            chunk = reader.read(block_size)
+            if not chunk:
+                return
+            yield chunk
+    engine = zlib.decompressobj(31)
+    for block in blocks:
+        while block:
+            chunk = engine.decompress(block, block_size)
+            if chunk:
+                yield chunk
+            block = engine.unconsumed_tail
+    # Drain output zlib still holds once all input has been consumed
+    while True:
+        chunk = engine.decompress(b'', block_size)
+        if not chunk:
+            break
+        yield chunk
+    tail = engine.flush()
+    if tail:
+        yield tail
+
+
+def compress_file(source_path, target_path, codec, level):
+    """Compress a file block by block; returns the compressed size"""
+    engine = compressor(codec, level)
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        while True:
+            chunk = source.read(STREAM_BLOCK_SIZE)
+            if not chunk:
+                break
+            target.write(engine.compress(chunk))
+        target.write(engine.flush())
+        return target.tell()
+
+
+def compress_staged_file(staging_path, filename, size):
+    """Compress a staged upload in place when COMPRESSION_CODEC is set and it pays off
+
+    Returns (encoding, stored_size); encoding is None when the file is
+    kept as it is.
+    """
+    codec = current_app.config['COMPRESSION_CODEC']
+    if not codec:
+        return None, size
+    codec = available_codec(codec)
+    level = choose_level(codec, staging_path, filename, size)
+    if level is None:
+        return None, size
+
+    compressed_path = staging_path + '.z'
+    try:
+        stored_size = compress_file(staging_path, compressed_path, codec, level)
+        if stored_size > size * (1 - MIN_SAVING):
+            os.remove(compressed_path)
+            return None, size
+        os.replace(compressed_path, staging_path)
+    except BaseException:
+        if os.path.exists(compressed_path):
+            os.remove(compressed_path)
+        raise
+    return codec, stored_size
+
+
+class DecompressingStorage(StorageBackend):
+    """Read-only view of one compressed object as its original bytes
+
+    A range starting at ``start`` decompresses and discards everything
+    before it, which is cheap for the text and document types that get
+    compressed but not free; full downloads pay nothing extra.
+    """
+
+    def __init__(self, storage, encoding, stored_size, size):
+        self.storage = storage
+        self.encoding = encoding
+        self.stored_size = stored_size
+        self.size = size
+
+    def stat(self, key):
+        stored = self.storage.stat(key)
+        return StoredObject(self.size, stored.modified)
+
+    def get_range_stream(self, key, start, stop, block_size=None):
+        if stop <= start:
+            return
+        position = 0
+        blocks = self.storage.get_range_stream(key, 0, self.stored_size)
+        for plain in iter_decompressed(self.encoding, blocks):
+            end = position + len(plain)
+            if end > start:
+                yield plain[max(start - position, 0):stop - position]
+            position = end
+            if position >= stop:
+                return
+
+
+def accepts_encoding(accept_encoding, encoding):
+    """Check an Accept-Encoding header allows the given content coding"""
+    if not accept_encoding:
+        return False
+    return parse_accept_header(accept_encoding)[encoding] > 0
+
+
+def select_representation(storage, share, accept_encoding, range_header):
+    """Choose how to serve a share's stored bytes
+
+    Returns (storage view, content encoding or None, etag). Clients that
+    accept the stored coding get the compressed bytes as they are; ranged
+    requests and other clients get the original bytes, decompressed on
+    the fly.
+    """
+    encoding = share.content_encoding
+    if not encoding:
+        return storage, None, share.sha256
+    if not range_header and accepts_encoding(accept_encoding, encoding):
+        return storage, encoding, f'{share.sha256}.{encoding}'
+    return DecompressingStorage(storage, encoding, share.stored_size, share.file_size), None, share.sha256
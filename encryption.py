@@ -0,0 +1,182 @@
+import base64
+import os
+import secrets
+import struct
+from collections import namedtuple
+
+from flask import current_app
+
+from storage import StorageBackend, StoredObject
+
+# Stored objects start with this header; every chunk's AAD repeats it
+MAGIC = b'SFVE'
+VERSION = 1
+HEADER = struct.Struct('>4sBBI')  # magic, version, cipher id, chunk size
+
+TAG_SIZE = 16
+NONCE_SIZE = 12
+
+CIPHERS = {'aes-gcm': 1, 'chacha20-poly1305': 2}
+
+# A per-blob key plus the framing it was written with
+DataKey = namedtuple('DataKey', ['key', 'cipher', 'chunk_size'])
+
+# Wrapped key layout: version, cipher id, chunk size, then nonce + sealed key
+_WRAPPED_PREFIX = struct.Struct('>BBI')
+
+
+def _aead(cipher_id, key):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+    return AESGCM(key) if cipher_id == CIPHERS['aes-gcm'] else ChaCha20Poly1305(key)
+
+
+def _master_aead():
+    """AES-GCM instance for ENCRYPTION_KEY, or None when encryption is off"""
+    aead = current_app.extensions.get('master_key')
+    if aead is None:
+        encoded = current_app.config['ENCRYPTION_KEY']
+        if not encoded:
+            return None
+        master_key = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+        if len(master_key) != 32:
+            raise ValueError("ENCRYPTION_KEY must be 32 bytes, base64url encoded")
+        aead = current_app.extensions['master_key'] = _aead(CIPHERS['aes-gcm'], master_key)
+    return aead
+
+
+def encryption_enabled():
+    return bool(current_app.config['ENCRYPTION_KEY'])
+
+
+def new_data_key():
+    """Generate a data key and return (DataKey, wrapped bytes for the database)"""
+    cipher = CIPHERS[current_app.config['ENCRYPTION_CIPHER']]
+    data_key = DataKey(secrets.token_bytes(32), cipher, current_app.config['ENCRYPTION_CHUNK_SIZE'])
+    prefix = _WRAPPED_PREFIX.pack(VERSION, data_key.cipher, data_key.chunk_size)
+    nonce = secrets.token_bytes(NONCE_SIZE)
+    # The framing parameters are authenticated with the key they describe
+    sealed = _master_aead().encrypt(nonce, data_key.key, prefix)
+    return data_key, prefix + nonce + sealed
+
+
+def unwrap_data_key(wrapped):
+    """Recover the DataKey sealed by new_data_key"""
+    prefix = wrapped[:_WRAPPED_PREFIX.size]
+    version, cipher, chunk_size = _WRAPPED_PREFIX.unpack(prefix)
+    if version != VERSION:
+        raise ValueError(f"Unsupported data key version {version}")
+    nonce = wrapped[_WRAPPED_PREFIX.size:_WRAPPED_PREFIX.size + NONCE_SIZE]
+    sealed = wrapped[_WRAPPED_PREFIX.size + NONCE_SIZE:]
+    aead = _master_aead()
+    if aead is None:
+        raise RuntimeError("Blob is encrypted but ENCRYPTION_KEY is not set")
+    return DataKey(aead.decrypt(nonce, sealed, prefix), cipher, chunk_size)
+
+
+def chunk_count(size, chunk_size):
+    # An empty file is still one (empty) final chunk, so truncation is detectable
+    return max(1, -(-size // chunk_size))
+
+
+def encrypted_size(size, chunk_size):
+    """Stored size of a plaintext of ``size`` bytes"""
+    return HEADER.size + size + chunk_count(size, chunk_size) * TAG_SIZE
+
+
+def _chunk_aad(header, index, final):
+    return header + struct.pack('>QB', index, final)
+
+
+def _chunk_nonce(index):
+    # Each data key encrypts one object, so the chunk index is a unique nonce
+    return index.to_bytes(NONCE_SIZE, 'big')
+
+
+def encrypt_file(source_path, target_path, data_key, size):
+    """Encrypt a file chunk by chunk; memory use is bounded by the chunk size"""
+    aead = _aead(data_key.cipher, data_key.key)
+    header = HEADER.pack(MAGIC, VERSION, data_key.cipher, data_key.chunk_size)
+    last = chunk_count(size, data_key.chunk_size) - 1
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        target.write(header)
+        for index in range(last + 1):
+            chunk = source.read(data_key.chunk_size)
+            target.write(aead.encrypt(_chunk_nonce(index), chunk,
+                                      _chunk_aad(header, index, index == last)))
+
+
+def encrypt_staged_file(staging_path, size):
+    """Encrypt a staged upload in place if ENCRYPTION_KEY is set
+
+    Returns the wrapped data key to store with the blob, or None when
+    encryption is disabled and the file is left as it is.
+    """
+    if not encryption_enabled():
+        return None
+    data_key, wrapped = new_data_key()
+    encrypted_path = staging_path + '.enc'
+    try:
+        encrypt_file(staging_path, encrypted_path, data_key, size)
+        os.replace(encrypted_path, staging_path)
+    except BaseException:
+        if os.path.exists(encrypted_path):
+            os.remove(encrypted_path)
+        raise
+    return wrapped
+
+
+class DecryptingStorage(StorageBackend):
+    """Read-only view of one encrypted object as its plaintext
+
+    Ranges are served by fetching only the chunks that cover them, so a
+    Range request costs at most two chunks more than its own length.
+    """
+
+    def __init__(self, storage, data_key, size):
+        self.storage = storage
+        self.data_key = data_key
+        self.size = size
+        self.header = HEADER.pack(MAGIC, VERSION, data_key.cipher, data_key.chunk_size)
+        self.last_index = chunk_count(size, data_key.chunk_size) - 1
+
+    def stat(self, key):
+        stored = self.storage.stat(key)
+        return StoredObject(self.size, stored.modified)
+
+    def _frame_length(self, index):
+        if index == self.last_index:
+            return self.size - index * self.data_key.chunk_size + TAG_SIZE
+        return self.data_key.chunk_size + TAG_SIZE
+
+    def get_range_stream(self, key, start, stop, block_size=None):
+        if stop <= start:
+            return
+        chunk_size = self.data_key.chunk_size
+        first, last = start // chunk_size, (stop - 1) // chunk_size
+        stored_start = HEADER.size + first * (chunk_size + TAG_SIZE)
+        stored_stop = HEADER.size + last * (chunk_size + TAG_SIZE) + self._frame_length(last)
+
+        aead = _aead(self.data_key.cipher, self.data_key.key)
+        buffer = bytearray()
+        index = first
+        needed = self._frame_length(index)
+        for block in self.storage.get_range_stream(key, stored_start, stored_stop):
+            buffer += block
+            while index <= last and len(buffer) >= needed:
+                plain = aead.decrypt(_chunk_nonce(index), bytes(buffer[:needed]),
+                                     _chunk_aad(self.header, index, index == self.last_index))
+                del buffer[:needed]
+                offset = index * chunk_size
+                yield plain[max(start - offset, 0):stop - offset]
+                index += 1
+                needed = self._frame_length(index)
+        if index <= last:
+            raise ValueError('encrypted object is truncated')
+
+
+def open_for_reading(storage, share):
+    """Storage view that yields the decrypted bytes of a share's blob"""
+    if not share.wrapped_key:
+        return storage
+    return DecryptingStorage(storage, unwrap_data_key(share.wrapped_key), share.stored_size)
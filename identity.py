@@ -0,0 +1,101 @@
+"""Who is signed in: identity claims in the session cookie, user records from a cache
+
+Logging in puts the user's ID and username in the Flask session, a
+cookie signed with SESSION_SECRET, so routes read the caller's identity
+without touching the database. The user record itself is kept in a
+per-process cache for USER_CACHE_TTL seconds. That cache is also what
+checks that the account still exists: a session naming a user that is
+gone is dropped.
+
+Code that changes a user row calls invalidate_user() after committing.
+Other processes see the change when their cached copy expires.
+"""
+from flask import current_app, g, session
+
+from app import db
+from cache import MISSING, TTLCache
+from models import User
+
+
+class UserSnapshot:
+    """Detached copy of the User fields the pages show"""
+
+    FIELDS = ('id', 'username', 'email', 'created_at')
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(**{name: getattr(user, name) for name in cls.FIELDS})
+
+    def __repr__(self):
+        return f'<UserSnapshot {self.username}>'
+
+
+class UserCache:
+    """Per-process cache of user records by ID, including IDs with no user"""
+
+    def __init__(self, maxsize, ttl):
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, user_id):
+        """Return a UserSnapshot for user_id, or None if no such user exists"""
+        snapshot = self.local.get(user_id)
+        if snapshot is None:
+            user = db.session.get(User, user_id)
+            snapshot = UserSnapshot.from_user(user) if user else MISSING
+            self.local.set(user_id, snapshot)
+        return None if snapshot is MISSING else snapshot
+
+    def put(self, user):
+        self.local.set(user.id, UserSnapshot.from_user(user))
+
+    def invalidate(self, *user_ids):
+        for user_id in user_ids:
+            self.local.delete(user_id)
+
+
+def get_user_cache():
+    """Return the application's UserCache, creating it on first use"""
+    cache = current_app.extensions.get('user_cache')
+    if cache is None:
+        config = current_app.config
+        cache = UserCache(maxsize=config['USER_CACHE_SIZE'], ttl=config['USER_CACHE_TTL'])
+        current_app.extensions['user_cache'] = cache
+    return cache
+
+
+def invalidate_user(*user_ids):
+    get_user_cache().invalidate(*user_ids)
+
+
+def login_user(user):
+    """Put user's identity claims in the session"""
+    session['user_id'] = user.id
+    session['username'] = user.username
+    # The caller has the row already; the next request should not load it again
+    get_user_cache().put(user)
+    g.current_user = UserSnapshot.from_user(user)
+
+
+def logout_user():
+    session.clear()
+    g.current_user = None
+
+
+def current_user():
+    """The signed-in user as a UserSnapshot, or None
+
+    Reads the user ID from the session and the record from the cache,
+    once per request.
+    """
+    if 'current_user' not in g:
+        user_id = session.get('user_id')
+        user = get_user_cache().get(user_id) if user_id is not None else None
+        if user is None and user_id is not None:
+            # The account is gone; forget the session rather than trust it
+            session.clear()
+        g.current_user = user
+    return g.current_user
@@ -1,4 +1,12 @@
-from app import app
+from app import create_app
+
+app = create_app()
 
 if __name__ == '__main__':
+    # The development server sets up its own schema; deployments run
+    # `flask --app main migrate` before starting workers
+    from migrations import migrate
+
+    with app.app_context():
+        migrate()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,450 @@
+import bisect
+import glob
+import hmac
+import json
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import current_app, g, request
+
+from storage import StorageBackend
+
+# Seconds; covers a cached redirect up to a long upload
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Bytes per second, 64 KiB/s to 1 GiB/s
+THROUGHPUT_BUCKETS = tuple(float(2 ** n) for n in range(16, 31, 2))
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+# Endpoints whose request or response body is a file transfer
+TRANSFER_ENDPOINTS = {
+    'upload.upload_file': 'upload',
+    'upload.upload_chunk': 'upload',
+    'upload.create_batch': 'upload',
+    'download.download_file': 'download',
+    'download.download_collection': 'download',
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    """A named family of series, one per combination of label values"""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), self._copy(value)] for key, value in self._series.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def merge(total, value):
+        return (total or 0) + value
+
+    def lines(self, series):
+        for labels, value in series:
+            yield f'{self.name}{_labels(self.labels, labels)} {_number(value)}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per-bucket (not cumulative) counts plus +Inf, then the sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    @staticmethod
+    def _copy(value):
+        return list(value)
+
+    @staticmethod
+    def merge(total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def lines(self, series):
+        for labels, value in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), value[:-1]):
+                cumulative += count
+                le = bound if bound == '+Inf' else _number(bound)
+                yield f'{self.name}_bucket{_labels(self.labels + ("le",), labels + [le])} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labels, labels)} {_number(value[-1])}'
+            yield f'{self.name}_count{_labels(self.labels, labels)} {cumulative}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help, labels=()):
+        return self.metrics.setdefault(name, Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(name, help, labels, buckets))
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def render(self, snapshots):
+        """Prometheus text exposition of one or more snapshots, summed series by series"""
+        lines = []
+        for name, metric in self.metrics.items():
+            merged = {}
+            for snapshot in snapshots:
+                for labels, value in snapshot.get(name, []):
+                    key = tuple(labels)
+                    merged[key] = metric.merge(merged.get(key), value)
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            lines.extend(metric.lines([[list(key), value] for key, value in sorted(merged.items())]))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'sfv_request_duration_seconds', 'Time from request start until the response body was sent',
+    ('endpoint', 'method', 'status'))
+TRANSFER_BYTES = REGISTRY.counter(
+    'sfv_transfer_bytes_total', 'File bytes received by uploads and sent by downloads', ('direction',))
+TRANSFER_RATE = REGISTRY.histogram(
+    'sfv_transfer_bytes_per_second', 'Throughput of individual uploads and downloads',
+    ('direction',), THROUGHPUT_BUCKETS)
+PASSWORD_SECONDS = REGISTRY.histogram(
+    'sfv_password_verify_seconds', 'Time spent verifying one password hash', ('scheme',))
+DB_QUERIES = REGISTRY.histogram(
+    'sfv_db_queries_per_request', 'SQL statements executed per sampled request', ('endpoint',),
+    QUERY_COUNT_BUCKETS)
+DB_REQUEST_SECONDS = REGISTRY.histogram(
+    'sfv_db_seconds_per_request', 'Total SQL time per sampled request', ('endpoint',))
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'sfv_db_query_seconds', 'Time per SQL statement in sampled requests')
+STORAGE_SECONDS = REGISTRY.histogram(
+    'sfv_storage_operation_seconds', 'Storage backend latency; for get, the time to the first block',
+    ('backend', 'operation'))
+
+# Set once by init_metrics; everything below is a no-op while it is False
+_enabled = False
+_sample_rate = 1.0
+
+# [statement count, seconds] for the current request when it is sampled
+_db_stats = ContextVar('sfv_db_stats', default=None)
+
+_flush_lock = threading.Lock()
+_last_flush = 0.0
+
+
+def metrics_enabled():
+    return _enabled
+
+
+def observe_request(endpoint, method, status, seconds):
+    if _enabled:
+        REQUEST_SECONDS.observe(seconds, endpoint, method, str(status))
+
+
+def observe_transfer(direction, size, seconds):
+    if _enabled and size:
+        TRANSFER_BYTES.inc(size, direction)
+        TRANSFER_RATE.observe(size / max(seconds, 1e-6), direction)
+
+
+def observe_password_verify(pwhash, seconds):
+    if _enabled:
+        scheme = 'argon2' if pwhash.startswith('$argon2') else pwhash.split(':', 1)[0].split('$', 1)[0]
+        PASSWORD_SECONDS.observe(seconds, scheme)
+
+
+class InstrumentedStorage(StorageBackend):
+    """Storage wrapper timing every backend call"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.backend = type(storage).__name__.replace('Storage', '').lower() or 'storage'
+
+    def _timed(self, operation, fn, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            STORAGE_SECONDS.observe(time.perf_counter() - started, self.backend, operation)
+
+    def put_file(self, key, path):
+        return self._timed('put', self.storage.put_file, key, path)
+
+    def put_stream(self, key, stream, length=None):
+        return self._timed('put', self.storage.put_stream, key, stream, length)
+
+    def get_range_stream(self, key, start, stop, block_size=None):
+        started = time.perf_counter()
+        if block_size is None:
+            blocks = iter(self.storage.get_range_stream(key, start, stop))
+        else:
+            blocks = iter(self.storage.get_range_stream(key, start, stop, block_size))
+        first = next(blocks, None)
+        STORAGE_SECONDS.observe(time.perf_counter() - started, self.backend, 'get')
+        if first is None:
+            return
+        yield first
+        yield from blocks
+
+    def delete(self, key):
+        return self._timed('delete', self.storage.delete, key)
+
+    def copy(self, key, new_key):
+        return self._timed('copy', self.storage.copy, key, new_key)
+
+    def stat(self, key):
+        return self._timed('stat', self.storage.stat, key)
+
+    def list_objects(self, start_after='', limit=1000):
+        return self._timed('list', self.storage.list_objects, start_after, limit)
+
+    def presigned_url(self, key, expires_in, **kwargs):
+        return self._timed('presign', self.storage.presigned_url, key, expires_in, **kwargs)
+
+    def local_path(self, key):
+        return self.storage.local_path(key)
+
+
+def instrument_storage(storage):
+    """Wrap a storage backend for timing when metrics are enabled"""
+    return InstrumentedStorage(storage) if _enabled else storage
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _db_stats.get() is not None:
+        conn.info['sfv_statement_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _db_stats.get()
+    started = conn.info.pop('sfv_statement_started', None)
+    if stats is None or started is None:
+        return
+    elapsed = time.perf_counter() - started
+    stats[0] += 1
+    stats[1] += elapsed
+    DB_QUERY_SECONDS.observe(elapsed)
+
+
+_file_wrappers = {}
+
+
+def _notifying_file_wrapper(file_wrapper):
+    """Subclass of the server's wsgi.file_wrapper that reports when it is closed
+
+    Servers only use sendfile for instances of their own wrapper class, so
+    a subclass keeps zero-copy downloads while still telling us when the
+    body has gone out.
+    """
+    wrapper = _file_wrappers.get(file_wrapper)
+    if wrapper is None:
+        class NotifyingFileWrapper(file_wrapper):
+            on_close = None
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                close = getattr(self, 'close', None)
+
+                def notify_close():
+                    try:
+                        if close is not None:
+                            close()
+                    finally:
+                        if self.on_close is not None:
+                            self.on_close()
+                self.close = notify_close
+
+        wrapper = _file_wrappers[file_wrapper] = NotifyingFileWrapper
+    return wrapper
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    environ = request.environ
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if isinstance(file_wrapper, type):
+        environ['wsgi.file_wrapper'] = _notifying_file_wrapper(file_wrapper)
+    stats = [0, 0.0] if _sample_rate >= 1 or random.random() < _sample_rate else None
+    g.metrics_db = stats
+    _db_stats.set(stats)
+
+
+def _counting(body, on_done):
+    sent = 0
+    try:
+        for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+        on_done(sent)
+
+
+def _finish_request(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    method = request.method
+    status = response.status_code
+    stats = g.pop('metrics_db', None)
+    _db_stats.set(None)
+    if stats is not None:
+        DB_QUERIES.observe(stats[0], endpoint)
+        DB_REQUEST_SECONDS.observe(stats[1], endpoint)
+
+    direction = TRANSFER_ENDPOINTS.get(endpoint)
+    if direction == 'upload' and status < 400:
+        observe_transfer('upload', request.content_length or 0, time.perf_counter() - started)
+    counts_download = direction == 'download' and status in (200, 206) and method != 'HEAD'
+    # The body may finish after the app context is gone
+    config = current_app.config
+
+    def done(sent):
+        elapsed = time.perf_counter() - started
+        observe_request(endpoint, method, status, elapsed)
+        if counts_download:
+            observe_transfer('download', sent, elapsed)
+        _maybe_flush(config)
+
+    # Werkzeug hands direct_passthrough bodies to the server untouched and
+    # never runs call_on_close for them, so those are wrapped instead
+    body = response.response
+    length = response.content_length or 0
+    if not response.direct_passthrough or method == 'HEAD' or status in (204, 304):
+        response.call_on_close(lambda: done(length))
+    elif hasattr(body, 'on_close'):
+        body.on_close = lambda: done(length)
+    else:
+        response.response = _counting(body, done)
+    return response
+
+
+def _request_failed(exc):
+    # Unhandled exceptions skip after_request; count them as 500s here
+    started = g.pop('metrics_started', None)
+    _db_stats.set(None)
+    if exc is not None and started is not None:
+        observe_request(request.endpoint or 'unmatched', request.method, 500, time.perf_counter() - started)
+
+
+def _maybe_flush(config, force=False):
+    """Write this process's snapshot to METRICS_DIR at most every METRICS_FLUSH_INTERVAL"""
+    global _last_flush
+    directory = config['METRICS_DIR']
+    if not directory:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < config['METRICS_FLUSH_INTERVAL']:
+        return
+    if not _flush_lock.acquire(blocking=False):
+        return
+    try:
+        _last_flush = now
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(REGISTRY.snapshot(), f)
+        os.replace(path + '.tmp', path)
+    finally:
+        _flush_lock.release()
+
+
+def _collect():
+    """Snapshots to expose: every worker's when METRICS_DIR is shared, else this process's"""
+    directory = current_app.config['METRICS_DIR']
+    if not directory:
+        return [REGISTRY.snapshot()]
+    _maybe_flush(current_app.config, force=True)
+    snapshots = []
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def metrics_view():
+    token = current_app.config['METRICS_TOKEN']
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return current_app.response_class('Unauthorized\n', status=401, mimetype='text/plain')
+    return current_app.response_class(REGISTRY.render(_collect()), content_type=CONTENT_TYPE)
+
+
+def init_metrics(app):
+    """Install request, database and storage instrumentation and /metrics
+
+    Does nothing unless METRICS_ENABLED is set: no hooks, no listeners and
+    no /metrics route, so a disabled deployment pays nothing per request.
+    The route is only added when METRICS_TOKEN is set; the metrics name
+    endpoints and show traffic, so they are not served to anyone who asks.
+    """
+    global _enabled, _sample_rate
+    if not app.config['METRICS_ENABLED']:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    _enabled = True
+    _sample_rate = app.config['METRICS_SAMPLE_RATE']
+    if app.config['METRICS_DIR']:
+        os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_request_failed)
+    if app.config['METRICS_TOKEN']:
+        app.add_url_rule('/metrics', 'metrics', metrics_view)
+    else:
+        app.logger.warning("METRICS_ENABLED is set but METRICS_TOKEN is not; /metrics is not served")
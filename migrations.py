@@ -0,0 +1,168 @@
+"""Schema management, kept out of application startup
+
+Workers never issue DDL while starting; run `flask --app main migrate`
+once per deploy (or after pulling new models) instead. It creates missing
+tables and adds the columns and indexes that models gained since the
+table was created, so it is safe to run repeatedly. It never drops or
+alters anything that already exists, except for converting public IDs
+stored as text to the binary keys models.CompactID expects. Files
+uploaded before content-addressed storage are then stored as blobs
+(blobstore.adopt_legacy_files), so their share links keep working, and
+the NOT NULL on their file_shares.file_path column is dropped, since
+new shares leave it empty.
+"""
+import re
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, literal, text
+
+from app import db
+from blobstore import adopt_legacy_files
+from models import CompactID
+from utils import file_id_key
+
+
+def _column_ddl(column, dialect):
+    """Column definition for ALTER TABLE ... ADD COLUMN
+
+    Existing rows get the column's scalar default, so counters such as
+    UserStats.reserved_bytes can be NOT NULL from the start. Columns
+    without one are added as nullable.
+    """
+    ddl = f'{dialect.identifier_preparer.quote(column.name)} {column.type.compile(dialect=dialect)}'
+    default = column.default
+    if default is not None and default.is_scalar:
+        value = literal(default.arg, column.type).compile(dialect=dialect, compile_kwargs={'literal_binds': True})
+        ddl += f' DEFAULT {value}'
+        if not column.nullable:
+            ddl += ' NOT NULL'
+    return ddl
+
+
+def _compact_text_ids(connection, table, column, column_type, batch_size=1000):
+    """Convert a public ID column still holding base62/base64url text to 9-byte keys; returns rows changed"""
+    dialect = connection.dialect
+    quote = dialect.identifier_preparer.quote
+    table_name, column_name = dialect.identifier_preparer.format_table(table), quote(column.name)
+    if dialect.name == 'postgresql':
+        if not isinstance(column_type, db.String):
+            return 0
+        connection.execute(text(
+            f"ALTER TABLE {table_name} ALTER COLUMN {column_name} TYPE bytea "
+            f"USING decode(translate({column_name}, '-_', '+/'), 'base64')"
+        ))
+        return connection.execute(text(f'SELECT count(*) FROM {table_name}')).scalar()
+    if dialect.name != 'sqlite':
+        return 0
+    # SQLite keeps the declared VARCHAR but stores whatever it is given.
+    # Text sorts before every blob, so "< x''" finds the rows still to
+    # convert with a range scan of the unique index
+    converted = 0
+    after = 0
+    while True:
+        rows = connection.execute(text(
+            f"SELECT rowid, {column_name} FROM {table_name} "
+            f"WHERE {column_name} < x'' AND rowid > :after ORDER BY rowid LIMIT :limit"
+        ), {'after': after, 'limit': batch_size}).all()
+        if not rows:
+            return converted
+        after = rows[-1][0]
+        updates = [{'key': file_id_key(value), 'rowid': rowid} for rowid, value in rows if file_id_key(value)]
+        if updates:
+            connection.execute(text(f'UPDATE {table_name} SET {column_name} = :key WHERE rowid = :rowid'),
+                               updates)
+        converted += len(updates)
+
+
+def _relax_legacy_file_path(engine):
+    """Drop NOT NULL from the pre-blob file_shares.file_path column; returns True if changed
+
+    The models no longer have the column, so inserts leave it empty. Its
+    values stay, for shares whose file could not be stored as a blob.
+    """
+    column = next((c for c in inspect(engine).get_columns('file_shares') if c['name'] == 'file_path'), None)
+    if column is None or column['nullable']:
+        return False
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE file_shares ALTER COLUMN file_path DROP NOT NULL'))
+        return True
+    if engine.dialect.name != 'sqlite':
+        return False
+    # SQLite cannot alter a column: rebuild the table from its own CREATE
+    # statement without the constraint, in one transaction, and put the
+    # indexes back
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=OFF')
+        cursor.execute('BEGIN')
+        table_sql = cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'file_shares'").fetchone()[0]
+        index_sql = [row[0] for row in cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'file_shares' AND sql IS NOT NULL")]
+        table_sql = re.sub(r'(\bfile_path\b[^,]*?)\s+NOT NULL', r'\1', table_sql, count=1)
+        table_sql = re.sub(r'^CREATE TABLE\s+("?)file_shares\1', 'CREATE TABLE file_shares_rebuild', table_sql)
+        cursor.execute(table_sql)
+        cursor.execute('INSERT INTO file_shares_rebuild SELECT * FROM file_shares')
+        cursor.execute('DROP TABLE file_shares')
+        cursor.execute('ALTER TABLE file_shares_rebuild RENAME TO file_shares')
+        for sql in index_sql:
+            cursor.execute(sql)
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return True
+
+
+def migrate():
+    """Bring the database schema up to date with the models; returns what was changed"""
+    engine = db.engine
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    changes = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing:
+            table.create(engine)
+            changes.append(f'created table {table.name}')
+            continue
+        columns = {column['name']: column['type'] for column in inspector.get_columns(table.name)}
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        with engine.begin() as connection:
+            table_name = engine.dialect.identifier_preparer.format_table(table)
+            for column in table.columns:
+                if column.name not in columns:
+                    connection.execute(text(f'ALTER TABLE {table_name} ADD COLUMN '
+                                            f'{_column_ddl(column, engine.dialect)}'))
+                    changes.append(f'added column {table.name}.{column.name}')
+            for column in table.columns:
+                if isinstance(column.type, CompactID) and column.name in columns:
+                    converted = _compact_text_ids(connection, table, column, columns[column.name])
+                    if converted:
+                        changes.append(f'converted {converted} {table.name}.{column.name} values to binary keys')
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    changes.append(f'created index {index.name}')
+    adopted, missing = adopt_legacy_files()
+    if adopted:
+        changes.append(f'stored {adopted} files uploaded before blob storage as blobs')
+    if missing:
+        changes.append(f'{missing} shares uploaded before blob storage have no file to store')
+    if _relax_legacy_file_path(engine):
+        changes.append('made file_shares.file_path nullable')
+    return changes
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    """Create missing tables, columns and indexes, and store pre-blob uploads as blobs"""
+    changes = migrate()
+    for change in changes:
+        click.echo(change)
+    click.echo(f'Schema up to date ({len(changes)} changes)')
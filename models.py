@@ -1,8 +1,51 @@
 from app import db
-from datetime import datetime, timezone
-from werkzeug.security import generate_password_hash, check_password_hash
+from datetime import datetime, timedelta, timezone
+from passwords import hash_password, verify_password
+from quotas import QuotaExceeded, default_egress_quota, default_storage_quota, egress_period
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.types import TypeDecorator
+from utils import file_id_from_key, file_id_key, generate_file_id, generate_file_ids, get_file_mime_type
+import base64
 import secrets
-import string
+
+# Fresh IDs drawn before giving up on inserting a share or collection
+PUBLIC_ID_ATTEMPTS = 5
+
+class CompactID(TypeDecorator):
+    """A 12-character public ID stored as its 9 raw bytes
+
+    Code keeps passing and receiving strings; the unique index holds
+    9-byte keys instead of 12+ character strings, and compares them
+    bytewise rather than by collation.
+    """
+    impl = db.LargeBinary(9)
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        return None if value is None else file_id_key(value)
+    
+    def process_result_value(self, value, dialect):
+        return None if value is None else file_id_from_key(value)
+
+def _is_public_id_collision(error, column):
+    return column in str(error.orig)
+
+def add_with_public_id(instance):
+    """Add a new FileShare or Collection, redrawing its random ID if it is already taken
+
+    Flushes the insert in a savepoint so a collision costs one retry
+    rather than failing the whole transaction.
+    """
+    column = instance.PUBLIC_ID
+    for attempt in range(PUBLIC_ID_ATTEMPTS):
+        try:
+            with db.session.begin_nested():
+                db.session.add(instance)
+            return instance
+        except IntegrityError as e:
+            if attempt == PUBLIC_ID_ATTEMPTS - 1 or not _is_public_id_collision(e, column):
+                raise
+            setattr(instance, column, generate_file_id())
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -17,35 +60,298 @@ class User(db.Model):
     file_shares = db.relationship('FileShare', backref='user', lazy=True, cascade='all, delete-orphan')
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
     
     def __repr__(self):
         return f'<User {self.username}>'
 
-class FileShare(db.Model):
+class UserStats(db.Model):
+    __tablename__ = 'user_stats'
+    
+    # Per-user dashboard summary, adjusted in the same transaction as the
+    # share insert, delete or download that changes it
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    file_count = db.Column(db.Integer, nullable=False, default=0)
+    total_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    total_downloads = db.Column(db.Integer, nullable=False, default=0)
+    exhausted_count = db.Column(db.Integer, nullable=False, default=0)
+    # Declared length of resumable uploads in progress, held against the storage quota
+    reserved_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    # Bytes served from this user's shares in egress_period (see quotas.egress_period)
+    egress_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    egress_period = db.Column(db.Integer, nullable=False, default=0)
+    # Per-user quotas in bytes; NULL uses the app-wide default, 0 is unlimited
+    storage_quota = db.Column(db.BigInteger, nullable=True)
+    egress_quota = db.Column(db.BigInteger, nullable=True)
+    
+    @classmethod
+    def adjust(cls, user_id, enforce_quota=False, **deltas):
+        """Apply counter deltas atomically, creating the row on first use
+        
+        With ``enforce_quota``, deltas that grow total_bytes plus
+        reserved_bytes only apply if the result stays within the user's
+        storage quota; returns False, changing nothing, when it would not.
+        """
+        values = {name: getattr(cls, name) + delta for name, delta in deltas.items() if delta}
+        if not values:
+            return True
+        db.session.flush()
+        stmt = db.update(cls).where(cls.user_id == user_id).values(**values)
+        growth = deltas.get('total_bytes', 0) + deltas.get('reserved_bytes', 0)
+        if enforce_quota and growth > 0:
+            limit = db.func.coalesce(cls.storage_quota, default_storage_quota())
+            stmt = stmt.where(db.or_(limit == 0, cls.total_bytes + cls.reserved_bytes + growth <= limit))
+        if db.session.execute(stmt).rowcount:
+            return True
+        if enforce_quota and cls._exists(user_id):
+            return False
+        # First change for this user: the rebuilt totals already include it
+        if not cls.rebuild(user_id):
+            db.session.execute(stmt)
+        return True
+    
+    @classmethod
+    def record_downloads(cls, user_id, downloads, exhausted, nbytes):
+        """Count downloads of a user's shares and charge their bytes as egress
+        
+        One conditional UPDATE: bytes from an earlier period are dropped,
+        and nothing changes (returning False) if ``nbytes`` would take the
+        user over their egress quota for the current period.
+        """
+        period = egress_period()
+        used = db.case((cls.egress_period == period, cls.egress_bytes), else_=0)
+        limit = db.func.coalesce(cls.egress_quota, default_egress_quota())
+        stmt = (
+            db.update(cls)
+            .where(cls.user_id == user_id, db.or_(limit == 0, used + nbytes <= limit))
+            .values(total_downloads=cls.total_downloads + downloads,
+                    exhausted_count=cls.exhausted_count + exhausted,
+                    egress_bytes=used + nbytes, egress_period=period)
+        )
+        if db.session.execute(stmt).rowcount:
+            return True
+        if cls._exists(user_id):
+            return False
+        # First change for this user: the rebuilt totals already include the downloads
+        if not cls.rebuild(user_id):
+            return bool(db.session.execute(stmt).rowcount)
+        db.session.execute(db.update(cls).where(cls.user_id == user_id)
+                           .values(egress_bytes=nbytes, egress_period=period))
+        return True
+    
+    @classmethod
+    def has_storage_for(cls, user_id, incoming):
+        """Whether ``incoming`` more bytes fit the user's storage quota
+        
+        A primary key read, cheap enough to refuse an upload before its
+        body is read; adjust(enforce_quota=True) makes the binding check
+        once the real size is known.
+        """
+        stats = cls.for_user(user_id)
+        limit = stats.storage_quota if stats.storage_quota is not None else default_storage_quota()
+        return not limit or stats.total_bytes + stats.reserved_bytes + incoming <= limit
+    
+    @classmethod
+    def _exists(cls, user_id):
+        return db.session.execute(db.select(cls.user_id).where(cls.user_id == user_id)).first() is not None
+    
+    @classmethod
+    def rebuild(cls, user_id):
+        """Backfill a user's summary from file_shares, once
+        
+        Returns False if another worker created the row first.
+        """
+        totals = db.session.execute(
+            db.select(
+                db.func.count(FileShare.id),
+                db.func.coalesce(db.func.sum(FileShare.file_size), 0),
+                db.func.coalesce(db.func.sum(FileShare.download_count), 0),
+                db.func.count(FileShare.exhausted_at)
+            ).where(FileShare.user_id == user_id)
+        ).one()
+        reserved = db.session.execute(
+            db.select(db.func.coalesce(db.func.sum(UploadSession.upload_length), 0))
+            .where(UploadSession.user_id == user_id)
+        ).scalar_one()
+        try:
+            with db.session.begin_nested():
+                db.session.add(cls(user_id=user_id, file_count=totals[0], total_bytes=totals[1],
+                                   total_downloads=totals[2], exhausted_count=totals[3],
+                                   reserved_bytes=reserved))
+        except IntegrityError:
+            return False
+        return True
+    
+    @classmethod
+    def for_user(cls, user_id):
+        """Return a user's summary row, backfilling it if it does not exist yet"""
+        stats = db.session.get(cls, user_id)
+        if stats is None:
+            cls.rebuild(user_id)
+            db.session.commit()
+            stats = db.session.get(cls, user_id)
+        return stats
+    
+    def expired_count(self):
+        """Count expired shares that are not already counted as exhausted
+        
+        Expiry is a function of time, so it is counted on the
+        (user_id, expires_at) index; the reaper keeps that range small.
+        """
+        now = datetime.now(timezone.utc)
+        return db.session.execute(
+            db.select(db.func.count(FileShare.id)).where(
+                FileShare.user_id == self.user_id,
+                FileShare.expires_at <= now,
+                FileShare.exhausted_at.is_(None)
+            )
+        ).scalar_one()
+    
+    def __repr__(self):
+        return f'<UserStats {self.user_id}: {self.file_count} files>'
+
+class Blob(db.Model):
+    __tablename__ = 'blobs'
+    
+    # Content-addressed storage: one row and one stored object per distinct SHA-256
+    sha256 = db.Column(db.String(64), primary_key=True)
+    storage_key = db.Column(db.String(500), nullable=False, unique=True)
+    # Per-blob data key sealed with ENCRYPTION_KEY; NULL for plaintext blobs
+    wrapped_key = db.Column(db.LargeBinary, nullable=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    # Content coding of the stored bytes ('zstd', 'gzip') and their length
+    # before encryption; NULL for blobs stored as uploaded
+    encoding = db.Column(db.String(16), nullable=True)
+    stored_size = db.Column(db.BigInteger, nullable=True)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    
+    def __repr__(self):
+        return f'<Blob {self.sha256[:12]} refs={self.ref_count}>'
+
+class Preview(db.Model):
+    __tablename__ = 'previews'
+
+    # One derivative per blob (thumbnail, first page, poster frame or text
+    # snippet), stored and encrypted like the blob and removed with it
+    sha256 = db.Column(db.String(64), db.ForeignKey('blobs.sha256'), primary_key=True)
+    storage_key = db.Column(db.String(500), nullable=False, unique=True)
+    wrapped_key = db.Column(db.LargeBinary, nullable=True)
+    content_type = db.Column(db.String(50), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+    @property
+    def stored_size(self):
+        """Length before encryption, as encryption.open_for_reading expects"""
+        return self.size
+
+    @property
+    def is_image(self):
+        return self.content_type.startswith('image/')
+
+    def __repr__(self):
+        return f'<Preview {self.sha256[:12]} {self.content_type}>'
+
+class ShareAccessMixin:
+    """Access checks shared by FileShare rows and cached ShareSnapshots"""
+    
+    @property
+    def served_mime_type(self):
+        """The type detected at upload, or a guess from the extension for older shares"""
+        return self.mime_type or get_file_mime_type(self.original_filename)
+    
+    def check_password(self, password):
+        """Check if provided password matches"""
+        if not self.password_hash:
+            return True  # No password protection
+        return verify_password(self.password_hash, password)
+    
+    def is_expired(self):
+        """Check if the file link has expired"""
+        if not self.expires_at:
+            return False
+        expires_at = self.expires_at
+        if expires_at.tzinfo is None:
+            # SQLite hands back naive datetimes; they are stored as UTC
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        return datetime.now(timezone.utc) > expires_at
+    
+    def is_download_limit_reached(self):
+        """Check if download limit has been reached"""
+        if not self.download_limit:
+            return False
+        return self.download_count >= self.download_limit
+    
+    def can_download(self):
+        """Check if file can be downloaded"""
+        return not self.is_expired() and not self.is_download_limit_reached()
+    
+    def reserve_download(self):
+        """Atomically count a download if the limit and expiry still allow it
+        
+        The check and the increment happen in one conditional UPDATE, so
+        concurrent workers can never serve more than download_limit copies.
+        The file's size is charged to the owner's egress in the same
+        transaction. Returns the new download count, or None if the
+        download was refused; raises QuotaExceeded if the owner is out of
+        egress.
+        """
+        new_count = db.session.execute(
+            FileShare.reservation()
+            .where(FileShare.id == self.id)
+            .returning(FileShare.download_count)
+        ).scalar_one_or_none()
+        if new_count is not None:
+            charged = UserStats.record_downloads(
+                self.user_id, 1, int(new_count == self.download_limit), self.file_size
+            )
+            if not charged:
+                db.session.rollback()
+                raise QuotaExceeded('egress')
+        db.session.commit()
+        return new_count
+
+class FileShare(ShareAccessMixin, db.Model):
     __tablename__ = 'file_shares'
+    __table_args__ = (
+        # Keyset pagination for the dashboard and per-user expiry counts
+        db.Index('ix_file_shares_user_created', 'user_id', 'created_at', 'id'),
+        db.Index('ix_file_shares_user_expires', 'user_id', 'expires_at'),
+    )
+    
+    PUBLIC_ID = 'file_id'
     
     id = db.Column(db.Integer, primary_key=True)
-    file_id = db.Column(db.String(32), unique=True, nullable=False, index=True)
+    file_id = db.Column(CompactID, unique=True, nullable=False, index=True)
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
-    file_path = db.Column(db.String(500), nullable=False)
     file_size = db.Column(db.Integer, nullable=False)
+    sha256 = db.Column(db.String(64), db.ForeignKey('blobs.sha256'), nullable=False, index=True)
+    # file_size divided by the bytes actually stored for it
+    compression_ratio = db.Column(db.Float, nullable=True)
+    # Type detected from the content at upload (see sniffing); NULL for older
+    # shares, which are served by extension
+    mime_type = db.Column(db.String(100), nullable=True)
     
     # Security settings
     password_hash = db.Column(db.String(256), nullable=True)
     download_limit = db.Column(db.Integer, nullable=True)
     download_count = db.Column(db.Integer, default=0)
-    expires_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True, index=True)
+    exhausted_at = db.Column(db.DateTime, nullable=True, index=True)
     
     # Metadata
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    collection_id = db.Column(db.Integer, db.ForeignKey('collections.id'), nullable=True, index=True)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     last_accessed = db.Column(db.DateTime, nullable=True)
     
+    blob = db.relationship('Blob', lazy='joined')
+    
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         if not self.file_id:
@@ -54,41 +360,342 @@ class FileShare(db.Model):
     @staticmethod
     def generate_file_id():
         """Generate a secure random file ID"""
-        alphabet = string.ascii_letters + string.digits
-        return ''.join(secrets.choice(alphabet) for _ in range(12))
+        return generate_file_id()
+    
+    @classmethod
+    def bulk_create(cls, rows):
+        """Insert share rows (dicts of column values) with one statement, giving each a fresh file_id
+
+        The IDs come from a single generate_file_ids call. If any of them is
+        already taken, only those are redrawn and the insert is retried.
+        """
+        for row, file_id in zip(rows, generate_file_ids(len(rows))):
+            row['file_id'] = file_id
+        for attempt in range(PUBLIC_ID_ATTEMPTS):
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(db.insert(cls), rows)
+                return rows
+            except IntegrityError as e:
+                if attempt == PUBLIC_ID_ATTEMPTS - 1 or not _is_public_id_collision(e, cls.PUBLIC_ID):
+                    raise
+                taken = set(db.session.execute(
+                    db.select(cls.file_id).where(cls.file_id.in_([row['file_id'] for row in rows]))
+                ).scalars())
+                for row in rows:
+                    if row['file_id'] in taken:
+                        row['file_id'] = generate_file_id()
+    
+    # Shares uploaded before content-addressed storage have no blob until
+    # `flask --app main migrate` adopts their file (blobstore.adopt_legacy_files);
+    # they read as having no stored object until then
+    
+    @property
+    def storage_key(self):
+        """Storage backend key of the blob holding this share's content, or None"""
+        return self.blob.storage_key if self.blob else None
+    
+    @property
+    def wrapped_key(self):
+        """Sealed data key of the blob, or None if it is stored in plaintext"""
+        return self.blob.wrapped_key if self.blob else None
+    
+    @property
+    def content_encoding(self):
+        """Compression applied to the stored blob, or None"""
+        return self.blob.encoding if self.blob else None
+    
+    @property
+    def stored_size(self):
+        """Length of the blob's (possibly compressed) bytes before encryption"""
+        if self.blob is None:
+            return None
+        if self.blob.stored_size is None:
+            return self.blob.size
+        return self.blob.stored_size
     
     def set_password(self, password):
         """Set password protection for the file"""
         if password:
-            self.password_hash = generate_password_hash(password)
+            self.password_hash = hash_password(password)
     
-    def check_password(self, password):
-        """Check if provided password matches"""
-        if not self.password_hash:
-            return True  # No password protection
-        return check_password_hash(self.password_hash, password)
+    @classmethod
+    def reservation(cls):
+        """UPDATE counting one download of each matched share still within its limit and expiry"""
+        now = datetime.now(timezone.utc)
+        return (
+            db.update(cls)
+            .where(
+                db.or_(cls.download_limit.is_(None), cls.download_count < cls.download_limit),
+                db.or_(cls.expires_at.is_(None), cls.expires_at > now)
+            )
+            .values(
+                download_count=cls.download_count + 1,
+                last_accessed=now,
+                # Stamp the download that uses up the limit so the reaper finds it by index
+                exhausted_at=db.case((cls.download_count + 1 >= cls.download_limit, now), else_=None)
+            )
+            .execution_options(synchronize_session=False)
+        )
     
-    def is_expired(self):
-        """Check if the file link has expired"""
-        if not self.expires_at:
-            return False
-        return datetime.now(timezone.utc) > self.expires_at
-    
-    def is_download_limit_reached(self):
-        """Check if download limit has been reached"""
-        if not self.download_limit:
-            return False
-        return self.download_count >= self.download_limit
+    @classmethod
+    def reserve_downloads(cls, share_ids):
+        """Count one download of several shares in a single UPDATE
+        
+        Shares whose limit is used up or that have expired are left alone.
+        Returns the ids of the shares that were counted; raises
+        QuotaExceeded, counting nothing, if an owner is out of egress.
+        """
+        if not share_ids:
+            return set()
+        rows = db.session.execute(
+            cls.reservation()
+            .where(cls.id.in_(list(share_ids)))
+            .returning(cls.id, cls.user_id, cls.download_count, cls.download_limit, cls.file_size)
+        ).all()
+        per_user = {}
+        for row in rows:
+            downloads, exhausted, nbytes = per_user.get(row.user_id, (0, 0, 0))
+            per_user[row.user_id] = (downloads + 1,
+                                     exhausted + int(row.download_count == row.download_limit),
+                                     nbytes + row.file_size)
+        for user_id, (downloads, exhausted, nbytes) in per_user.items():
+            if not UserStats.record_downloads(user_id, downloads, exhausted, nbytes):
+                db.session.rollback()
+                raise QuotaExceeded('egress')
+        db.session.commit()
+        return {row.id for row in rows}
     
-    def can_download(self):
-        """Check if file can be downloaded"""
-        return not self.is_expired() and not self.is_download_limit_reached()
+    @staticmethod
+    def status_expression(now):
+        """SQL expression giving 'expired', 'limit_reached' or 'active'"""
+        return db.case(
+            (db.and_(FileShare.expires_at.isnot(None), FileShare.expires_at <= now), 'expired'),
+            (db.and_(FileShare.download_limit.isnot(None),
+                     FileShare.download_count >= FileShare.download_limit), 'limit_reached'),
+            else_='active'
+        )
     
-    def increment_download_count(self):
-        """Increment download count and update last accessed time"""
-        self.download_count += 1
-        self.last_accessed = datetime.now(timezone.utc)
-        db.session.commit()
+    @classmethod
+    def dashboard_page(cls, user_id, before=None, limit=50):
+        """Fetch one page of a user's shares, newest first, by keyset
+        
+        ``before`` is the (created_at, id) of the last row already shown.
+        Returns (rows, next_cursor); rows carry only what the dashboard
+        renders plus a SQL-computed ``status``.
+        """
+        now = datetime.now(timezone.utc)
+        query = (
+            db.select(
+                cls.id, cls.file_id, cls.original_filename, cls.file_size,
+                cls.password_hash.isnot(None).label('is_protected'),
+                cls.download_count, cls.download_limit, cls.expires_at, cls.created_at,
+                cls.status_expression(now).label('status')
+            )
+            .where(cls.user_id == user_id)
+            .order_by(cls.created_at.desc(), cls.id.desc())
+            .limit(limit + 1)
+        )
+        if before is not None:
+            query = query.where(db.tuple_(cls.created_at, cls.id) < before)
+        rows = db.session.execute(query).all()
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1].created_at, rows[-1].id)
+        return rows, next_cursor
     
     def __repr__(self):
         return f'<FileShare {self.file_id}: {self.original_filename}>'
+
+class Collection(db.Model):
+    __tablename__ = 'collections'
+    
+    PUBLIC_ID = 'collection_id'
+    
+    # A group of shares created together, reachable through one link
+    id = db.Column(db.Integer, primary_key=True)
+    collection_id = db.Column(CompactID, unique=True, nullable=False, index=True)
+    name = db.Column(db.String(255), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    
+    shares = db.relationship('FileShare', lazy='dynamic', order_by='FileShare.id')
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if not self.collection_id:
+            self.collection_id = generate_file_id()
+    
+    def __repr__(self):
+        return f'<Collection {self.collection_id}>'
+
+class UploadSession(db.Model):
+    __tablename__ = 'upload_sessions'
+    
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    original_filename = db.Column(db.String(255), nullable=False)
+    file_path = db.Column(db.String(500), nullable=False)
+    upload_length = db.Column(db.BigInteger, nullable=False)
+    upload_offset = db.Column(db.BigInteger, nullable=False, default=0)
+    
+    # Share settings applied when the upload is finalized
+    password_hash = db.Column(db.String(256), nullable=True)
+    download_limit = db.Column(db.Integer, nullable=True)
+    expiry_hours = db.Column(db.Integer, nullable=True)
+    
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if not self.id:
+            self.id = secrets.token_hex(16)
+    
+    def is_complete(self):
+        """Check if every byte of the upload has been received"""
+        return self.upload_offset >= self.upload_length
+    
+    def __repr__(self):
+        return f'<UploadSession {self.id}: {self.upload_offset}/{self.upload_length}>'
+
+class ScanCursor(db.Model):
+    __tablename__ = 'scan_cursors'
+    
+    # Where each phase of the storage consistency scan stopped, so the next run resumes there
+    name = db.Column(db.String(32), primary_key=True)
+    position = db.Column(db.String(500), nullable=False, default='')
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    
+    @classmethod
+    def load(cls, name):
+        cursor = db.session.get(cls, name)
+        return cursor.position if cursor else ''
+    
+    @classmethod
+    def save(cls, name, position):
+        """Record a phase's position; the caller commits"""
+        cursor = db.session.get(cls, name) or cls(name=name)
+        cursor.position = position
+        cursor.updated_at = datetime.now(timezone.utc)
+        db.session.add(cursor)
+    
+    def __repr__(self):
+        return f'<ScanCursor {self.name}: {self.position}>'
+
+class AccessEvent(db.Model):
+    __tablename__ = 'access_events'
+    __table_args__ = (
+        db.Index('ix_access_events_share_time', 'share_id', 'occurred_at'),
+    )
+    
+    # Append-only download history, written in bulk by analytics.AccessLog.
+    # No foreign keys: the history outlives the shares the reaper deletes
+    id = db.Column(db.Integer, primary_key=True)
+    share_id = db.Column(db.Integer, nullable=False)
+    file_id = db.Column(CompactID, nullable=False)
+    owner_id = db.Column(db.Integer, nullable=False)
+    occurred_at = db.Column(db.DateTime, nullable=False, index=True)
+    ip = db.Column(db.String(45), nullable=True)
+    status = db.Column(db.SmallInteger, nullable=False)
+    bytes_sent = db.Column(db.BigInteger, nullable=False, default=0)
+    range_header = db.Column(db.String(100), nullable=True)
+    user_agent = db.Column(db.String(255), nullable=True)
+    # Whether this request counted a download rather than continuing one
+    counted = db.Column(db.Boolean, nullable=False, default=False)
+    
+    def __repr__(self):
+        return f'<AccessEvent {self.share_id} at {self.occurred_at}>'
+
+class ShareAccessHourly(db.Model):
+    __tablename__ = 'share_access_hourly'
+    
+    # Per-share totals of access_events by hour, kept up to date as events are written
+    share_id = db.Column(db.Integer, primary_key=True)
+    hour = db.Column(db.DateTime, primary_key=True)
+    requests = db.Column(db.Integer, nullable=False, default=0)
+    downloads = db.Column(db.Integer, nullable=False, default=0)
+    bytes_sent = db.Column(db.BigInteger, nullable=False, default=0)
+    
+    @classmethod
+    def add(cls, share_id, hour, requests, downloads, bytes_sent):
+        """Add to one share's totals for an hour, creating the row on first use"""
+        stmt = (
+            db.update(cls)
+            .where(cls.share_id == share_id, cls.hour == hour)
+            .values(requests=cls.requests + requests, downloads=cls.downloads + downloads,
+                    bytes_sent=cls.bytes_sent + bytes_sent)
+        )
+        if db.session.execute(stmt).rowcount:
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.execute(db.insert(cls).values(share_id=share_id, hour=hour, requests=requests,
+                                                         downloads=downloads, bytes_sent=bytes_sent))
+        except IntegrityError:
+            # Another writer created the row first
+            db.session.execute(stmt)
+    
+    @classmethod
+    def recent(cls, share_ids, hours=24):
+        """Downloads and bytes per share over the last ``hours`` hours, as {share_id: (downloads, bytes)}"""
+        if not share_ids:
+            return {}
+        since = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+        rows = db.session.execute(
+            db.select(cls.share_id, db.func.sum(cls.downloads), db.func.sum(cls.bytes_sent))
+            .where(cls.share_id.in_(list(share_ids)), cls.hour >= since)
+            .group_by(cls.share_id)
+        ).all()
+        return {share_id: (downloads, nbytes) for share_id, downloads, nbytes in rows}
+    
+    def __repr__(self):
+        return f'<ShareAccessHourly {self.share_id} {self.hour}>'
+
+class ShareSnapshot(ShareAccessMixin):
+    """Detached, serializable copy of the FileShare fields the download pages use"""
+    
+    FIELDS = (
+        'id', 'file_id', 'original_filename', 'file_size', 'sha256', 'mime_type', 'storage_key', 'wrapped_key',
+        'content_encoding', 'stored_size',
+        'password_hash', 'download_limit', 'download_count', 'expires_at',
+        'user_id', 'created_at', 'last_accessed'
+    )
+    DATETIME_FIELDS = ('expires_at', 'created_at', 'last_accessed')
+    BINARY_FIELDS = ('wrapped_key',)
+    
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+    
+    @classmethod
+    def from_share(cls, file_share):
+        return cls(**{name: getattr(file_share, name) for name in cls.FIELDS})
+    
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        for name in self.DATETIME_FIELDS:
+            if data[name] is not None:
+                data[name] = data[name].isoformat()
+        for name in self.BINARY_FIELDS:
+            if data[name] is not None:
+                data[name] = base64.b64encode(data[name]).decode('ascii')
+        return data
+    
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        for name in cls.DATETIME_FIELDS:
+            if data.get(name) is not None:
+                data[name] = datetime.fromisoformat(data[name])
+        for name in cls.BINARY_FIELDS:
+            if data.get(name) is not None:
+                data[name] = base64.b64decode(data[name])
+        return cls(**data)
+    
+    def __repr__(self):
+        return f'<ShareSnapshot {self.file_id}>'
+
@@ -0,0 +1,114 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from metrics import observe_password_verify
+
+# Full parameter strings for Werkzeug's methods, so "scrypt" in the config
+# and "scrypt:32768:8:1" in a stored hash compare equal
+WERKZEUG_DEFAULTS = {
+    'scrypt': 'scrypt:32768:8:1',
+    'pbkdf2': 'pbkdf2:sha256:1000000',
+}
+
+# argon2id time cost, memory cost (KiB) and parallelism when unspecified
+ARGON2_DEFAULTS = (3, 65536, 4)
+
+
+class VerificationBusy(Exception):
+    """Raised when the verification pool has no free slot"""
+
+
+def normalize_method(method):
+    """Expand a configured hashing method to its full parameter string"""
+    method = (method or 'scrypt').strip()
+    if method == 'argon2':
+        return 'argon2:{}:{}:{}'.format(*ARGON2_DEFAULTS)
+    return WERKZEUG_DEFAULTS.get(method, method)
+
+
+def _argon2_hasher(method):
+    from argon2 import PasswordHasher
+
+    _, time_cost, memory_cost, parallelism = method.split(':')
+    return PasswordHasher(time_cost=int(time_cost), memory_cost=int(memory_cost),
+                          parallelism=int(parallelism))
+
+
+def hash_password(password, method=None):
+    """Hash a password with the configured method (Werkzeug formats or argon2)"""
+    method = normalize_method(method or current_app.config['PASSWORD_HASH_METHOD'])
+    if method.startswith('argon2'):
+        return _argon2_hasher(method).hash(password)
+    return generate_password_hash(password, method=method)
+
+
+def _check(pwhash, password):
+    if pwhash.startswith('$argon2'):
+        from argon2.exceptions import VerificationError, InvalidHashError
+
+        try:
+            return _argon2_hasher(normalize_method('argon2')).verify(pwhash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    return check_password_hash(pwhash, password)
+
+
+def _timed_check(pwhash, password):
+    started = time.perf_counter()
+    try:
+        return _check(pwhash, password)
+    finally:
+        observe_password_verify(pwhash, time.perf_counter() - started)
+
+
+def needs_rehash(pwhash, method=None):
+    """Check if a stored hash was made with different parameters than configured"""
+    method = normalize_method(method or current_app.config['PASSWORD_HASH_METHOD'])
+    if method.startswith('argon2'):
+        if not pwhash.startswith('$argon2'):
+            return True
+        return _argon2_hasher(method).check_needs_rehash(pwhash)
+    return pwhash.split('$', 1)[0] != method
+
+
+class VerificationPool:
+    """Bounded pool that runs hash verifications off the request thread
+
+    At most ``workers`` hashes run at once per process and at most
+    ``queue_size`` wait; further callers get VerificationBusy instead of
+    piling up and starving download serving of CPU.
+    """
+
+    def __init__(self, workers, queue_size):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pwverify')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def verify(self, pwhash, password, timeout=None):
+        if not self._slots.acquire(blocking=False):
+            raise VerificationBusy()
+        try:
+            return self._executor.submit(_timed_check, pwhash, password).result(timeout=timeout)
+        finally:
+            self._slots.release()
+
+
+def get_verification_pool():
+    pool = current_app.extensions.get('password_pool')
+    if pool is None:
+        pool = VerificationPool(
+            workers=current_app.config['PASSWORD_VERIFY_WORKERS'],
+            queue_size=current_app.config['PASSWORD_VERIFY_QUEUE']
+        )
+        current_app.extensions['password_pool'] = pool
+    return pool
+
+
+def verify_password(pwhash, password):
+    """Verify a password on the bounded pool; raises VerificationBusy when saturated"""
+    if not pwhash:
+        return False
+    return get_verification_pool().verify(pwhash, password)
@@ -0,0 +1,115 @@
+"""Preview rendering, run in the preview worker processes
+
+Nothing here touches the app, the database or storage: each renderer
+reads a local source file and writes one derivative, so the functions can
+run in a process pool started with the spawn method. Renderers need
+optional tools and say so with PreviewUnavailable when they are missing:
+
+    image   thumbnails of PNG, JPEG and GIF files (Pillow)
+    pdf     the first page of a PDF (pdftoppm, from poppler-utils)
+    video   a poster frame one second in (ffmpeg)
+    text    the first lines of a text file (nothing)
+"""
+import os
+import subprocess
+
+# Detected MIME type to the renderer that handles it
+PREVIEW_KINDS = {
+    'image/png': 'image',
+    'image/jpeg': 'image',
+    'image/gif': 'image',
+    'application/pdf': 'pdf',
+    'video/mp4': 'video',
+    'video/quicktime': 'video',
+    'video/x-msvideo': 'video',
+    'text/plain': 'text',
+}
+
+# Bytes of a text file read for its snippet, and lines kept
+TEXT_SNIPPET_BYTES = 4096
+TEXT_SNIPPET_LINES = 40
+
+
+class PreviewUnavailable(Exception):
+    """No preview can be made for this file here (a tool is missing or the file is unusable)"""
+
+
+def _run(args, timeout):
+    try:
+        subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE, timeout=timeout, check=True)
+    except FileNotFoundError:
+        raise PreviewUnavailable(f'{args[0]} is not installed')
+    except subprocess.CalledProcessError as e:
+        raise PreviewUnavailable(f'{args[0]} failed: {e.stderr.decode(errors="replace").strip()[-200:]}')
+
+
+def render_image(source_path, target_path, size, timeout):
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        raise PreviewUnavailable('Pillow is not installed')
+    try:
+        with Image.open(source_path) as image:
+            # JPEG decoders can scale down while decoding, far cheaper than resizing after
+            image.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((size, size))
+            if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+                image.convert('RGBA').save(target_path, 'PNG', optimize=True)
+                return 'image/png'
+            image.convert('RGB').save(target_path, 'JPEG', quality=80, optimize=True)
+            return 'image/jpeg'
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise PreviewUnavailable(f'unreadable image: {str(e)}')
+
+
+def render_pdf(source_path, target_path, size, timeout):
+    # pdftoppm appends the extension to the output name it is given
+    base = target_path + '.page'
+    _run(['pdftoppm', '-f', '1', '-l', '1', '-singlefile', '-jpeg', '-scale-to', str(size),
+          source_path, base], timeout)
+    os.replace(base + '.jpg', target_path)
+    return 'image/jpeg'
+
+
+def render_video(source_path, target_path, size, timeout):
+    scale = f'scale={size}:{size}:force_original_aspect_ratio=decrease'
+    # One second in skips black lead-in frames; clips shorter than that use their first frame
+    for offset in ('1', '0'):
+        _run(['ffmpeg', '-v', 'error', '-y', '-ss', offset, '-i', source_path, '-frames:v', '1',
+              '-vf', scale, '-f', 'image2', '-c:v', 'mjpeg', target_path], timeout)
+        if os.path.exists(target_path) and os.path.getsize(target_path):
+            return 'image/jpeg'
+    raise PreviewUnavailable('no video frame found')
+
+
+def render_text(source_path, target_path, size, timeout):
+    with open(source_path, 'rb') as f:
+        head = f.read(TEXT_SNIPPET_BYTES + 1)
+    truncated = len(head) > TEXT_SNIPPET_BYTES
+    head = head[:TEXT_SNIPPET_BYTES]
+    if head.startswith((b'\xff\xfe', b'\xfe\xff')):
+        text = head.decode('utf-16', errors='replace')
+    else:
+        text = head.decode('utf-8-sig', errors='replace')
+    lines = text.splitlines()
+    # Drop a line cut off by the byte limit
+    if truncated and len(lines) > 1:
+        lines.pop()
+    with open(target_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines[:TEXT_SNIPPET_LINES]) + '\n')
+    return 'text/plain'
+
+
+RENDERERS = {
+    'image': render_image,
+    'pdf': render_pdf,
+    'video': render_video,
+    'text': render_text,
+}
+
+
+def render(kind, source_path, target_path, size, timeout):
+    """Render a derivative of ``kind`` into target_path; returns its content type"""
+    return RENDERERS[kind](source_path, target_path, size, timeout)
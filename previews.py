@@ -0,0 +1,419 @@
+"""Background preview generation for /info/<file_id>
+
+After an upload commits, its blob is queued for a preview: a row in a
+SQLite file on this host (PREVIEW_QUEUE_PATH), written in well under a
+millisecond and never waited on otherwise, so no broker is needed and
+the upload response does not depend on it. Workers claim jobs from that
+file, fetch the plaintext of the blob, and render a thumbnail, first PDF
+page, video poster frame or text snippet (see previewrender) in a pool of
+PREVIEW_WORKERS processes. The derivative is stored next to its blob
+under ab/cd/<sha256>.preview.<suffix>, encrypted like the blob, recorded
+in the previews table and removed with the blob.
+
+Workers run either in each web process (PREVIEW_WORKERS > 0, started on
+the first upload) or as `flask --app main previews work`. Claims are
+leases, so jobs of a worker that dies are picked up again; files whose
+preview cannot be made (a missing tool, a corrupt file) are set aside
+with their error, and `flask --app main previews backfill --retry-failed`
+queues them, and every stored file without a preview, again.
+"""
+import multiprocessing
+import os
+import secrets
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from models import Blob, FileShare, Preview
+from blobstore import sharded_key
+from compression import select_representation
+from encryption import encrypt_staged_file, open_for_reading
+from previewrender import PREVIEW_KINDS, TEXT_SNIPPET_BYTES, PreviewUnavailable, render
+from storage import get_storage
+from utils import get_file_mime_type
+
+# Seconds an idle worker waits before looking for jobs again
+POLL_INTERVAL = 2.0
+# Attempts before a job that keeps failing is set aside, and the delay before the first retry
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS preview_jobs (
+    id INTEGER PRIMARY KEY,
+    sha256 TEXT NOT NULL UNIQUE,
+    mime_type TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_preview_jobs_run_after ON preview_jobs (run_after);
+"""
+
+PreviewJob = namedtuple('PreviewJob', 'id sha256 mime_type attempts')
+
+
+def preview_key(sha256):
+    """New storage key for a blob's preview, in the same shard as the blob"""
+    return sharded_key(f'{sha256}.preview.{secrets.token_hex(4)}')
+
+
+class PreviewQueue:
+    """Preview jobs in a SQLite file shared by the processes on this host
+
+    A job is claimed by moving its run_after past a lease, so claiming
+    needs no lock beyond SQLite's own and a crashed worker's jobs come
+    due again. Set-aside jobs keep their error and a NULL run_after.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        # Connections must not cross a fork
+        os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def put(self, jobs, retry_failed=False):
+        """Queue (sha256, mime_type) pairs; blobs already queued are left as they are"""
+        conflict = ('DO UPDATE SET run_after = excluded.run_after, attempts = 0, error = NULL '
+                    'WHERE preview_jobs.run_after IS NULL') if retry_failed else 'DO NOTHING'
+        now = time.time()
+        self._connection().executemany(
+            f'INSERT INTO preview_jobs (sha256, mime_type, run_after) VALUES (?, ?, ?) '
+            f'ON CONFLICT (sha256) {conflict}',
+            [(sha256, mime_type, now) for sha256, mime_type in jobs]
+        )
+
+    def claim(self, limit, lease):
+        """Take up to ``limit`` due jobs for ``lease`` seconds"""
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                'SELECT id, sha256, mime_type, attempts FROM preview_jobs '
+                'WHERE run_after <= ? ORDER BY run_after LIMIT ?', (now, limit)
+            ).fetchall()
+            connection.executemany(
+                'UPDATE preview_jobs SET run_after = ?, attempts = attempts + 1 WHERE id = ?',
+                [(now + lease, row[0]) for row in rows]
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return [PreviewJob(job_id, sha256, mime_type, attempts + 1) for job_id, sha256, mime_type, attempts in rows]
+
+    def done(self, job):
+        self._connection().execute('DELETE FROM preview_jobs WHERE id = ?', (job.id,))
+
+    def fail(self, job, error, permanent=False):
+        """Retry the job later with exponential backoff, or set it aside"""
+        if permanent or job.attempts >= MAX_ATTEMPTS:
+            run_after = None
+        else:
+            run_after = time.time() + RETRY_DELAY * 2 ** (job.attempts - 1)
+        self._connection().execute('UPDATE preview_jobs SET run_after = ?, error = ? WHERE id = ?',
+                                   (run_after, str(error)[:500], job.id))
+
+    def counts(self):
+        queued, failed = self._connection().execute(
+            'SELECT COUNT(run_after), COUNT(*) - COUNT(run_after) FROM preview_jobs'
+        ).fetchone()
+        return {'queued': queued, 'failed': failed}
+
+
+def _fetch_source(job, workdir, max_bytes):
+    """Local path of the plaintext to render, or None when the job has nothing to do"""
+    share = db.session.execute(
+        db.select(FileShare).where(FileShare.sha256 == job.sha256).limit(1)
+    ).scalar()
+    if share is None or db.session.get(Preview, job.sha256) is not None:
+        return None
+    kind = PREVIEW_KINDS[job.mime_type]
+    length = min(share.file_size, TEXT_SNIPPET_BYTES + 1) if kind == 'text' else share.file_size
+    if length > max_bytes:
+        raise PreviewUnavailable(f'larger than {max_bytes} bytes')
+
+    storage = get_storage()
+    if not share.wrapped_key and not share.content_encoding:
+        # Plain blobs on local disk are rendered where they are
+        path = storage.local_path(share.storage_key)
+        if path:
+            return os.path.abspath(path)
+    view = select_representation(open_for_reading(storage, share), share, None, None)[0]
+    path = os.path.join(workdir, f'{job.id}.source')
+    with open(path, 'wb') as f:
+        for block in view.get_range_stream(share.storage_key, 0, length):
+            f.write(block)
+    return path
+
+
+def store_preview(sha256, path, content_type):
+    """Encrypt and store a rendered derivative and record it; the file at path is consumed"""
+    if db.session.get(Blob, sha256) is None:
+        # The blob was deleted while its preview was being made
+        return
+    size = os.path.getsize(path)
+    wrapped_key = encrypt_staged_file(path, size)
+    key = preview_key(sha256)
+    storage = get_storage()
+    storage.put_file(key, path)
+    try:
+        with db.session.begin_nested():
+            db.session.add(Preview(sha256=sha256, storage_key=key, wrapped_key=wrapped_key,
+                                   content_type=content_type, size=size))
+        db.session.commit()
+    except IntegrityError:
+        # Another worker stored one first, or the blob has just gone
+        db.session.rollback()
+        storage.delete(key)
+
+
+class PreviewWorker:
+    """Claims preview jobs and renders them in a pool of processes
+
+    Fetching sources and storing results happen on the calling thread,
+    which needs an app context; only rendering goes to the pool. The pool
+    uses the spawn method so its processes inherit none of the app's
+    threads, locks or connections.
+    """
+
+    def __init__(self, app, queue, workers):
+        self.app = app
+        self.queue = queue
+        self.workers = workers
+        self._wake = threading.Event()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._thread = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def run_once(self):
+        """Claim one round of jobs and finish them; returns how many were claimed"""
+        config = self.app.config
+        timeout = config['PREVIEW_TIMEOUT']
+        # Long enough to fetch, render and store, so a live worker keeps its jobs
+        jobs = self.queue.claim(self.workers * 2, lease=timeout * 4)
+        if not jobs:
+            return 0
+        workdir = tempfile.mkdtemp(prefix='sfv-preview-')
+        try:
+            futures = {}
+            for job in jobs:
+                try:
+                    source = _fetch_source(job, workdir, config['PREVIEW_MAX_SOURCE_BYTES'])
+                except Exception as e:
+                    db.session.rollback()
+                    self._failed(job, e)
+                    continue
+                if source is None:
+                    self.queue.done(job)
+                    continue
+                target = os.path.join(workdir, f'{job.id}.preview')
+                future = self._get_pool().submit(render, PREVIEW_KINDS[job.mime_type], source, target,
+                                                 config['PREVIEW_SIZE'], timeout)
+                futures[future] = (job, target)
+
+            for future in as_completed(futures):
+                job, target = futures[future]
+                try:
+                    store_preview(job.sha256, target, future.result())
+                    self.queue.done(job)
+                except BrokenProcessPool as e:
+                    # A renderer crashed the process; start a fresh pool for the next round
+                    self._pool = None
+                    self._failed(job, e)
+                except Exception as e:
+                    db.session.rollback()
+                    self._failed(job, e)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        return len(jobs)
+
+    def _failed(self, job, error):
+        permanent = isinstance(error, PreviewUnavailable)
+        log = self.app.logger.info if permanent else self.app.logger.warning
+        log(f"Preview of {job.sha256[:12]} failed (attempt {job.attempts}): {str(error)}")
+        self.queue.fail(job, error, permanent=permanent)
+
+    def run(self, until_idle=False):
+        """Work through jobs as they come due; with until_idle, return once none are left"""
+        while True:
+            with self.app.app_context():
+                try:
+                    claimed = self.run_once()
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.error(f"Preview worker error: {str(e)}")
+                    claimed = 0
+            if claimed:
+                continue
+            if until_idle:
+                return
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+
+    def start(self):
+        """Run in a daemon thread of this process, if it is not already"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='preview-worker', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+
+def get_preview_queue():
+    """Return the application's PreviewQueue, or None when previews are off"""
+    extensions = current_app.extensions
+    if 'preview_queue' not in extensions:
+        config = current_app.config
+        extensions['preview_queue'] = PreviewQueue(config['PREVIEW_QUEUE_PATH']) if config['PREVIEWS_ENABLED'] else None
+    return extensions['preview_queue']
+
+
+def _in_process_worker(queue):
+    extensions = current_app.extensions
+    if 'preview_worker' not in extensions:
+        workers = current_app.config['PREVIEW_WORKERS']
+        extensions['preview_worker'] = PreviewWorker(
+            current_app._get_current_object(), queue, workers) if workers > 0 else None
+    return extensions['preview_worker']
+
+
+def queue_previews(items):
+    """Queue previews for newly stored (sha256, mime_type) pairs; call after committing
+
+    Types nothing can be rendered for are skipped. A failure is logged
+    and otherwise ignored, so it never fails the upload.
+    """
+    queue = get_preview_queue()
+    if queue is None:
+        return
+    jobs = {sha256: mime_type for sha256, mime_type in items if mime_type in PREVIEW_KINDS}
+    if not jobs:
+        return
+    try:
+        queue.put(jobs.items())
+    except sqlite3.Error as e:
+        current_app.logger.error(f"Could not queue previews: {str(e)}")
+        return
+    worker = _in_process_worker(queue)
+    if worker is not None:
+        worker.start()
+        worker.wake()
+
+
+def queue_preview(share):
+    queue_previews([(share.sha256, share.mime_type)])
+
+
+def backfill(batch_size=500, retry_failed=False):
+    """Queue every stored file of a previewable type that has no preview yet"""
+    queue = get_preview_queue()
+    if queue is None:
+        return 0
+    queued = 0
+    after = ''
+    while True:
+        rows = db.session.execute(
+            db.select(FileShare.sha256, db.func.max(FileShare.mime_type), db.func.max(FileShare.original_filename))
+            .where(FileShare.sha256 > after,
+                   ~db.select(Preview.sha256).where(Preview.sha256 == FileShare.sha256).exists())
+            .group_by(FileShare.sha256)
+            .order_by(FileShare.sha256)
+            .limit(batch_size)
+        ).all()
+        db.session.rollback()
+        if not rows:
+            return queued
+        after = rows[-1][0]
+        # Shares from before content sniffing have no stored type
+        jobs = [(sha256, mime_type or get_file_mime_type(filename)) for sha256, mime_type, filename in rows]
+        jobs = [(sha256, mime_type) for sha256, mime_type in jobs if mime_type in PREVIEW_KINDS]
+        queue.put(jobs, retry_failed=retry_failed)
+        queued += len(jobs)
+
+
+@click.group('previews')
+def previews_cli():
+    """Preview generation"""
+
+
+@previews_cli.command('work')
+@click.option('--workers', type=int, default=None,
+              help='Rendering processes (default: PREVIEW_WORKERS, or one per CPU).')
+@click.option('--until-idle', is_flag=True, help='Exit once no jobs are due.')
+@with_appcontext
+def work_command(workers, until_idle):
+    """Render queued previews"""
+    queue = get_preview_queue()
+    if queue is None:
+        raise click.ClickException('Previews are disabled (PREVIEWS_ENABLED=0)')
+    workers = workers or current_app.config['PREVIEW_WORKERS'] or os.cpu_count() or 1
+    worker = PreviewWorker(current_app._get_current_object(), queue, workers)
+    try:
+        worker.run(until_idle=until_idle)
+    finally:
+        worker.close()
+    click.echo(queue.counts())
+
+
+@previews_cli.command('backfill')
+@click.option('--batch-size', type=int, default=500, help='Files queued per batch.')
+@click.option('--retry-failed', is_flag=True, help='Also queue files whose preview failed before.')
+@with_appcontext
+def backfill_command(batch_size, retry_failed):
+    """Queue previews for stored files that have none"""
+    click.echo({'queued': backfill(batch_size=batch_size, retry_failed=retry_failed)})
+
+
+@previews_cli.command('status')
+@with_appcontext
+def status_command():
+    """Show how many preview jobs are queued and set aside"""
+    queue = get_preview_queue()
+    if queue is None:
+        raise click.ClickException('Previews are disabled (PREVIEWS_ENABLED=0)')
+    click.echo(queue.counts())
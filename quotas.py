@@ -0,0 +1,96 @@
+"""Per-user storage and egress quotas
+
+Usage lives in the UserStats counters, so enforcing a quota is a primary
+key read before an upload streams and one conditional UPDATE when the
+bytes are claimed; nothing sums over file_shares. Quotas are in bytes and
+0 means unlimited. Users get STORAGE_QUOTA_BYTES / EGRESS_QUOTA_BYTES
+unless `flask --app main quota` gives them their own.
+"""
+from datetime import datetime, timezone
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app import db
+
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+class QuotaExceeded(Exception):
+    """A transfer would take a user over one of their quotas"""
+
+    def __init__(self, kind):
+        super().__init__(f'{kind} quota exceeded')
+        self.kind = kind
+
+
+def default_storage_quota():
+    return current_app.config['STORAGE_QUOTA_BYTES']
+
+
+def default_egress_quota():
+    return current_app.config['EGRESS_QUOTA_BYTES']
+
+
+def egress_period(now=None):
+    """Number identifying the EGRESS_QUOTA_PERIOD (day, week or month) containing ``now``"""
+    now = now or datetime.now(timezone.utc)
+    unit = current_app.config['EGRESS_QUOTA_PERIOD']
+    if unit == 'day':
+        return now.toordinal()
+    if unit == 'week':
+        # Ordinal 1 is a Monday, so weeks run Monday to Sunday
+        return (now.toordinal() - 1) // 7
+    if unit == 'month':
+        return now.year * 12 + now.month - 1
+    raise ValueError(f'EGRESS_QUOTA_PERIOD must be day, week or month, not {unit!r}')
+
+
+def parse_size(value):
+    """Parse '500M', '10g' or '1048576' into bytes"""
+    value = value.strip().lower().removesuffix('b').removesuffix('i')
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def usage(stats):
+    """Current usage and effective quotas from a UserStats row"""
+    storage_quota = stats.storage_quota if stats.storage_quota is not None else default_storage_quota()
+    egress_quota = stats.egress_quota if stats.egress_quota is not None else default_egress_quota()
+    return {
+        'stored_bytes': stats.total_bytes,
+        'reserved_bytes': stats.reserved_bytes,
+        'storage_quota': storage_quota or None,
+        'egress_bytes': stats.egress_bytes if stats.egress_period == egress_period() else 0,
+        'egress_quota': egress_quota or None,
+        'egress_period': current_app.config['EGRESS_QUOTA_PERIOD'],
+    }
+
+
+def _quota_option(value):
+    if value is None:
+        return None
+    if value == 'default':
+        return 'default'
+    return parse_size(value)
+
+
+@click.command('quota')
+@click.argument('username')
+@click.option('--storage', help='Storage quota, e.g. 10G; 0 for unlimited, "default" for the app-wide value.')
+@click.option('--egress', help='Egress quota per period, e.g. 100G; 0 for unlimited, "default" for the app-wide value.')
+@with_appcontext
+def quota_command(username, storage, egress):
+    """Show a user's usage and quotas, optionally setting their own quotas"""
+    from models import User, UserStats
+
+    user = db.session.execute(db.select(User).where(User.username == username)).scalar_one_or_none()
+    if user is None:
+        raise click.ClickException(f'No user named {username!r}')
+    stats = UserStats.for_user(user.id)
+    for name, value in (('storage_quota', _quota_option(storage)), ('egress_quota', _quota_option(egress))):
+        if value is not None:
+            setattr(stats, name, None if value == 'default' else value)
+    db.session.commit()
+    click.echo(usage(stats))
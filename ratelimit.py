@@ -0,0 +1,212 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_rate(value):
+    """Parse '20/minute' into (limit, period_seconds)"""
+    count, _, period = value.partition('/')
+    return int(count), PERIODS[period.strip().rstrip('s') or 'second']
+
+
+class TokenBucketLimiter:
+    """In-memory token buckets keyed by an arbitrary string
+
+    Each key refills at ``limit / period`` tokens per second up to
+    ``limit``. Idle keys are evicted LRU-first beyond ``maxsize``.
+    A decision is a dict lookup and some arithmetic under a lock.
+    """
+
+    def __init__(self, limit, period, maxsize=100000):
+        self.capacity = float(limit)
+        self.refill_rate = limit / period
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _tokens(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - updated) * self.refill_rate)
+
+    def _store(self, key, tokens, now):
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+
+    def allow(self, key, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._tokens(key, now)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._store(key, tokens, now)
+            return allowed
+
+    def exhausted(self, key, cost=1):
+        """Whether allow(key, cost) would refuse right now, without spending anything"""
+        with self._lock:
+            return self._tokens(key, time.monotonic()) < cost
+
+    def reserve(self, key, cost):
+        """Spend ``cost`` tokens even if that runs the bucket into debt
+
+        Returns the seconds until the debt is paid back, 0 if there is none.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._tokens(key, now) - cost
+            self._store(key, tokens, now)
+        return max(0.0, -tokens / self.refill_rate)
+
+    def delay(self, key):
+        """Seconds until the key is out of debt"""
+        with self._lock:
+            tokens = self._tokens(key, time.monotonic())
+        return max(0.0, -tokens / self.refill_rate)
+
+
+class SlidingWindowLimiter:
+    """Sliding-window counters in a shared store, so every worker sees the same counts
+
+    The window is approximated from two fixed windows: the current
+    window's count plus the previous one's, weighted by how much of it
+    still overlaps. Refused requests are counted too, so a client that
+    keeps hammering stays refused. One pipelined round trip per decision;
+    if the store is unreachable the limiter fails open.
+    """
+
+    def __init__(self, store, name, limit, period):
+        self.store = store
+        self.limit = limit
+        self.period = period
+        self.prefix = f'ratelimit:{name}:'
+
+    def _window(self, key):
+        now = time.time()
+        window = int(now // self.period)
+        elapsed = (now % self.period) / self.period
+        return f'{self.prefix}{key}:{window}', f'{self.prefix}{key}:{window - 1}', elapsed
+
+    def _estimate(self, current, previous, elapsed):
+        return int(previous or 0) * (1 - elapsed) + int(current or 0)
+
+    def allow(self, key, cost=1):
+        current_key, previous_key, elapsed = self._window(key)
+        try:
+            current, _, previous = (
+                self.store.pipeline()
+                .incrby(current_key, cost)
+                .expire(current_key, 2 * self.period)
+                .get(previous_key)
+                .execute()
+            )
+        except Exception as e:
+            current_app.logger.warning(f"Rate limit store failed: {str(e)}")
+            return True
+        return self._estimate(current, previous, elapsed) <= self.limit
+
+    def exhausted(self, key, cost=1):
+        """Whether allow(key, cost) would refuse right now, without counting anything"""
+        current_key, previous_key, elapsed = self._window(key)
+        try:
+            current, previous = self.store.mget([current_key, previous_key])
+        except Exception as e:
+            current_app.logger.warning(f"Rate limit store failed: {str(e)}")
+            return False
+        return self._estimate(current, previous, elapsed) + cost > self.limit
+
+
+def get_shared_store():
+    """The RATE_LIMIT_URL store (redis:// or fake://), or None to count in process"""
+    extensions = current_app.extensions
+    if 'rate_limit_store' not in extensions:
+        from cache import connect_shared_backend
+        extensions['rate_limit_store'] = connect_shared_backend(current_app.config['RATE_LIMIT_URL'],
+                                                                'RATE_LIMIT_URL')
+    return extensions['rate_limit_store']
+
+
+def get_limiter(name):
+    """Return the limiter configured as RATE_LIMITS[name], creating it on first use
+
+    With a shared store every worker counts against the same sliding
+    windows; otherwise each process keeps its own token buckets.
+    """
+    limiters = current_app.extensions.setdefault('rate_limiters', {})
+    limiter = limiters.get(name)
+    if limiter is None:
+        limit, period = parse_rate(current_app.config['RATE_LIMITS'][name])
+        store = get_shared_store()
+        if store is not None:
+            limiter = SlidingWindowLimiter(store, name, limit, period)
+        else:
+            limiter = TokenBucketLimiter(limit, period)
+        limiters[name] = limiter
+    return limiter
+
+
+def verification_allowed(client_ip, target):
+    """Spend one password-verification token for the client IP and the target
+
+    ``target`` names what is being guessed ('file:<id>' or 'user:<name>'),
+    so a distributed attack on one link is capped as well as one noisy IP.
+    """
+    return (get_limiter('verify_per_ip').allow(client_ip or 'unknown')
+            and get_limiter('verify_per_target').allow(target))
+
+
+def request_allowed(name, key):
+    """Spend one token of the RATE_LIMITS[name] limit for ``key``"""
+    return get_limiter(name).allow(key or 'unknown')
+
+
+def lookup_allowed(client_ip):
+    """Whether the client may look up another share or collection ID
+
+    Clients that keep asking for IDs that do not exist are refused before
+    the lookup, so enumerating the ID space costs neither a cache entry
+    nor a query.
+    """
+    return not get_limiter('missing_per_ip').exhausted(client_ip or 'unknown')
+
+
+def record_missing(client_ip):
+    """Count a lookup of an ID that does not exist against the client"""
+    get_limiter('missing_per_ip').allow(client_ip or 'unknown')
+
+
+def get_egress_shaper():
+    """Per-share byte buckets refilling at SHARE_EGRESS_RATE, or None when shaping is off"""
+    extensions = current_app.extensions
+    if 'egress_shaper' not in extensions:
+        rate = current_app.config['SHARE_EGRESS_RATE']
+        burst = current_app.config['SHARE_EGRESS_BURST'] or rate
+        extensions['egress_shaper'] = TokenBucketLimiter(burst, burst / rate) if rate else None
+    return extensions['egress_shaper']
+
+
+def egress_retry_after(file_id):
+    """Seconds a new transfer of the share has to wait, or 0 if it may start now
+
+    A hot link that is more than SHARE_EGRESS_MAX_DELAY seconds of its
+    SHARE_EGRESS_RATE behind is turned away instead of holding a worker.
+    """
+    shaper = get_egress_shaper()
+    if shaper is None:
+        return 0
+    delay = shaper.delay(file_id)
+    return math.ceil(delay) if delay > current_app.config['SHARE_EGRESS_MAX_DELAY'] else 0
+
+
+def shape_egress(shaper, file_id, nbytes):
+    """Count bytes sent from a share; returns how long the sender should pause"""
+    if shaper is None or not nbytes:
+        return 0.0
+    return shaper.reserve(file_id, nbytes)
@@ -0,0 +1,174 @@
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app import db
+from models import FileShare, UploadSession, UserStats
+from blobstore import release_blobs, remove_blob
+from cache import invalidate_share
+
+# Metrics from the most recent run in this process
+last_run = {}
+
+
+def reap_shares(condition, order_by, batch_size, max_batches, totals):
+    """Delete shares matching an indexed condition, one bounded batch at a time"""
+    for _ in range(max_batches):
+        # Walk the index in order and lock nothing beyond one small batch
+        rows = db.session.execute(
+            db.select(FileShare.id, FileShare.sha256)
+            .where(condition)
+            .order_by(order_by)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+
+        # RETURNING reports only rows this transaction deleted, so two
+        # reapers racing on the same batch never release a blob twice
+        deleted = db.session.execute(
+            db.delete(FileShare)
+            .where(FileShare.id.in_([row.id for row in rows]))
+            .returning(FileShare.file_id, FileShare.sha256, FileShare.file_size, FileShare.user_id,
+                       FileShare.download_count, FileShare.exhausted_at)
+            .execution_options(synchronize_session=False)
+        ).all()
+        keys, blob_bytes = release_blobs(Counter(row.sha256 for row in deleted))
+
+        per_user = {}
+        for row in deleted:
+            stats = per_user.setdefault(row.user_id, Counter())
+            stats['file_count'] -= 1
+            stats['total_bytes'] -= row.file_size
+            stats['total_downloads'] -= row.download_count or 0
+            stats['exhausted_count'] -= int(row.exhausted_at is not None)
+        for user_id, deltas in per_user.items():
+            UserStats.adjust(user_id, **deltas)
+        db.session.commit()
+        invalidate_share(*[row.file_id for row in deleted])
+
+        for key in keys:
+            remove_blob(key)
+
+        totals['batches'] += 1
+        totals['shares_deleted'] += len(deleted)
+        totals['share_bytes'] += sum(row.file_size for row in deleted)
+        totals['blobs_deleted'] += len(keys)
+        totals['bytes_reclaimed'] += blob_bytes
+
+        if len(rows) < batch_size:
+            break
+
+
+def _reap_upload_sessions(cutoff, batch_size, max_batches, totals):
+    """Remove resumable uploads that have not received a chunk since cutoff"""
+    for _ in range(max_batches):
+        uploads = db.session.execute(
+            db.select(UploadSession)
+            .where(UploadSession.updated_at <= cutoff)
+            .order_by(UploadSession.updated_at)
+            .limit(batch_size)
+        ).scalars().all()
+        if not uploads:
+            break
+
+        reserved = Counter()
+        for upload in uploads:
+            try:
+                os.remove(upload.file_path)
+                totals['bytes_reclaimed'] += upload.upload_offset
+            except FileNotFoundError:
+                pass
+            reserved[upload.user_id] += upload.upload_length
+            db.session.delete(upload)
+        # Give the abandoned uploads' space back to their owners' quotas
+        for user_id, length in reserved.items():
+            UserStats.adjust(user_id, reserved_bytes=-length)
+        db.session.commit()
+
+        totals['batches'] += 1
+        totals['uploads_deleted'] += len(uploads)
+
+        if len(uploads) < batch_size:
+            break
+
+
+def reap(batch_size=None, max_batches=None):
+    """Delete expired and exhausted shares and abandoned uploads
+
+    Every query is a range scan on an indexed timestamp (expires_at,
+    exhausted_at, upload_sessions.updated_at), so the cost of a run is
+    proportional to the work found, not to the size of the table or the
+    upload folder. Returns a dict of metrics for the run.
+    """
+    config = current_app.config
+    batch_size = batch_size or config['REAPER_BATCH_SIZE']
+    max_batches = max_batches or config['REAPER_MAX_BATCHES']
+    now = datetime.now(timezone.utc)
+
+    totals = Counter(batches=0, shares_deleted=0, share_bytes=0,
+                     blobs_deleted=0, uploads_deleted=0, bytes_reclaimed=0)
+    started = time.perf_counter()
+
+    reap_shares(FileShare.expires_at <= now, FileShare.expires_at,
+                batch_size, max_batches, totals)
+
+    # Exhausted links stay around long enough for in-flight range requests to finish
+    exhausted_cutoff = now - timedelta(seconds=config['DOWNLOAD_GRANT_TTL'])
+    reap_shares(FileShare.exhausted_at <= exhausted_cutoff, FileShare.exhausted_at,
+                batch_size, max_batches, totals)
+
+    upload_cutoff = now - timedelta(seconds=config['UPLOAD_SESSION_TTL'])
+    _reap_upload_sessions(upload_cutoff, batch_size, max_batches, totals)
+
+    metrics = dict(totals)
+    metrics['duration_s'] = round(time.perf_counter() - started, 3)
+    metrics['finished_at'] = datetime.now(timezone.utc).isoformat()
+    last_run.clear()
+    last_run.update(metrics)
+
+    if metrics['shares_deleted'] or metrics['uploads_deleted']:
+        current_app.logger.info(f"Reaper run: {metrics}")
+    return metrics
+
+
+def _reaper_loop(app, interval):
+    while True:
+        time.sleep(interval)
+        with app.app_context():
+            try:
+                reap()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Reaper error: {str(e)}")
+
+
+def start_reaper_thread(app):
+    """Run the reaper periodically in a daemon thread of this process"""
+    interval = app.config['REAPER_INTERVAL']
+    if interval <= 0:
+        return None
+    thread = threading.Thread(target=_reaper_loop, args=(app, interval),
+                              name='share-reaper', daemon=True)
+    thread.start()
+    return thread
+
+
+@click.command('reap')
+@click.option('--batch-size', type=int, default=None, help='Rows deleted per transaction.')
+@click.option('--max-batches', type=int, default=None, help='Upper bound on batches per phase.')
+@click.option('--loop', is_flag=True, help='Keep running every REAPER_INTERVAL seconds.')
+@with_appcontext
+def reap_command(batch_size, max_batches, loop):
+    """Delete expired and exhausted shares and report bytes reclaimed"""
+    while True:
+        click.echo(reap(batch_size=batch_size, max_batches=max_batches))
+        if not loop:
+            break
+        time.sleep(max(current_app.config['REAPER_INTERVAL'], 1))
@@ -1,7 +1,9 @@
-from flask import Blueprint, request, render_template, redirect, url_for, flash, session
-from werkzeug.security import generate_password_hash
+from flask import Blueprint, request, render_template, redirect, url_for, flash
 from app import db
 from models import User
+from identity import current_user, login_user, logout_user
+from passwords import VerificationBusy, needs_rehash
+from ratelimit import request_allowed, verification_allowed
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -15,13 +17,28 @@ def login():
             flash('Username and password are required', 'error')
             return render_template('login.html')
         
+        # Spend verification budget before doing any hashing work
+        if not verification_allowed(request.remote_addr, f'user:{username}'):
+            flash('Too many login attempts. Please wait a minute and try again.', 'error')
+            return render_template('login.html'), 429
+        
         # Find user
         user = User.query.filter_by(username=username).first()
         
-        if user and user.check_password(password):
-            # Store user info in session
-            session['user_id'] = user.id
-            session['username'] = user.username
+        try:
+            password_ok = user is not None and user.check_password(password)
+        except VerificationBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('login.html'), 503
+        
+        if password_ok:
+            # Upgrade the stored hash if the hashing parameters changed
+            if needs_rehash(user.password_hash):
+                user.set_password(password)
+                db.session.commit()
+            
+            # Identity claims go in the signed session cookie
+            login_user(user)
             
             flash('Login successful', 'success')
             return redirect(url_for('dashboard'))
@@ -38,6 +55,11 @@ def register():
         password = request.form.get('password', '').strip()
         confirm_password = request.form.get('confirm_password', '').strip()
         
+        # Account creation hashes a password and writes a row; cap it per IP
+        if not request_allowed('register_per_ip', request.remote_addr):
+            flash('Too many registrations from your network. Please try again later.', 'error')
+            return render_template('login.html', show_register=True), 429
+        
         # Validation
         if not username or not email or not password:
             flash('All fields are required', 'error')
@@ -78,19 +100,16 @@ def register():
 
 @auth_bp.route('/logout')
 def logout():
-    # Clear session
-    session.clear()
+    logout_user()
     
     flash('You have been logged out', 'info')
     return redirect(url_for('index'))
 
 @auth_bp.route('/profile')
 def profile():
-    # Check if user is logged in via session
-    if 'user_id' not in session:
+    user = current_user()
+    if user is None:
         flash('Please login to view profile', 'error')
         return redirect(url_for('auth.login'))
     
-    user_id = session['user_id']
-    user = User.query.get(user_id)
     return render_template('profile.html', user=user)
@@ -0,0 +1,42 @@
+from datetime import datetime
+from flask import request, render_template, redirect, url_for, flash, current_app
+from models import FileShare, ShareAccessHourly, UserStats
+from identity import current_user
+from quotas import usage
+
+# Registered on the app itself by create_app, so the endpoints stay
+# 'index' and 'dashboard' rather than moving under a blueprint prefix
+
+def index():
+    return render_template('index.html')
+
+def dashboard():
+    user = current_user()
+    if user is None:
+        flash('Please login to access dashboard', 'error')
+        return redirect(url_for('auth.login'))
+    user_id = user.id
+
+    # Keyset pagination: ?before=<created_at>,<id> of the last row shown
+    before = None
+    cursor = request.args.get('before', '')
+    if cursor:
+        try:
+            created_at, share_id = cursor.rsplit(',', 1)
+            before = (datetime.fromisoformat(created_at), int(share_id))
+        except ValueError:
+            before = None
+
+    files, next_before = FileShare.dashboard_page(
+        user_id, before=before, limit=current_app.config["DASHBOARD_PAGE_SIZE"]
+    )
+    next_cursor = f"{next_before[0].isoformat()},{next_before[1]}" if next_before else None
+    # Hourly rollups written by the access log, not the raw events
+    recent = ShareAccessHourly.recent([f.id for f in files])
+
+    stats = UserStats.for_user(user_id)
+    expired_count = stats.expired_count()
+    active_count = stats.file_count - stats.exhausted_count - expired_count
+    return render_template('dashboard.html', user=user, files=files, stats=stats, usage=usage(stats),
+                           expired_count=expired_count, active_count=active_count,
+                           next_cursor=next_cursor, is_first_page=before is None, recent=recent)
@@ -1,17 +1,86 @@
-import os
+import time
 from datetime import datetime, timezone
-from flask import Blueprint, request, render_template, send_file, flash, redirect, url_for, current_app
+from werkzeug.http import parse_if_range_header
+from flask import Blueprint, request, render_template, flash, redirect, url_for, current_app, session, abort
 from app import db
-from models import FileShare
+from models import FileShare, Collection, Preview
+from analytics import record_access
+from cache import get_share, invalidate_share
+from passwords import VerificationBusy
+from quotas import QuotaExceeded
+from ratelimit import (egress_retry_after, get_egress_shaper, lookup_allowed, record_missing,
+                       shape_egress, verification_allowed)
+from storage import get_storage
+from encryption import open_for_reading
+from compression import select_representation
+from streaming import content_disposition, resolve_ranges, send_object_ranges
+from utils import is_file_id
+from zipstream import iter_zip, share_entry, unique_name, zip_length
 
 download_bp = Blueprint('download', __name__)
 
+# Cap on grants kept in the session cookie so it stays well under 4 KB
+MAX_DOWNLOAD_GRANTS = 20
+
+TOO_MANY_MISSES_MESSAGE = 'Too many requests for links that do not exist. Please wait a minute and try again.'
+EGRESS_QUOTA_MESSAGE = "This file's owner has used up their download allowance for now. Please try again later."
+
+def has_download_grant(session_data, file_id):
+    """Check if this client already started a counted download of the file"""
+    grants = session_data.get('download_grants', {})
+    return grants.get(file_id, 0) > time.time()
+
+def issue_download_grant(session_data, file_id, ttl):
+    """Remember a counted download so resumed and parallel range requests are free"""
+    now = time.time()
+    grants = {k: v for k, v in session_data.get('download_grants', {}).items() if v > now}
+    grants[file_id] = now + ttl
+    if len(grants) > MAX_DOWNLOAD_GRANTS:
+        grants = dict(sorted(grants.items(), key=lambda item: item[1])[-MAX_DOWNLOAD_GRANTS:])
+    session_data['download_grants'] = grants
+
+def continues_download(session_data, file_share, range_header, if_range):
+    """Check a request resumes a counted download of this exact file
+
+    Only a partial request (a Range short of the whole file) whose
+    If-Range names the file's ETag rides on a download grant; full GETs
+    go through the password, limit and count every time.
+    """
+    if not range_header or not if_range or not file_share.sha256:
+        return False
+    if parse_if_range_header(if_range).etag != file_share.sha256:
+        return False
+    ranges = resolve_ranges(range_header, file_share.file_size)
+    if ranges is None or ranges == [(0, file_share.file_size)]:
+        return False
+    return has_download_grant(session_data, file_share.file_id)
+
+def log_access(share, status, nbytes, counted):
+    """Queue an access event for the download being served"""
+    record_access(share, status, nbytes, counted, ip=request.remote_addr,
+                  range_header=request.headers.get('Range'), user_agent=request.headers.get('User-Agent'))
+
+def too_many_misses():
+    flash(TOO_MANY_MISSES_MESSAGE, 'error')
+    return render_template('download.html', error='Too many requests'), 429
+
+def link_busy(file_share, retry_after):
+    """429 for a hot link that is over its egress rate"""
+    flash('This link is very busy right now. Please try again shortly.', 'error')
+    response = current_app.make_response(
+        (render_template('download.html', error='Link busy', file_share=file_share), 429))
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
 @download_bp.route('/d/<file_id>', methods=['GET', 'POST'])
 def download_file(file_id):
     """Handle file download with security checks"""
-    file_share = FileShare.query.filter_by(file_id=file_id).first()
+    if not lookup_allowed(request.remote_addr):
+        return too_many_misses()
+    file_share = get_share(file_id)
     
     if not file_share:
+        record_missing(request.remote_addr)
         flash('File not found or link is invalid', 'error')
         return render_template('download.html', error='File not found')
     
@@ -20,21 +89,42 @@ def download_file(file_id):
         flash('Download link has expired', 'error')
         return render_template('download.html', error='Link expired', file_share=file_share)
     
+    # An upload from before blob storage whose file `flask migrate` has not adopted
+    if file_share.storage_key is None:
+        flash('File no longer exists on server', 'error')
+        return render_template('download.html', error='File not found on server', file_share=file_share)
+    
+    # Range requests that continue a counted download skip the limit and password checks
+    has_grant = continues_download(session, file_share, request.headers.get('Range'),
+                                   request.headers.get('If-Range'))
+    
     # Check if download limit reached
-    if file_share.is_download_limit_reached():
+    if not has_grant and file_share.is_download_limit_reached():
         flash('Download limit has been reached', 'error')
         return render_template('download.html', error='Download limit reached', file_share=file_share)
     
-    # Check if file exists on disk
-    if not os.path.exists(file_share.file_path):
-        flash('File no longer exists on server', 'error')
-        return render_template('download.html', error='File not found on server', file_share=file_share)
+    # Turn hot links away before any password hashing or counting
+    retry_after = egress_retry_after(file_id)
+    if retry_after and request.method != 'HEAD':
+        return link_busy(file_share, retry_after)
     
     # Handle password protection
-    if file_share.password_hash:
+    if file_share.password_hash and not has_grant:
         if request.method == 'POST':
             password = request.form.get('password', '')
-            if not file_share.check_password(password):
+            if not verification_allowed(request.remote_addr, f'file:{file_id}'):
+                flash('Too many password attempts. Please wait a minute and try again.', 'error')
+                return render_template('download.html', 
+                                     file_share=file_share, 
+                                     password_required=True), 429
+            try:
+                password_ok = file_share.check_password(password)
+            except VerificationBusy:
+                flash('The server is busy. Please try again in a moment.', 'error')
+                return render_template('download.html', 
+                                     file_share=file_share, 
+                                     password_required=True), 503
+            if not password_ok:
                 flash('Incorrect password', 'error')
                 return render_template('download.html', 
                                      file_share=file_share, 
@@ -46,17 +136,72 @@ def download_file(file_id):
                                  file_share=file_share, 
                                  password_required=True)
     
+    # Count one download per logical transfer, not per range request. The
+    # reservation re-checks the limit atomically, so racing workers can't
+    # serve more than download_limit copies.
+    counted = not has_grant and request.method != 'HEAD'
+    if counted:
+        try:
+            reserved = file_share.reserve_download()
+        except QuotaExceeded:
+            flash(EGRESS_QUOTA_MESSAGE, 'error')
+            return render_template('download.html', error='Download allowance used up', file_share=file_share), 429
+        invalidate_share(file_id)
+        if reserved is None:
+            flash('Download limit has been reached', 'error')
+            return render_template('download.html', error='Download limit reached', file_share=file_share)
+        issue_download_grant(session, file_id, current_app.config['DOWNLOAD_GRANT_TTL'])
+    
     # All checks passed - serve the file
     try:
-        # Increment download count
-        file_share.increment_download_count()
+        # Encrypted blobs are decrypted chunk by chunk and never presigned;
+        # compressed ones go out as stored when the client accepts the coding
+        storage, content_encoding, etag = select_representation(
+            open_for_reading(get_storage(), file_share),
+            file_share,
+            request.headers.get('Accept-Encoding'),
+            request.headers.get('Range')
+        )
+        mimetype = file_share.served_mime_type
+        
+        # Hand the transfer to the storage service when it can sign URLs
+        if current_app.config['STORAGE_PRESIGNED_DOWNLOADS']:
+            url = storage.presigned_url(
+                file_share.storage_key,
+                current_app.config['STORAGE_PRESIGN_TTL'],
+                download_name=file_share.original_filename,
+                mimetype=mimetype,
+                content_encoding=content_encoding
+            )
+            if url:
+                shape_egress(get_egress_shaper(), file_id, file_share.file_size)
+                response = redirect(url)
+                if request.method != 'HEAD':
+                    log_access(file_share, response.status_code, file_share.file_size, counted)
+                response.headers['Cache-Control'] = 'private, no-store'
+                return response
         
-        # Send file
-        return send_file(
-            file_share.file_path,
-            as_attachment=True,
-            download_name=file_share.original_filename
+        # Send file (honours Range/If-Range and streams via sendfile under gunicorn)
+        response = send_object_ranges(
+            storage,
+            file_share.storage_key,
+            download_name=file_share.original_filename,
+            mimetype=mimetype,
+            etag=etag
         )
+        if file_share.content_encoding:
+            response.vary.add('Accept-Encoding')
+            if content_encoding:
+                response.headers['Content-Encoding'] = content_encoding
+        # A sync worker can't pace the bytes, so the whole body is charged
+        # up front; later transfers of the link wait until it is paid off
+        if request.method != 'HEAD':
+            shape_egress(get_egress_shaper(), file_id, response.content_length)
+            log_access(file_share, response.status_code, response.content_length, counted)
+        return response
+    except FileNotFoundError:
+        flash('File no longer exists on server', 'error')
+        return render_template('download.html', error='File not found on server', file_share=file_share)
     except Exception as e:
         current_app.logger.error(f"Download error: {str(e)}")
         flash('An error occurred while downloading the file', 'error')
@@ -65,12 +210,152 @@ def download_file(file_id):
 @download_bp.route('/info/<file_id>')
 def file_info(file_id):
     """Show file information without downloading"""
-    file_share = FileShare.query.filter_by(file_id=file_id).first()
+    if not lookup_allowed(request.remote_addr):
+        return too_many_misses()
+    file_share = get_share(file_id)
     
     if not file_share:
+        record_missing(request.remote_addr)
         flash('File not found', 'error')
         return render_template('download.html', error='File not found')
     
+    preview = db.session.get(Preview, file_share.sha256) if preview_visible(file_share) else None
     return render_template('download.html', 
                          file_share=file_share, 
+                         preview=preview,
                          show_info=True)
+
+def preview_visible(file_share):
+    """Previews show what the file holds, so they need the same access as downloading it"""
+    if not file_share.can_download() or file_share.sha256 is None:
+        return False
+    return not file_share.password_hash or has_download_grant(session, file_share.file_id)
+
+@download_bp.route('/info/<file_id>/preview')
+def file_preview(file_id):
+    """Serve the stored preview of a share's file"""
+    if not lookup_allowed(request.remote_addr):
+        return too_many_misses()
+    file_share = get_share(file_id)
+    if not file_share:
+        record_missing(request.remote_addr)
+        abort(404)
+    preview = db.session.get(Preview, file_share.sha256) if preview_visible(file_share) else None
+    if preview is None:
+        abort(404)
+    
+    # The preview of a share never changes, so browsers and caches may keep it
+    response = current_app.response_class(mimetype=preview.content_type)
+    response.set_etag(preview.storage_key.rsplit('/', 1)[-1])
+    max_age = current_app.config['PREVIEW_CACHE_MAX_AGE']
+    response.headers['Cache-Control'] = (
+        f"{'private' if file_share.password_hash else 'public'}, max-age={max_age}, immutable")
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    if request.if_none_match.contains(response.get_etag()[0]):
+        response.status_code = 304
+        return response
+    
+    view = open_for_reading(get_storage(), preview)
+    try:
+        response.set_data(b''.join(view.get_range_stream(preview.storage_key, 0, preview.size)))
+    except FileNotFoundError:
+        current_app.logger.error(f"Preview object {preview.storage_key} is missing")
+        abort(404)
+    return response
+
+@download_bp.route('/c/<collection_id>')
+def view_collection(collection_id):
+    """List the shares created together under one collection link"""
+    if not lookup_allowed(request.remote_addr):
+        return too_many_misses()
+    collection = Collection.query.filter_by(collection_id=collection_id).first() if is_file_id(collection_id) else None
+    shares = collection.shares.all() if collection else []
+    
+    if not shares:
+        record_missing(request.remote_addr)
+        flash('Collection not found or link is invalid', 'error')
+        return render_template('download.html', error='Collection not found')
+    
+    return render_template('collection.html', collection=collection, shares=shares)
+
+@download_bp.route('/d/<collection_id>.zip', methods=['GET', 'POST'])
+def download_collection(collection_id):
+    """Stream every downloadable share in a collection as one ZIP archive"""
+    if not lookup_allowed(request.remote_addr):
+        return too_many_misses()
+    collection = Collection.query.filter_by(collection_id=collection_id).first() if is_file_id(collection_id) else None
+    all_shares = collection.shares.all() if collection else []
+    
+    if not all_shares:
+        record_missing(request.remote_addr)
+        flash('Collection not found or link is invalid', 'error')
+        return render_template('download.html', error='Collection not found')
+    
+    # Archives are not served in ranges, so every request is a whole new download:
+    # it is checked and counted again, however recently the client fetched it
+    shares = [s for s in all_shares if not s.is_expired() and not s.is_download_limit_reached()]
+    
+    if not shares:
+        flash('None of the files in this collection can be downloaded any more', 'error')
+        return render_template('collection.html', collection=collection, shares=all_shares)
+    
+    # One password covers the archive; files uploaded in one batch share a
+    # hash, so this is normally a single verification
+    protected = {s.password_hash: s for s in shares if s.password_hash}
+    if protected:
+        if request.method != 'POST':
+            flash('Enter the password to download these files', 'info')
+            return render_template('collection.html', collection=collection, shares=all_shares)
+        if not verification_allowed(request.remote_addr, f'collection:{collection_id}'):
+            flash('Too many password attempts. Please wait a minute and try again.', 'error')
+            return render_template('collection.html', collection=collection, shares=all_shares), 429
+        password = request.form.get('password', '')
+        try:
+            password_ok = all(s.check_password(password) for s in protected.values())
+        except VerificationBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('collection.html', collection=collection, shares=all_shares), 503
+        if not password_ok:
+            flash('Incorrect password', 'error')
+            return render_template('collection.html', collection=collection, shares=all_shares)
+    
+    # Count every file in one UPDATE; files that ran out meanwhile are left out
+    counted = request.method != 'HEAD'
+    if counted:
+        try:
+            reserved = FileShare.reserve_downloads([s.id for s in shares])
+        except QuotaExceeded:
+            flash(EGRESS_QUOTA_MESSAGE, 'error')
+            return render_template('collection.html', collection=collection, shares=all_shares), 429
+        shares = [s for s in shares if s.id in reserved]
+        invalidate_share(*(s.file_id for s in shares))
+        if not shares:
+            flash('Download limit has been reached', 'error')
+            return render_template('collection.html', collection=collection, shares=all_shares)
+    
+    try:
+        storage = get_storage()
+        level = current_app.config['ZIP_DEFLATE_LEVEL']
+        used_names = set()
+        entries = [share_entry(storage, s, unique_name(s.original_filename, used_names), level)
+                   for s in shares]
+    except Exception as e:
+        current_app.logger.error(f"Collection download error: {str(e)}")
+        flash('An error occurred while preparing the download', 'error')
+        return render_template('collection.html', collection=collection, shares=all_shares)
+    
+    if request.method != 'HEAD':
+        for s in shares:
+            log_access(s, 200, s.file_size, counted)
+    
+    # Members are read from storage as the archive is sent; nothing is staged on disk
+    response = current_app.response_class(iter_zip(entries), mimetype='application/zip',
+                                          direct_passthrough=True)
+    disposition, names = content_disposition(f'{collection.name or collection_id}.zip')
+    response.headers.set('Content-Disposition', disposition, **names)
+    length = zip_length(entries)
+    if length is not None:
+        response.content_length = length
+    response.cache_control.private = True
+    response.cache_control.no_store = True
+    return response
@@ -1,15 +1,39 @@
 import os
+import fcntl
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from flask import Blueprint, request, flash, redirect, url_for, render_template, current_app, session
+from flask import Blueprint, request, flash, redirect, url_for, render_template, current_app, jsonify
 from werkzeug.utils import secure_filename
-from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.exceptions import RequestEntityTooLarge, ClientDisconnected
 from app import db
-from models import FileShare, User
+from models import FileShare, User, UploadSession, UserStats, Collection, add_with_public_id
+from streaming import copy_stream, hash_file_prefix
+from cache import invalidate_share
+from blobstore import (new_staging_path, store_staged_file, store_staged_files, acquire_blob,
+                       discard_put_keys, release_blob, remove_blob, compression_ratio, compression_ratios)
+from passwords import hash_password
+from ratelimit import request_allowed
+from sniffing import SNIFF_LENGTH, ContentSniffer, ContentTypeMismatch, content_type_of_stored
+from previews import queue_preview, queue_previews
+from identity import current_user
 import secrets
 import string
 
 upload_bp = Blueprint('upload', __name__)
 
+# Running SHA-256 state per resumable upload, keyed by upload ID. A worker
+# that did not see the previous chunk rebuilds the state from disk.
+MAX_CACHED_HASHERS = 256
+_upload_hashers = OrderedDict()
+_upload_hashers_lock = threading.Lock()
+
+UPLOAD_RATE_MESSAGE = 'Too many uploads. Please wait a minute and try again.'
+STORAGE_QUOTA_MESSAGE = 'Not enough storage left in your quota for this file. Delete some files and try again.'
+CONTENT_MISMATCH_MESSAGE = 'File content does not match its type'
+
 ALLOWED_EXTENSIONS = {
     'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'xls', 'xlsx', 
     'ppt', 'pptx', 'zip', 'rar', '7z', 'mp3', 'mp4', 'avi', 'mov', 'wav'
@@ -27,13 +51,61 @@ def generate_secure_filename(original_filename):
     random_suffix = ''.join(secrets.choice(string.ascii_lowercase + string.digits) for _ in range(6))
     return f"{secure_name}_{timestamp}_{random_suffix}{ext}"
 
+def parse_share_options(form):
+    """Validate password, download limit and expiry fields
+
+    Returns (options, error) where error is a user-facing message or None.
+    """
+    options = {
+        'password': (form.get('password') or '').strip(),
+        'download_limit': None,
+        'expiry_hours': None,
+    }
+    
+    # Validate download limit
+    download_limit = str(form.get('download_limit') or '').strip()
+    if download_limit:
+        try:
+            options['download_limit'] = int(download_limit)
+        except ValueError:
+            return None, 'Invalid download limit'
+        if options['download_limit'] <= 0:
+            return None, 'Download limit must be a positive number'
+    
+    # Validate expiry time
+    expiry_hours = str(form.get('expiry_hours') or '').strip()
+    if expiry_hours:
+        try:
+            options['expiry_hours'] = int(expiry_hours)
+        except ValueError:
+            return None, 'Invalid expiry time'
+        if options['expiry_hours'] <= 0:
+            return None, 'Expiry time must be a positive number'
+    
+    return options, None
+
+def expiry_from_hours(expiry_hours):
+    """Turn an expiry in hours into an absolute UTC timestamp"""
+    if not expiry_hours:
+        return None
+    return datetime.now(timezone.utc) + timedelta(hours=expiry_hours)
+
 @upload_bp.route('/upload', methods=['GET', 'POST'])
 def upload_file():
-    # Check if user is logged in via session
-    if 'user_id' not in session:
+    user = current_user()
+    if user is None:
         flash('Please login to upload files', 'error')
         return redirect(url_for('auth.login'))
     if request.method == 'POST':
+        if not request_allowed('upload_per_user', f'user:{user.id}'):
+            flash(UPLOAD_RATE_MESSAGE, 'error')
+            return render_template('index.html'), 429
+        # Refuse before the body is parsed (and spooled to disk) when it can't fit
+        if not UserStats.has_storage_for(user.id, request.content_length or 0):
+            flash(STORAGE_QUOTA_MESSAGE, 'error')
+            return redirect(request.url)
+        staging_path = None
+        put_keys = []
         try:
             # Check if file was uploaded
             if 'file' not in request.files:
@@ -50,62 +122,51 @@ def upload_file():
                 flash('File type not allowed', 'error')
                 return redirect(request.url)
             
-            # Get form data
-            password = request.form.get('password', '').strip()
-            download_limit = request.form.get('download_limit', '').strip()
-            expiry_hours = request.form.get('expiry_hours', '').strip()
-            
-            # Validate download limit
-            if download_limit:
-                try:
-                    download_limit = int(download_limit)
-                    if download_limit <= 0:
-                        flash('Download limit must be a positive number', 'error')
-                        return redirect(request.url)
-                except ValueError:
-                    flash('Invalid download limit', 'error')
-                    return redirect(request.url)
-            else:
-                download_limit = None
-            
-            # Validate expiry time
-            expires_at = None
-            if expiry_hours:
-                try:
-                    expiry_hours = int(expiry_hours)
-                    if expiry_hours <= 0:
-                        flash('Expiry time must be a positive number', 'error')
-                        return redirect(request.url)
-                    expires_at = datetime.now(timezone.utc) + timedelta(hours=expiry_hours)
-                except ValueError:
-                    flash('Invalid expiry time', 'error')
-                    return redirect(request.url)
+            options, error = parse_share_options(request.form)
+            if error:
+                flash(error, 'error')
+                return redirect(request.url)
             
-            # Generate secure filename and save file
+            # Copy the upload to staging, sizing and hashing it in one pass;
+            # the content is checked against the extension before any is written
             secure_filename_generated = generate_secure_filename(file.filename)
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], secure_filename_generated)
-            file.save(file_path)
+            staging_path = new_staging_path()
+            hasher = hashlib.sha256()
+            sniffer = ContentSniffer(file.filename)
+            with open(staging_path, 'wb') as target:
+                file_size = copy_stream(file.stream, target, hasher, check_head=sniffer, head_length=SNIFF_LENGTH)
+            
+            # Claim the space first; a concurrent upload may have used it meanwhile
+            if not UserStats.adjust(user.id, enforce_quota=True, file_count=1, total_bytes=file_size):
+                db.session.rollback()
+                os.remove(staging_path)
+                flash(STORAGE_QUOTA_MESSAGE, 'error')
+                return redirect(request.url)
             
-            # Get file size
-            file_size = os.path.getsize(file_path)
+            # Link to identical content if it is already stored
+            sha256 = store_staged_file(staging_path, hasher.hexdigest(), file_size, file.filename,
+                                       put_keys=put_keys)
             
             # Create file share record
             file_share = FileShare(
                 filename=secure_filename_generated,
                 original_filename=file.filename,
-                file_path=file_path,
                 file_size=file_size,
-                download_limit=download_limit,
-                expires_at=expires_at,
-                user_id=session['user_id']
+                sha256=sha256,
+                mime_type=sniffer.mime_type,
+                compression_ratio=compression_ratio(sha256),
+                download_limit=options['download_limit'],
+                expires_at=expiry_from_hours(options['expiry_hours']),
+                user_id=user.id
             )
             
             # Set password if provided
-            if password:
-                file_share.set_password(password)
+            if options['password']:
+                file_share.set_password(options['password'])
             
-            db.session.add(file_share)
+            add_with_public_id(file_share)
             db.session.commit()
+            queue_preview(file_share)
             
             # Generate share URL
             share_url = url_for('download.download_file', file_id=file_share.file_id, _external=True)
@@ -116,7 +177,15 @@ def upload_file():
         except RequestEntityTooLarge:
             flash('File too large. Maximum size is 100MB.', 'error')
             return redirect(request.url)
+        except ContentTypeMismatch:
+            os.remove(staging_path)
+            flash(CONTENT_MISMATCH_MESSAGE, 'error')
+            return redirect(request.url)
         except Exception as e:
+            db.session.rollback()
+            discard_put_keys(put_keys)
+            if staging_path and os.path.exists(staging_path):
+                os.remove(staging_path)
             current_app.logger.error(f"Upload error: {str(e)}")
             flash('An error occurred during upload. Please try again.', 'error')
             return redirect(request.url)
@@ -126,12 +195,12 @@ def upload_file():
 @upload_bp.route('/delete/<file_id>', methods=['POST'])
 def delete_file(file_id):
     """Delete a file share"""
-    # Check if user is logged in via session
-    if 'user_id' not in session:
+    user = current_user()
+    if user is None:
         flash('Please login to delete files', 'error')
         return redirect(url_for('auth.login'))
     
-    user_id = session['user_id']
+    user_id = user.id
     file_share = FileShare.query.filter_by(file_id=file_id, user_id=user_id).first()
     
     if not file_share:
@@ -139,17 +208,495 @@ def delete_file(file_id):
         return redirect(url_for('dashboard'))
     
     try:
-        # Delete physical file
-        if os.path.exists(file_share.file_path):
-            os.remove(file_share.file_path)
-        
-        # Delete database record
+        # Delete database record and drop its reference to the stored blob
+        released_keys = release_blob(file_share.sha256)
         db.session.delete(file_share)
+        UserStats.adjust(
+            user_id,
+            file_count=-1,
+            total_bytes=-file_share.file_size,
+            total_downloads=-(file_share.download_count or 0),
+            exhausted_count=-int(file_share.exhausted_at is not None)
+        )
         db.session.commit()
+        invalidate_share(file_id)
+        
+        # Garbage-collect the blob once no share points at it
+        for key in released_keys:
+            remove_blob(key)
         
         flash('File deleted successfully', 'success')
     except Exception as e:
+        db.session.rollback()
         current_app.logger.error(f"Delete error: {str(e)}")
         flash('An error occurred while deleting the file', 'error')
     
     return redirect(url_for('dashboard'))
+
+# Resumable chunked uploads (tus-style): create, PATCH at offset, finalize.
+# Chunks are written into a staging file inside UPLOAD_FOLDER that is handed
+# to the storage backend on finalize (a rename when storage is local).
+
+def _api_error(message, status):
+    return jsonify({'error': message}), status
+
+def _upload_status_headers(upload):
+    return {
+        'Upload-Offset': str(upload.upload_offset),
+        'Upload-Length': str(upload.upload_length),
+        'Cache-Control': 'no-store',
+    }
+
+def _share_created(file_share):
+    share_url = url_for('download.download_file', file_id=file_share.file_id, _external=True)
+    return jsonify({
+        'file_id': file_share.file_id,
+        'share_url': share_url,
+        'size': file_share.file_size,
+        'sha256': file_share.sha256,
+    }), 201
+
+def _linked_content_type(user_id, filename, sha256):
+    """Type for a new share of content that is already stored, from one of the user's shares checked at upload
+
+    Only the user's own shares count: the hash is public (it is the
+    download ETag), so knowing it proves nothing about having the bytes.
+    None when no such share records one, so the bytes have to be sent and
+    checked; raises ContentTypeMismatch when the content is known not to
+    match the file's extension.
+    """
+    stored = db.session.execute(
+        db.select(FileShare.mime_type)
+        .where(FileShare.user_id == user_id, FileShare.sha256 == sha256, FileShare.mime_type.isnot(None))
+        .limit(1)
+    ).scalar()
+    return content_type_of_stored(filename, stored) if stored else None
+
+def _get_upload_session(upload_id):
+    """Load the caller's upload session or return an API error response"""
+    user = current_user()
+    if user is None:
+        return None, _api_error('Authentication required', 401)
+    upload = db.session.get(UploadSession, upload_id)
+    if not upload or upload.user_id != user.id:
+        return None, _api_error('Upload not found', 404)
+    return upload, None
+
+def _take_hasher(upload):
+    """Return a SHA-256 object positioned at the upload's current offset"""
+    with _upload_hashers_lock:
+        cached = _upload_hashers.pop(upload.id, None)
+    if cached and cached[0] == upload.upload_offset:
+        return cached[1]
+    # Another worker received the previous chunk; re-hash what is on disk
+    return hash_file_prefix(upload.file_path, upload.upload_offset, hashlib.sha256())
+
+def _keep_hasher(upload_id, offset, hasher):
+    with _upload_hashers_lock:
+        _upload_hashers[upload_id] = (offset, hasher)
+        while len(_upload_hashers) > MAX_CACHED_HASHERS:
+            _upload_hashers.popitem(last=False)
+
+def _drop_hasher(upload_id):
+    with _upload_hashers_lock:
+        return _upload_hashers.pop(upload_id, None)
+
+@upload_bp.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload and reserve its file on disk"""
+    user = current_user()
+    if user is None:
+        return _api_error('Authentication required', 401)
+    if not request_allowed('upload_per_user', f'user:{user.id}'):
+        return _api_error(UPLOAD_RATE_MESSAGE, 429)
+    
+    data = request.get_json(silent=True) or request.form
+    original_filename = (data.get('filename') or '').strip()
+    if not original_filename or not allowed_file(original_filename):
+        return _api_error('File type not allowed', 400)
+    
+    try:
+        upload_length = int(data.get('length') or request.headers.get('Upload-Length', ''))
+    except ValueError:
+        return _api_error('Upload length is required', 400)
+    if upload_length < 0:
+        return _api_error('Upload length must not be negative', 400)
+    if upload_length > current_app.config['MAX_UPLOAD_SIZE']:
+        return _api_error('File too large', 413)
+    
+    options, error = parse_share_options(data)
+    if error:
+        return _api_error(error, 400)
+    if not UserStats.has_storage_for(user.id, upload_length):
+        return _api_error('Storage quota exceeded', 507)
+    
+    secure_filename_generated = generate_secure_filename(original_filename)
+    
+    # Content the user has already shared: link to it without receiving the bytes again
+    sha256 = (data.get('sha256') or '').strip().lower()
+    try:
+        mime_type = _linked_content_type(user.id, original_filename, sha256) if sha256 else None
+    except ContentTypeMismatch:
+        return _api_error(CONTENT_MISMATCH_MESSAGE, 415)
+    if mime_type and acquire_blob(sha256, size=upload_length):
+        file_share = FileShare(
+            filename=secure_filename_generated,
+            original_filename=original_filename,
+            file_size=upload_length,
+            sha256=sha256,
+            mime_type=mime_type,
+            compression_ratio=compression_ratio(sha256),
+            download_limit=options['download_limit'],
+            expires_at=expiry_from_hours(options['expiry_hours']),
+            user_id=user.id
+        )
+        if options['password']:
+            file_share.set_password(options['password'])
+        add_with_public_id(file_share)
+        if not UserStats.adjust(file_share.user_id, enforce_quota=True, file_count=1, total_bytes=upload_length):
+            db.session.rollback()
+            return _api_error('Storage quota exceeded', 507)
+        db.session.commit()
+        return _share_created(file_share)
+    db.session.rollback()
+    
+    file_path = new_staging_path()
+    
+    upload = UploadSession(
+        user_id=user.id,
+        filename=secure_filename_generated,
+        original_filename=original_filename,
+        file_path=file_path,
+        upload_length=upload_length,
+        upload_offset=0,
+        password_hash=hash_password(options['password']) if options['password'] else None,
+        download_limit=options['download_limit'],
+        expiry_hours=options['expiry_hours']
+    )
+    
+    try:
+        open(file_path, 'xb').close()
+        db.session.add(upload)
+        # The declared length is held against the quota until finalize or abort
+        if not UserStats.adjust(upload.user_id, enforce_quota=True, reserved_bytes=upload_length):
+            db.session.rollback()
+            os.remove(file_path)
+            return _api_error('Storage quota exceeded', 507)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        current_app.logger.error(f"Upload create error: {str(e)}")
+        return _api_error('Could not start upload', 500)
+    
+    _keep_hasher(upload.id, 0, hashlib.sha256())
+    location = url_for('upload.upload_chunk', upload_id=upload.id)
+    headers = _upload_status_headers(upload)
+    headers['Location'] = location
+    return jsonify({'upload_id': upload.id, 'offset': 0, 'location': location}), 201, headers
+
+@upload_bp.route('/api/uploads/<upload_id>', methods=['HEAD', 'GET'])
+def upload_status(upload_id):
+    """Report how many bytes the server has so the client can resume"""
+    upload, error = _get_upload_session(upload_id)
+    if error:
+        return error
+    body = {'upload_id': upload.id, 'offset': upload.upload_offset, 'length': upload.upload_length}
+    return jsonify(body), 200, _upload_status_headers(upload)
+
+@upload_bp.route('/api/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    """Append the request body at Upload-Offset, streaming it to disk"""
+    upload, error = _get_upload_session(upload_id)
+    if error:
+        return error
+    
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return _api_error('Upload-Offset header is required', 400)
+    if offset != upload.upload_offset:
+        return _api_error('Upload-Offset does not match the server offset', 409)
+    
+    remaining = upload.upload_length - offset
+    if request.content_length is not None and request.content_length > remaining:
+        return _api_error('Chunk extends past the declared upload length', 413)
+    
+    with open(upload.file_path, 'r+b') as target:
+        # One writer per upload across all workers
+        try:
+            fcntl.flock(target, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return _api_error('Another chunk is being written for this upload', 423)
+        
+        hasher = _take_hasher(upload)
+        target.seek(offset)
+        target.truncate()
+        # The first chunk is checked against the extension before it is written
+        sniffer = ContentSniffer(upload.original_filename, upload.upload_length) if offset == 0 else None
+        status_error = None
+        try:
+            copy_stream(request.stream, target, hasher, limit=remaining,
+                        check_head=sniffer, head_length=SNIFF_LENGTH)
+        except ClientDisconnected:
+            # Keep whatever arrived so the client can resume from there
+            pass
+        except ValueError:
+            status_error = _api_error('Chunk extends past the declared upload length', 413)
+        except ContentTypeMismatch:
+            status_error = _api_error(CONTENT_MISMATCH_MESSAGE, 415)
+        target.flush()
+        
+        if status_error:
+            target.truncate(offset)
+            _drop_hasher(upload.id)
+            return status_error
+        
+        new_offset = target.tell()
+        updated = db.session.execute(
+            db.update(UploadSession)
+            .where(UploadSession.id == upload.id, UploadSession.upload_offset == offset)
+            .values(upload_offset=new_offset, updated_at=datetime.now(timezone.utc))
+        ).rowcount
+        db.session.commit()
+    
+    if not updated:
+        _drop_hasher(upload.id)
+        return _api_error('Upload-Offset does not match the server offset', 409)
+    
+    _keep_hasher(upload.id, new_offset, hasher)
+    upload.upload_offset = new_offset
+    return '', 204, _upload_status_headers(upload)
+
+@upload_bp.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """Turn a fully received upload into a file share"""
+    upload, error = _get_upload_session(upload_id)
+    if error:
+        return error
+    if not upload.is_complete():
+        return _api_error('Upload is incomplete', 409)
+    
+    # A finalize whose commit failed may have consumed the staged data
+    if not os.path.exists(upload.file_path) or os.path.getsize(upload.file_path) < upload.upload_offset:
+        _restart_upload(upload)
+        return _api_error('Upload is incomplete', 409)
+    
+    cached = _drop_hasher(upload.id)
+    if cached and cached[0] == upload.upload_offset:
+        sha256 = cached[1].hexdigest()
+    else:
+        sha256 = hash_file_prefix(upload.file_path, upload.upload_offset, hashlib.sha256()).hexdigest()
+    
+    data = request.get_json(silent=True) or request.form
+    expected = (data.get('sha256') or '').strip().lower()
+    if expected and expected != sha256:
+        return _api_error('Checksum mismatch', 422)
+    
+    # The first chunk was checked as it arrived, but it may have been shorter than the sniffed head
+    sniffer = ContentSniffer(upload.original_filename, upload.upload_length)
+    with open(upload.file_path, 'rb') as f:
+        head = f.read(SNIFF_LENGTH)
+    try:
+        sniffer(head)
+    except ContentTypeMismatch:
+        return _api_error(CONTENT_MISMATCH_MESSAGE, 415)
+    
+    file_path = upload.file_path
+    put_keys = []
+    try:
+        store_staged_file(file_path, sha256, upload.upload_offset, upload.original_filename,
+                          put_keys=put_keys)
+        file_share = FileShare(
+            filename=upload.filename,
+            original_filename=upload.original_filename,
+            file_size=upload.upload_offset,
+            sha256=sha256,
+            mime_type=sniffer.mime_type,
+            compression_ratio=compression_ratio(sha256),
+            password_hash=upload.password_hash,
+            download_limit=upload.download_limit,
+            expires_at=expiry_from_hours(upload.expiry_hours),
+            user_id=upload.user_id
+        )
+        add_with_public_id(file_share)
+        db.session.delete(upload)
+        UserStats.adjust(file_share.user_id, file_count=1, total_bytes=file_share.file_size,
+                         reserved_bytes=-upload.upload_length)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        discard_put_keys(put_keys)
+        current_app.logger.error(f"Upload finalize error: {str(e)}")
+        if not os.path.exists(file_path):
+            _restart_upload(upload)
+        return _api_error('Could not finalize upload', 500)
+    
+    queue_preview(file_share)
+    return _share_created(file_share)
+
+def _restart_upload(upload):
+    """Send a session whose staged data is gone back to offset 0 so the client can resend it"""
+    try:
+        with open(upload.file_path, 'wb'):
+            pass
+        upload.upload_offset = 0
+        db.session.commit()
+        _keep_hasher(upload.id, 0, hashlib.sha256())
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Upload restart error: {str(e)}")
+
+@upload_bp.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    """Abandon a resumable upload and remove its partial file"""
+    upload, error = _get_upload_session(upload_id)
+    if error:
+        return error
+    
+    _drop_hasher(upload.id)
+    if os.path.exists(upload.file_path):
+        os.remove(upload.file_path)
+    db.session.delete(upload)
+    UserStats.adjust(upload.user_id, reserved_bytes=-upload.upload_length)
+    db.session.commit()
+    return '', 204
+
+# Batch uploads: many files in one multipart request, staged concurrently
+# and shared with a single bulk insert
+
+def _stage_upload(file, staging_path):
+    """Copy one uploaded file to staging, returning (size, sha256, mime_type)
+    
+    mime_type is None, and nothing is written, when the content does not
+    match the file's extension.
+    """
+    hasher = hashlib.sha256()
+    sniffer = ContentSniffer(file.filename)
+    with open(staging_path, 'wb') as target:
+        try:
+            size = copy_stream(file.stream, target, hasher, check_head=sniffer, head_length=SNIFF_LENGTH)
+        except ContentTypeMismatch:
+            return 0, None, None
+    return size, hasher.hexdigest(), sniffer.mime_type
+
+@upload_bp.route('/api/batches', methods=['POST'])
+def create_batch():
+    """Share every file in a multipart request and return a JSON manifest"""
+    user = current_user()
+    if user is None:
+        return _api_error('Authentication required', 401)
+    user_id = user.id
+    if not request_allowed('upload_per_user', f'user:{user_id}'):
+        return _api_error(UPLOAD_RATE_MESSAGE, 429)
+    if not UserStats.has_storage_for(user_id, request.content_length or 0):
+        return _api_error('Storage quota exceeded', 507)
+    
+    # A batch may be larger and have more parts than a single upload
+    request.max_content_length = current_app.config['BATCH_MAX_CONTENT_LENGTH']
+    request.max_form_parts = current_app.config['BATCH_MAX_FILES'] + 16
+    try:
+        files = [f for f in request.files.getlist('files') if f.filename]
+    except RequestEntityTooLarge:
+        return _api_error('Batch too large', 413)
+    if not files:
+        return _api_error('No files in batch', 400)
+    if len(files) > current_app.config['BATCH_MAX_FILES']:
+        return _api_error('Too many files in batch', 413)
+    
+    options, error = parse_share_options(request.form)
+    if error:
+        return _api_error(error, 400)
+    
+    accepted = [f for f in files if allowed_file(f.filename)]
+    rejected = [{'filename': f.filename, 'error': 'File type not allowed'}
+                for f in files if not allowed_file(f.filename)]
+    if not accepted:
+        return jsonify({'error': 'No allowed files in batch', 'rejected': rejected}), 400
+    
+    staging_paths = [new_staging_path() for _ in accepted]
+    put_keys = []
+    workers = current_app.config['BATCH_UPLOAD_WORKERS']
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_stage_upload, accepted, staging_paths))
+        for f, path, (_, _, mime_type) in zip(accepted, staging_paths, results):
+            if mime_type is None:
+                os.remove(path)
+                rejected.append({'filename': f.filename, 'error': CONTENT_MISMATCH_MESSAGE})
+        kept = [i for i, (_, _, mime_type) in enumerate(results) if mime_type is not None]
+        accepted = [accepted[i] for i in kept]
+        staging_paths = [staging_paths[i] for i in kept]
+        staged = [results[i] for i in kept]
+        if not staged:
+            return jsonify({'error': 'No allowed files in batch', 'rejected': rejected}), 400
+        if not UserStats.adjust(user_id, enforce_quota=True, file_count=len(staged),
+                                total_bytes=sum(size for size, _, _ in staged)):
+            db.session.rollback()
+            for path in staging_paths:
+                os.remove(path)
+            return _api_error('Storage quota exceeded', 507)
+        store_staged_files(
+            [(path, sha256, size, f.filename) for f, path, (size, sha256, _) in zip(accepted, staging_paths, staged)],
+            max_workers=workers, put_keys=put_keys
+        )
+        
+        collection = None
+        if str(request.form.get('collection', '')).lower() in ('1', 'true', 'yes', 'on'):
+            collection = Collection(
+                name=(request.form.get('collection_name') or '').strip()[:255] or None,
+                user_id=user_id
+            )
+            add_with_public_id(collection)
+        
+        # One hash for the whole batch instead of one per file
+        password_hash = hash_password(options['password']) if options['password'] else None
+        expires_at = expiry_from_hours(options['expiry_hours'])
+        ratios = compression_ratios({sha256 for _, sha256, _ in staged})
+        rows = [
+            {
+                'filename': generate_secure_filename(f.filename),
+                'original_filename': f.filename,
+                'file_size': size,
+                'sha256': sha256,
+                'mime_type': mime_type,
+                'compression_ratio': ratios.get(sha256),
+                'password_hash': password_hash,
+                'download_limit': options['download_limit'],
+                'expires_at': expires_at,
+                'user_id': user_id,
+                'collection_id': collection.id if collection else None,
+            }
+            for f, (size, sha256, mime_type) in zip(accepted, staged)
+        ]
+        FileShare.bulk_create(rows)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        discard_put_keys(put_keys)
+        for path in staging_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        current_app.logger.error(f"Batch upload error: {str(e)}")
+        return _api_error('Could not store batch', 500)
+    
+    queue_previews((row['sha256'], row['mime_type']) for row in rows)
+    return jsonify({
+        'count': len(rows),
+        'files': [
+            {
+                'filename': row['original_filename'],
+                'file_id': row['file_id'],
+                'share_url': url_for('download.download_file', file_id=row['file_id'], _external=True),
+                'size': row['file_size'],
+                'sha256': row['sha256'],
+            }
+            for row in rows
+        ],
+        'rejected': rejected,
+        'collection': {
+            'collection_id': collection.collection_id,
+            'url': url_for('download.view_collection', collection_id=collection.collection_id, _external=True),
+        } if collection else None,
+    }), 201
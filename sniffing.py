@@ -0,0 +1,173 @@
+"""Content-type detection from the first bytes of an upload
+
+Uploads are checked as they are streamed: streaming.copy_stream holds
+back the first SNIFF_LENGTH bytes, hands them to a ContentSniffer, and
+only writes anything once the content matches the file's extension. A
+renamed executable or any other mismatch is refused before the rest of
+the body reaches staging. The detected type is stored on the share and
+served as-is on download.
+
+Signatures are looked up by their first byte in a table built at import,
+so a check is a dict lookup and a couple of prefix comparisons.
+"""
+from utils import MIME_TYPES
+
+# Bytes held back and inspected; PDF readers accept a header anywhere in the first KB
+SNIFF_LENGTH = 1024
+
+# Containers shared by several extensions: the extension names the specific type
+ZIP = 'application/zip'
+OLE = 'application/x-ole-storage'
+CONTAINERS = {ZIP, OLE}
+
+_SIGNATURES = {}
+for _prefix, _mime in (
+    (b'%PDF-', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'PK\x03\x04', ZIP),
+    (b'PK\x05\x06', ZIP),
+    (b'PK\x07\x08', ZIP),
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', OLE),
+    (b'Rar!\x1a\x07', 'application/x-rar-compressed'),
+    (b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (b'ID3', 'audio/mpeg'),
+    # Byte order marks
+    (b'\xef\xbb\xbf', 'text/plain'),
+    (b'\xff\xfe', 'text/plain'),
+    (b'\xfe\xff', 'text/plain'),
+):
+    _SIGNATURES.setdefault(_prefix[0], []).append((_prefix, _mime))
+
+_RIFF_FORMATS = {b'WAVE': 'audio/wav', b'AVI ': 'video/x-msvideo'}
+# ISO base media boxes that may open a file: ftyp, or a bare QuickTime atom
+_QUICKTIME_ATOMS = {b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot'}
+# Control characters that never appear in text (everything below 0x20 but
+# BEL, BS, TAB, LF, FF, CR and ESC), as libmagic treats them
+_BINARY_BYTES = bytes(sorted(set(range(0x20)) - {7, 8, 9, 10, 12, 13, 27}))
+
+# Detected types each allowed extension may have
+EXTENSION_CONTENT = {
+    'txt': {'text/plain'},
+    'pdf': {'application/pdf'},
+    'png': {'image/png'},
+    'jpg': {'image/jpeg'},
+    'jpeg': {'image/jpeg'},
+    'gif': {'image/gif'},
+    'doc': {OLE},
+    'xls': {OLE},
+    'ppt': {OLE},
+    'docx': {ZIP},
+    'xlsx': {ZIP},
+    'pptx': {ZIP},
+    'zip': {ZIP},
+    'rar': {'application/x-rar-compressed'},
+    '7z': {'application/x-7z-compressed'},
+    'mp3': {'audio/mpeg'},
+    'wav': {'audio/wav'},
+    'mp4': {'video/mp4', 'video/quicktime'},
+    'mov': {'video/quicktime', 'video/mp4'},
+    'avi': {'video/x-msvideo'},
+}
+
+# Stored type back to what sniff() reports for it
+_DETECTED_AS = {MIME_TYPES[ext]: ZIP for ext in ('docx', 'xlsx', 'pptx')}
+_DETECTED_AS.update({MIME_TYPES[ext]: OLE for ext in ('doc', 'xls', 'ppt')})
+
+
+class ContentTypeMismatch(Exception):
+    """The content of an upload does not match its file extension"""
+
+
+def _is_mpeg_frame(head):
+    # 11-bit frame sync, then neither the reserved version nor the reserved layer
+    return (len(head) >= 2 and head[0] == 0xff and head[1] & 0xe0 == 0xe0
+            and head[1] & 0x18 != 0x08 and head[1] & 0x06 != 0)
+
+
+def _is_box_size(head, length):
+    # A box opens with its big-endian size: 0 (runs to the end of the file),
+    # 1 (a 64-bit size follows) or at least its own 8-byte header
+    size = int.from_bytes(head[:4], 'big')
+    return size in (0, 1) or 8 <= size <= (length if length is not None else size)
+
+
+def _is_text(head):
+    return len(head.translate(None, _BINARY_BYTES)) == len(head)
+
+
+def sniff(head, length=None):
+    """MIME type of content starting with ``head``, or None if it is not recognised
+
+    ``length``, the size of the whole file when known, rules out boxes
+    claiming to be larger than it.
+    """
+    if not head:
+        return None
+    for prefix, mime in _SIGNATURES.get(head[0], ()):
+        if head.startswith(prefix):
+            return mime
+    if head.startswith(b'RIFF'):
+        return _RIFF_FORMATS.get(head[8:12])
+    box = head[4:8]
+    if box == b'ftyp' and _is_box_size(head, length):
+        return 'video/quicktime' if head[8:12] == b'qt  ' else 'video/mp4'
+    # Bare atom names are ordinary words ("The free ...", "Let skip ..."),
+    # so text that happens to carry one in bytes 4-8 stays text
+    if box in _QUICKTIME_ATOMS and _is_box_size(head, length) and not _is_text(head):
+        return 'video/quicktime'
+    if _is_mpeg_frame(head):
+        return 'audio/mpeg'
+    if head.find(b'%PDF-', 0, SNIFF_LENGTH) != -1:
+        return 'application/pdf'
+    if _is_text(head):
+        return 'text/plain'
+    return None
+
+
+def _extension(filename):
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+def content_type_for(filename, detected):
+    """Type to store for a file with content detected as ``detected``
+
+    Raises ContentTypeMismatch unless that content is expected for the
+    file's extension. Containers take the extension's more specific type.
+    """
+    ext = _extension(filename)
+    if detected not in EXTENSION_CONTENT.get(ext, ()):
+        raise ContentTypeMismatch(f'{filename} does not contain {ext or "this kind of"} data')
+    if detected in CONTAINERS:
+        return MIME_TYPES[ext]
+    return detected
+
+
+def content_type_of_stored(filename, stored_mime):
+    """content_type_for() for content already checked and stored as ``stored_mime``"""
+    return content_type_for(filename, _DETECTED_AS.get(stored_mime, stored_mime))
+
+
+class ContentSniffer:
+    """check_head callback for streaming.copy_stream that records the detected type
+
+    With ``length``, the size of the whole upload, a head cut short by the
+    end of a resumable upload chunk is let through unchecked (mime_type
+    stays None) and left to the check when the upload is finalized.
+    """
+
+    def __init__(self, filename, length=None):
+        self.filename = filename
+        self.length = length
+        self.mime_type = None
+
+    def __call__(self, head):
+        if self.length is not None and len(head) < min(SNIFF_LENGTH, self.length):
+            return
+        # An empty file has nothing to misrepresent
+        if not head:
+            self.mime_type = MIME_TYPES.get(_extension(self.filename), 'application/octet-stream')
+            return
+        self.mime_type = content_type_for(self.filename, sniff(head, self.length))
@@ -0,0 +1,284 @@
+import os
+import secrets
+import shutil
+from collections import namedtuple
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+from flask import current_app
+from werkzeug.http import dump_options_header
+
+from streaming import STREAM_BLOCK_SIZE, content_disposition, iter_file_range
+
+# Size in bytes and last modification time (aware, UTC) of a stored object
+StoredObject = namedtuple('StoredObject', ['size', 'modified'])
+
+
+class StorageBackend:
+    """Interface every storage driver implements
+
+    Keys are relative, slash-separated names such as a blob's SHA-256.
+    Missing keys raise FileNotFoundError from stat() and get_range_stream().
+    """
+
+    def put_file(self, key, path):
+        """Move a finished local file into storage under key"""
+        raise NotImplementedError
+
+    def put_stream(self, key, stream, length=None):
+        """Store everything read from a binary stream under key"""
+        raise NotImplementedError
+
+    def get_range_stream(self, key, start, stop, block_size=STREAM_BLOCK_SIZE):
+        """Yield bytes [start, stop) of an object in bounded blocks"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove an object; removing a missing key is not an error"""
+        raise NotImplementedError
+
+    def copy(self, key, new_key):
+        """Make the object at key also available under new_key"""
+        raise NotImplementedError
+
+    def list_objects(self, start_after='', limit=1000):
+        """Up to ``limit`` (key, StoredObject) pairs with keys after start_after, in key order"""
+        raise NotImplementedError
+
+    def stat(self, key):
+        """Return a StoredObject for key"""
+        raise NotImplementedError
+
+    def presigned_url(self, key, expires_in, download_name=None, mimetype=None, content_encoding=None):
+        """Time-limited URL a client can fetch the object from directly, or None"""
+        return None
+
+    def local_path(self, key):
+        """Filesystem path of the object when it lives on local disk, or None"""
+        return None
+
+
+class LocalStorage(StorageBackend):
+    """Objects stored as plain files under one directory"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def local_path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def put_file(self, key, path):
+        target = self.local_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+
+    def put_stream(self, key, stream, length=None):
+        target = self.local_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Write beside the target and rename so readers never see a partial object
+        temp_path = f'{target}.{secrets.token_hex(8)}.part'
+        try:
+            with open(temp_path, 'wb') as f:
+                while True:
+                    chunk = stream.read(STREAM_BLOCK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            os.replace(temp_path, target)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def get_range_stream(self, key, start, stop, block_size=STREAM_BLOCK_SIZE):
+        return iter_file_range(self.local_path(key), start, stop, block_size)
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def copy(self, key, new_key):
+        source, target = self.local_path(key), self.local_path(new_key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # A hard link costs no I/O; filesystems without them get a real copy
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            pass
+        except OSError:
+            if not os.path.exists(source):
+                raise FileNotFoundError(key)
+            temp_path = f'{target}.{secrets.token_hex(8)}.part'
+            shutil.copyfile(source, temp_path)
+            os.replace(temp_path, target)
+
+    def stat(self, key):
+        stat_result = os.stat(self.local_path(key))
+        return StoredObject(stat_result.st_size,
+                            datetime.fromtimestamp(int(stat_result.st_mtime), timezone.utc))
+
+    def list_objects(self, start_after='', limit=1000):
+        found = []
+        self._walk(self.root, '', start_after.split('/') if start_after else [], found, limit)
+        return found
+
+    def _walk(self, directory, prefix, cursor, found, limit):
+        """Depth-first walk in name order, skipping everything up to the cursor path
+
+        Only the directories on the cursor's path and after it are listed,
+        so resuming deep into a sharded tree does not rescan what came before.
+        Dot entries (the staging folder) and in-flight .part files are skipped.
+        """
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if len(found) >= limit:
+                return
+            name = entry.name
+            if name.startswith('.') or name.endswith('.part') or (cursor and name < cursor[0]):
+                continue
+            below = cursor[1:] if cursor and name == cursor[0] else []
+            if entry.is_dir(follow_symlinks=False):
+                self._walk(entry.path, f'{prefix}{name}/', below, found, limit)
+            elif not (cursor and name == cursor[0]):
+                stat_result = entry.stat()
+                found.append((prefix + name, StoredObject(
+                    stat_result.st_size, datetime.fromtimestamp(int(stat_result.st_mtime), timezone.utc))))
+
+
+class S3Storage(StorageBackend):
+    """Objects stored in an S3-compatible bucket (AWS S3, MinIO, moto)
+
+    Requires boto3. ``endpoint_url`` points the client at a non-AWS
+    server; credentials come from the usual AWS environment variables.
+    """
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region_name=None, client=None):
+        if client is None:
+            import boto3
+
+            client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region_name)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+
+    def _key(self, key):
+        return f'{self.prefix}/{key}' if self.prefix else key
+
+    def _missing(self, error):
+        code = error.response.get('Error', {}).get('Code')
+        return code in ('404', 'NoSuchKey', 'NotFound')
+
+    def put_file(self, key, path):
+        self.client.upload_file(path, self.bucket, self._key(key))
+        os.remove(path)
+
+    def put_stream(self, key, stream, length=None):
+        self.client.upload_fileobj(stream, self.bucket, self._key(key))
+
+    def get_range_stream(self, key, start, stop, block_size=STREAM_BLOCK_SIZE):
+        from botocore.exceptions import ClientError
+
+        if stop <= start:
+            return
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(key),
+                                              Range=f'bytes={start}-{stop - 1}')
+        except ClientError as e:
+            if self._missing(e):
+                raise FileNotFoundError(key) from e
+            raise
+        body = response['Body']
+        try:
+            yield from body.iter_chunks(block_size)
+        finally:
+            body.close()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def copy(self, key, new_key):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.copy({'Bucket': self.bucket, 'Key': self._key(key)}, self.bucket, self._key(new_key))
+        except ClientError as e:
+            if self._missing(e):
+                raise FileNotFoundError(key) from e
+            raise
+
+    def list_objects(self, start_after='', limit=1000):
+        params = {'Bucket': self.bucket, 'MaxKeys': limit}
+        if self.prefix:
+            params['Prefix'] = f'{self.prefix}/'
+        if start_after:
+            params['StartAfter'] = self._key(start_after)
+        strip = len(self.prefix) + 1 if self.prefix else 0
+        found = []
+        for item in self.client.list_objects_v2(**params).get('Contents', []):
+            modified = item['LastModified']
+            if modified.tzinfo is None:
+                modified = modified.replace(tzinfo=timezone.utc)
+            found.append((item['Key'][strip:], StoredObject(item['Size'], modified.replace(microsecond=0))))
+        return found
+
+    def stat(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if self._missing(e):
+                raise FileNotFoundError(key) from e
+            raise
+        modified = response['LastModified']
+        if modified.tzinfo is None:
+            modified = modified.replace(tzinfo=timezone.utc)
+        return StoredObject(response['ContentLength'], modified.replace(microsecond=0))
+
+    def presigned_url(self, key, expires_in, download_name=None, mimetype=None, content_encoding=None):
+        params = {'Bucket': self.bucket, 'Key': self._key(key)}
+        if download_name:
+            disposition, names = content_disposition(download_name)
+            params['ResponseContentDisposition'] = dump_options_header(disposition, names)
+        if mimetype:
+            params['ResponseContentType'] = mimetype
+        if content_encoding:
+            params['ResponseContentEncoding'] = content_encoding
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=int(expires_in))
+
+
+def create_storage(config):
+    """Build the backend named by STORAGE_URL
+
+    ``file:///abs/path`` or an empty value stores files under UPLOAD_FOLDER;
+    ``s3://bucket/prefix`` uses S3Storage with S3_ENDPOINT_URL and S3_REGION.
+    """
+    url = config.get('STORAGE_URL') or ''
+    parsed = urlparse(url)
+    if parsed.scheme in ('', 'file'):
+        return LocalStorage(parsed.path or config['UPLOAD_FOLDER'])
+    if parsed.scheme == 's3':
+        try:
+            return S3Storage(parsed.netloc, prefix=parsed.path,
+                             endpoint_url=config.get('S3_ENDPOINT_URL') or None,
+                             region_name=config.get('S3_REGION') or None)
+        except ImportError:
+            raise RuntimeError("STORAGE_URL is an s3:// URL but the boto3 package is not installed")
+    raise ValueError(f"Unsupported STORAGE_URL scheme: {parsed.scheme}")
+
+
+def get_storage():
+    """Return the application's storage backend, creating it on first use"""
+    storage = current_app.extensions.get('storage')
+    if storage is None:
+        from metrics import instrument_storage
+
+        storage = instrument_storage(create_storage(current_app.config))
+        current_app.extensions['storage'] = storage
+    return storage
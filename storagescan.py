@@ -0,0 +1,347 @@
+"""Sharded storage layout migration and a disk/database consistency scanner
+
+New blobs are stored under sharded keys (ab/cd/abcd...). `flask --app
+main storage relayout` stores files uploaded before blob storage as
+blobs, then moves blobs stored under the older flat layout into place.
+`flask --app main storage scan` reconciles storage with the blobs and
+file_shares tables:
+
+    blobs     rows whose stored object is missing
+    shares    file_shares rows whose blob row is missing
+    objects   stored objects no blob, preview or pre-blob share points at
+    staging   files in the staging folder no upload is using
+
+Every phase works in bounded batches: one short read per batch, storage
+calls outside any transaction, and a cursor saved in scan_cursors, so a
+run from cron continues where the previous one stopped and wraps around
+at the end. Nothing is changed without --repair.
+"""
+import os
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app import db
+from models import Blob, FileShare, Preview, ScanCursor, UploadSession
+from blobstore import STAGING_DIR, adopt_legacy_files, has_legacy_file_paths, remove_blob, sharded_key
+from cache import invalidate_share
+from reaper import reap_shares
+from storage import get_storage
+
+
+def _old_keys_grace():
+    """Seconds an object must outlive its key being changed
+
+    Cached share snapshots, and presigned URLs when those are handed out,
+    may still point at the old key until then.
+    """
+    config = current_app.config
+    grace = config['SHARE_CACHE_TTL']
+    if config['STORAGE_PRESIGNED_DOWNLOADS']:
+        grace += config['STORAGE_PRESIGN_TTL']
+    return grace
+
+
+def _remove_due(pending, grace, wait=False):
+    """Remove old keys whose grace period is over; with wait, sleep until all are"""
+    removed = 0
+    while pending and (wait or time.monotonic() - pending[0][0] >= grace):
+        committed_at, keys = pending.popleft()
+        time.sleep(max(0.0, committed_at + grace - time.monotonic()))
+        for key in keys:
+            remove_blob(key)
+        removed += len(keys)
+    return removed
+
+
+def relayout(batch_size=500, max_batches=None):
+    """Move blobs stored under flat keys to sharded keys; returns a dict of counts
+
+    Files of shares uploaded before blob storage are first stored as
+    blobs, under sharded keys. Each object is copied (a hard link on local
+    disk) before its row is repointed, and the old key is removed only
+    once nothing can still be reading it, so downloads keep working
+    throughout.
+    """
+    storage = get_storage()
+    grace = _old_keys_grace()
+    totals = Counter(batches=0, checked=0, moved=0, missing=0, removed=0)
+    totals['adopted'], totals['adopt_missing'] = adopt_legacy_files(batch_size)
+    pending = deque()
+    after = ''
+    while max_batches is None or totals['batches'] < max_batches:
+        rows = db.session.execute(
+            db.select(Blob.sha256, Blob.storage_key)
+            .where(Blob.sha256 > after)
+            .order_by(Blob.sha256)
+            .limit(batch_size)
+        ).all()
+        db.session.rollback()
+        if not rows:
+            break
+        after = rows[-1].sha256
+        totals['batches'] += 1
+        totals['checked'] += len(rows)
+
+        moves = []
+        for sha256, key in rows:
+            if '/' in key:
+                continue
+            try:
+                storage.copy(key, sharded_key(key))
+            except FileNotFoundError:
+                totals['missing'] += 1
+                continue
+            moves.append((sha256, key, sharded_key(key)))
+
+        moved, unused = [], []
+        for sha256, key, new_key in moves:
+            result = db.session.execute(
+                db.update(Blob).where(Blob.sha256 == sha256, Blob.storage_key == key).values(storage_key=new_key)
+            )
+            (moved if result.rowcount == 1 else unused).append((sha256, key, new_key))
+        file_ids = db.session.execute(
+            db.select(FileShare.file_id).where(FileShare.sha256.in_([sha256 for sha256, _, _ in moved]))
+        ).scalars().all() if moved else []
+        db.session.commit()
+        invalidate_share(*file_ids)
+        # Rows deleted or re-stored meanwhile leave only the copy made here
+        for _, _, new_key in unused:
+            storage.delete(new_key)
+
+        totals['moved'] += len(moved)
+        pending.append((time.monotonic(), [key for _, key, _ in moved]))
+        totals['removed'] += _remove_due(pending, grace)
+    totals['removed'] += _remove_due(pending, grace, wait=True)
+    return dict(totals)
+
+
+def _scan_blobs(batch_size, max_batches, repair, totals):
+    storage = get_storage()
+    after = ScanCursor.load('blobs')
+    for _ in range(max_batches):
+        rows = db.session.execute(
+            db.select(Blob.sha256, Blob.storage_key)
+            .where(Blob.sha256 > after)
+            .order_by(Blob.sha256)
+            .limit(batch_size)
+        ).all()
+        db.session.rollback()
+        after = rows[-1].sha256 if rows else ''
+        totals['blobs_checked'] += len(rows)
+
+        missing = {}
+        for sha256, key in rows:
+            try:
+                storage.stat(key)
+            except FileNotFoundError:
+                missing[sha256] = key
+        if missing:
+            # A blob relaid out since the read has a new key that does exist
+            current = dict(db.session.execute(
+                db.select(Blob.sha256, Blob.storage_key).where(Blob.sha256.in_(list(missing)))
+            ).all())
+            db.session.rollback()
+            missing = {sha256: key for sha256, key in missing.items() if current.get(sha256) == key}
+        for sha256, key in missing.items():
+            current_app.logger.warning(f"Storage scan: blob {sha256} has no object at {key}")
+        totals['blobs_missing'] += len(missing)
+
+        if missing and repair:
+            # Shares of content that is gone can never be served
+            reap_shares(FileShare.sha256.in_(list(missing)), FileShare.id, batch_size, max_batches, totals)
+            preview_keys = db.session.execute(
+                db.delete(Preview)
+                .where(Preview.sha256.in_(list(missing)),
+                       ~db.select(FileShare.id).where(FileShare.sha256 == Preview.sha256).exists())
+                .returning(Preview.storage_key)
+            ).scalars().all()
+            deleted = db.session.execute(
+                db.delete(Blob)
+                .where(Blob.sha256.in_(list(missing)),
+                       ~db.select(FileShare.id).where(FileShare.sha256 == Blob.sha256).exists())
+                .execution_options(synchronize_session=False)
+            )
+            totals['blob_rows_deleted'] += deleted.rowcount
+        ScanCursor.save('blobs', after)
+        db.session.commit()
+        if missing and repair:
+            for key in preview_keys:
+                remove_blob(key)
+        if not rows:
+            break
+
+
+def _scan_shares(batch_size, max_batches, repair, totals):
+    after = int(ScanCursor.load('shares') or 0)
+    for _ in range(max_batches):
+        rows = db.session.execute(
+            db.select(FileShare.id, FileShare.sha256)
+            .where(FileShare.id > after)
+            .order_by(FileShare.id)
+            .limit(batch_size)
+        ).all()
+        after = rows[-1].id if rows else 0
+        totals['shares_checked'] += len(rows)
+
+        stored = set(db.session.execute(
+            db.select(Blob.sha256).where(Blob.sha256.in_({sha256 for _, sha256 in rows}))
+        ).scalars()) if rows else set()
+        db.session.rollback()
+        # Shares with no sha256 yet are pre-blob uploads waiting for migrate or relayout
+        dangling = [share_id for share_id, sha256 in rows if sha256 is not None and sha256 not in stored]
+        for share_id in dangling:
+            current_app.logger.warning(f"Storage scan: share {share_id} points at a blob row that does not exist")
+        totals['shares_dangling'] += len(dangling)
+
+        if dangling and repair:
+            reap_shares(FileShare.id.in_(dangling), FileShare.id, batch_size, max_batches, totals)
+        ScanCursor.save('shares', str(after) if after else '')
+        db.session.commit()
+        if not rows:
+            break
+
+
+def _legacy_paths():
+    """Absolute paths of the files shares from before blob storage still point at
+
+    Those files sit under UPLOAD_FOLDER with no blob row until migrate or
+    relayout stores them, so the objects phase must leave them alone.
+    """
+    if not has_legacy_file_paths():
+        return set()
+    file_path = db.literal_column('file_shares.file_path')
+    paths = db.session.execute(
+        db.select(file_path).select_from(FileShare).where(FileShare.sha256.is_(None), file_path.isnot(None))
+    ).scalars().all()
+    return {os.path.abspath(path) for path in paths}
+
+
+def _scan_objects(batch_size, max_batches, repair, cutoff, totals):
+    storage = get_storage()
+    after = ScanCursor.load('objects')
+    legacy = _legacy_paths()
+    db.session.rollback()
+    for _ in range(max_batches):
+        objects = storage.list_objects(after, batch_size)
+        after = objects[-1][0] if objects else ''
+        totals['objects_checked'] += len(objects)
+
+        keys = [key for key, _ in objects]
+        referenced = set(db.session.execute(
+            db.select(Blob.storage_key).where(Blob.storage_key.in_(keys))
+            .union_all(db.select(Preview.storage_key).where(Preview.storage_key.in_(keys)))
+        ).scalars()) if objects else set()
+        db.session.rollback()
+        if legacy:
+            referenced.update(key for key in keys
+                              if storage.local_path(key) and os.path.abspath(storage.local_path(key)) in legacy)
+        # Objects just put by an upload get their row when it commits
+        orphans = [(key, stored) for key, stored in objects if key not in referenced and stored.modified < cutoff]
+        for key, stored in orphans:
+            current_app.logger.warning(f"Storage scan: object {key} ({stored.size} bytes) belongs to no blob or preview")
+        totals['objects_orphaned'] += len(orphans)
+
+        if orphans and repair:
+            for key, stored in orphans:
+                remove_blob(key)
+                totals['bytes_reclaimed'] += stored.size
+            totals['objects_deleted'] += len(orphans)
+        ScanCursor.save('objects', after)
+        db.session.commit()
+        if not objects:
+            break
+
+
+def _scan_staging(batch_size, max_batches, repair, cutoff, totals):
+    staging_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], STAGING_DIR)
+    try:
+        names = sorted(entry.name for entry in os.scandir(staging_folder) if entry.is_file())
+    except FileNotFoundError:
+        names = []
+    after = ScanCursor.load('staging')
+    db.session.rollback()
+    names = [name for name in names if name > after]
+    todo = names[:batch_size * max_batches]
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        paths = [os.path.join(staging_folder, name) for name in batch]
+        totals['staging_checked'] += len(batch)
+        in_use = set(db.session.execute(
+            db.select(UploadSession.file_path).where(UploadSession.file_path.in_(paths))
+        ).scalars())
+        db.session.rollback()
+        for path in paths:
+            if path in in_use:
+                continue
+            try:
+                stat_result = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if datetime.fromtimestamp(stat_result.st_mtime, timezone.utc) >= cutoff:
+                continue
+            current_app.logger.warning(f"Storage scan: staging file {path} belongs to no upload")
+            totals['staging_orphaned'] += 1
+            if repair:
+                try:
+                    os.remove(path)
+                    totals['staging_deleted'] += 1
+                    totals['bytes_reclaimed'] += stat_result.st_size
+                except FileNotFoundError:
+                    pass
+    # Start over next time once every file has been seen
+    after = todo[-1] if len(names) > len(todo) else ''
+    ScanCursor.save('staging', after)
+    db.session.commit()
+
+
+def scan(batch_size=500, max_batches=20, repair=False, grace=3600):
+    """Check up to max_batches of each phase; returns a dict of counts
+
+    Objects and staging files younger than ``grace`` seconds are never
+    reported, since an upload may be about to commit the row that owns them.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace)
+    totals = Counter(blobs_checked=0, blobs_missing=0, shares_checked=0, shares_dangling=0,
+                     objects_checked=0, objects_orphaned=0, staging_checked=0, staging_orphaned=0)
+    if repair:
+        # reap_shares adds its own counts (shares_deleted, blobs_deleted, ...) as it goes
+        totals.update(shares_deleted=0, blob_rows_deleted=0, objects_deleted=0, staging_deleted=0,
+                      bytes_reclaimed=0)
+    started = time.perf_counter()
+    _scan_blobs(batch_size, max_batches, repair, totals)
+    _scan_shares(batch_size, max_batches, repair, totals)
+    _scan_objects(batch_size, max_batches, repair, cutoff, totals)
+    _scan_staging(batch_size, max_batches, repair, cutoff, totals)
+    metrics = dict(totals)
+    metrics['duration_s'] = round(time.perf_counter() - started, 3)
+    return metrics
+
+
+@click.group('storage')
+def storage_cli():
+    """Storage layout and consistency tools"""
+
+
+@storage_cli.command('relayout')
+@click.option('--batch-size', type=int, default=500, help='Blobs moved per transaction.')
+@click.option('--max-batches', type=int, default=None, help='Stop after this many batches.')
+@with_appcontext
+def relayout_command(batch_size, max_batches):
+    """Store pre-blob uploads as blobs and move flat-layout blobs to sharded keys"""
+    click.echo(relayout(batch_size=batch_size, max_batches=max_batches))
+
+
+@storage_cli.command('scan')
+@click.option('--batch-size', type=int, default=500, help='Rows or objects checked per batch.')
+@click.option('--max-batches', type=int, default=20, help='Upper bound on batches per phase.')
+@click.option('--grace', type=int, default=3600, help='Seconds before an unowned object counts as orphaned.')
+@click.option('--repair', is_flag=True, help='Delete orphans and shares whose content is gone.')
+@with_appcontext
+def scan_command(batch_size, max_batches, grace, repair):
+    """Reconcile stored objects with the blobs and file_shares tables"""
+    click.echo(scan(batch_size=batch_size, max_batches=max_batches, repair=repair, grace=grace))
@@ -0,0 +1,233 @@
+import secrets
+import unicodedata
+from urllib.parse import quote
+
+from flask import current_app, request
+from werkzeug.http import parse_range_header, parse_if_range_header
+
+# Block size handed to wsgi.file_wrapper and used by the fallback iterator
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# Requests asking for more ranges than this are answered with the whole file
+MAX_RANGES = 16
+
+
+def content_disposition(download_name, as_attachment=True):
+    """Build Content-Disposition options for a (possibly non-ASCII) filename"""
+    try:
+        download_name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name)
+        simple = simple.encode('ascii', 'ignore').decode('ascii')
+        quoted = quote(download_name, safe="!#$&+-.^_`|~")
+        names = {'filename': simple, 'filename*': f"UTF-8''{quoted}"}
+    else:
+        names = {'filename': download_name}
+    return ('attachment' if as_attachment else 'inline'), names
+
+
+def resolve_ranges(range_header, length):
+    """Turn a Range header into a sorted list of coalesced (start, stop) pairs
+
+    Returns None when the header is absent or malformed (serve the whole file)
+    and an empty list when no range is satisfiable (416).
+    """
+    if not range_header:
+        return None
+    parsed = parse_range_header(range_header)
+    if parsed is None or parsed.units != 'bytes':
+        return None
+    if len(parsed.ranges) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for start, stop in parsed.ranges:
+        if start < 0:
+            start = max(0, length + start)
+            stop = length
+        elif stop is None or stop > length:
+            stop = length
+        if start < stop:
+            ranges.append((start, stop))
+
+    # Merge overlapping or adjacent ranges so no byte is sent twice
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def if_range_matches(header, etag, last_modified):
+    """Check whether an If-Range precondition allows a partial response"""
+    if not header:
+        return True
+    if_range = parse_if_range_header(header)
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None and last_modified is not None:
+        return int(last_modified.timestamp()) <= int(if_range.date.timestamp())
+    return False
+
+
+def iter_file_range(path, start, stop, block_size=STREAM_BLOCK_SIZE):
+    """Yield bytes [start, stop) of a file in bounded blocks"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(block_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _zero_copy_body(path, start, stop):
+    """Return a body the WSGI server can sendfile(), or a bounded iterator
+
+    gunicorn's wsgi.file_wrapper sends exactly Content-Length bytes from the
+    current file offset with os.sendfile, so seeking first is all a range
+    needs. Servers without a file wrapper get a plain generator instead.
+    """
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is None:
+        return iter_file_range(path, start, stop)
+    f = open(path, 'rb')
+    try:
+        f.seek(start)
+        return file_wrapper(f, STREAM_BLOCK_SIZE)
+    except Exception:
+        f.close()
+        raise
+
+
+def multipart_layout(ranges, length, mimetype):
+    """Plan a multipart/byteranges body: (boundary, part headers, trailer, total length)"""
+    boundary = secrets.token_hex(16)
+    part_headers = [
+        (f'\r\n--{boundary}\r\n'
+         f'Content-Type: {mimetype}\r\n'
+         f'Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n').encode('ascii')
+        for start, stop in ranges
+    ]
+    trailer = f'\r\n--{boundary}--\r\n'.encode('ascii')
+    body_length = sum(len(h) for h in part_headers)
+    body_length += sum(stop - start for start, stop in ranges)
+    body_length += len(trailer)
+    return boundary, part_headers, trailer, body_length
+
+
+def _multipart_body(storage, key, ranges, part_headers, trailer):
+    """Yield a multipart/byteranges body for several ranges of one object"""
+    for (start, stop), headers in zip(ranges, part_headers):
+        yield headers
+        yield from storage.get_range_stream(key, start, stop)
+    yield trailer
+
+
+def send_object_ranges(storage, key, download_name, mimetype, etag=None, as_attachment=True):
+    """Serve a stored object with Range, If-Range and conditional GET support
+
+    Objects on local disk are handed to the server's wsgi.file_wrapper for
+    full and single-range responses so gunicorn can stream them with
+    os.sendfile; other backends are streamed block by block. Multi-range
+    requests are answered with multipart/byteranges.
+    """
+    stored = storage.stat(key)
+    length = stored.size
+    if etag is None:
+        etag = f'{length:x}-{int(stored.modified.timestamp()):x}'
+    last_modified = stored.modified
+    path = storage.local_path(key)
+
+    def body(start, stop):
+        if path is not None:
+            return _zero_copy_body(path, start, stop)
+        return storage.get_range_stream(key, start, stop)
+
+    response_class = current_app.response_class
+    disposition, names = content_disposition(download_name, as_attachment)
+
+    def base_response(body, status):
+        rv = response_class(body, status=status, mimetype=mimetype, direct_passthrough=True)
+        rv.headers.set('Content-Disposition', disposition, **names)
+        rv.headers['Accept-Ranges'] = 'bytes'
+        rv.set_etag(etag)
+        rv.last_modified = last_modified
+        rv.cache_control.private = True
+        rv.cache_control.no_transform = True
+        return rv
+
+    # Conditional GET: the client already has this exact representation
+    if request.if_none_match.contains(etag):
+        return base_response(None, 304)
+
+    ranges = None
+    if if_range_matches(request.headers.get('If-Range'), etag, last_modified):
+        ranges = resolve_ranges(request.headers.get('Range'), length)
+
+    if ranges is None:
+        rv = base_response(body(0, length), 200)
+        rv.content_length = length
+        return rv
+
+    if not ranges:
+        rv = base_response(None, 416)
+        rv.headers['Content-Range'] = f'bytes */{length}'
+        return rv
+
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        rv = base_response(body(start, stop), 206)
+        rv.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+        rv.content_length = stop - start
+        return rv
+
+    boundary, part_headers, trailer, body_length = multipart_layout(ranges, length, mimetype)
+    rv = base_response(_multipart_body(storage, key, ranges, part_headers, trailer), 206)
+    rv.headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+    rv.content_length = body_length
+    return rv
+
+
+def copy_stream(source, target, hasher=None, limit=None, block_size=STREAM_BLOCK_SIZE,
+                check_head=None, head_length=1024):
+    """Copy a binary stream into an open file, hashing it in the same pass
+
+    Returns the number of bytes copied. Raises ValueError once more than
+    ``limit`` bytes have been read so oversized bodies are cut off early.
+    With ``check_head``, the first ``head_length`` bytes (all of them for
+    a shorter stream) are passed to it before anything is written, so it
+    can refuse the body by raising.
+    """
+    copied = 0
+    head = b''
+    while True:
+        chunk = source.read(block_size)
+        if check_head is not None:
+            head += chunk
+            if chunk and len(head) < head_length:
+                continue
+            check_head(head)
+            check_head = None
+            chunk = head
+        if not chunk:
+            break
+        copied += len(chunk)
+        if limit is not None and copied > limit:
+            raise ValueError('stream exceeds the allowed length')
+        target.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+    return copied
+
+
+def hash_file_prefix(path, length, hasher, block_size=STREAM_BLOCK_SIZE):
+    """Feed the first ``length`` bytes of a file into a hasher"""
+    for chunk in iter_file_range(path, 0, length, block_size):
+        hasher.update(chunk)
+    return hasher
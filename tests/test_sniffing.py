@@ -0,0 +1,38 @@
+import pytest
+
+from sniffing import ContentSniffer, ContentTypeMismatch, content_type_for, sniff
+
+
+@pytest.mark.parametrize('text', [
+    b'The free software movement',
+    b'Let skip this line',
+    b'The wide open road\n',
+    b'Thismdat is not a movie',
+    b'Somemoov and somepnot',
+])
+def test_text_with_quicktime_atom_names_is_text(text):
+    assert sniff(text) == 'text/plain'
+    assert sniff(text, len(text)) == 'text/plain'
+    assert content_type_for('notes.txt', sniff(text)) == 'text/plain'
+    sniffer = ContentSniffer('notes.txt')
+    sniffer(text)
+    assert sniffer.mime_type == 'text/plain'
+
+
+def test_quicktime_atoms_are_still_detected():
+    movie = (24).to_bytes(4, 'big') + b'moov' + b'\x00' * 16 + (8).to_bytes(4, 'big') + b'mdat'
+    assert sniff(movie) == 'video/quicktime'
+    assert sniff(b'\x00\x00\x00\x08wide\x00\x00\x01\x00mdat') == 'video/quicktime'
+    assert sniff(b'\x00\x00\x00\x18ftypqt  \x00\x00\x02\x00') == 'video/quicktime'
+    assert sniff(b'\x00\x00\x00\x18ftypisom\x00\x00\x02\x00') == 'video/mp4'
+
+
+def test_box_larger_than_the_file_is_not_quicktime():
+    head = b'\x7f\x00\x00\x00free\x00\x00'
+    assert sniff(head) == 'video/quicktime'
+    assert sniff(head, len(head)) is None
+
+
+def test_text_upload_with_mov_extension_is_refused():
+    with pytest.raises(ContentTypeMismatch):
+        content_type_for('clip.mov', sniff(b'The free software movement'))
@@ -0,0 +1,67 @@
+import hashlib
+import io
+
+import pytest
+
+from app import create_app, db
+from migrations import migrate
+from models import FileShare, User
+
+CONTENT = b'%PDF-1.4\n' + b'quarterly figures\n' * 200
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.db'),
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'PREVIEWS_ENABLED': False,
+        'ANALYTICS_ENABLED': False,
+    })
+    with app.app_context():
+        migrate()
+        for username in ('alice', 'bob'):
+            user = User(username=username, email=f'{username}@example.com')
+            user.set_password('secret1')
+            db.session.add(user)
+        db.session.commit()
+    yield app
+    with app.app_context():
+        db.engine.dispose()
+
+
+def login(app, username):
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': 'secret1'})
+    return client
+
+
+def shortcut(client):
+    return client.post('/api/uploads', json={
+        'filename': 'report.pdf',
+        'length': len(CONTENT),
+        'sha256': hashlib.sha256(CONTENT).hexdigest(),
+    })
+
+
+def test_owner_can_share_stored_content_by_hash(app):
+    alice = login(app, 'alice')
+    alice.post('/upload', data={'file': (io.BytesIO(CONTENT), 'report.pdf'), 'password': 'pw'})
+
+    response = shortcut(alice)
+    assert response.status_code == 201
+    assert response.get_json()['sha256'] == hashlib.sha256(CONTENT).hexdigest()
+
+
+def test_another_user_cannot_claim_content_by_hash(app):
+    alice = login(app, 'alice')
+    alice.post('/upload', data={'file': (io.BytesIO(CONTENT), 'report.pdf'), 'password': 'pw'})
+
+    response = shortcut(login(app, 'bob'))
+    # Bob has to send the bytes like any other upload
+    assert response.status_code == 201
+    assert 'upload_id' in response.get_json()
+    with app.app_context():
+        bob = User.query.filter_by(username='bob').one()
+        assert FileShare.query.filter_by(user_id=bob.id).count() == 0
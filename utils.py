@@ -1,4 +1,6 @@
+import base64
 import os
+import re
 import secrets
 import string
 from datetime import datetime, timezone
@@ -9,10 +11,44 @@ def generate_secure_token(length=32):
     alphabet = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
-def generate_file_id(length=12):
+# Public share and collection IDs: 9 random bytes (72 bits), which encode
+# to exactly 12 base64url characters with no padding. The database keeps
+# the 9 raw bytes; older 12-character base62 IDs decode the same way.
+FILE_ID_BYTES = 9
+FILE_ID_LENGTH = 12
+FILE_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{12}')
+
+def generate_file_id():
     """Generate a secure file ID for URLs"""
-    alphabet = string.ascii_letters + string.digits
-    return ''.join(secrets.choice(alphabet) for _ in range(length))
+    return base64.urlsafe_b64encode(secrets.token_bytes(FILE_ID_BYTES)).decode('ascii')
+
+def generate_file_ids(count):
+    """Generate ``count`` distinct file IDs from a single token_bytes call
+
+    Whole IDs line up with base64 groups, so one encode of the random
+    buffer sliced every FILE_ID_LENGTH characters yields every ID.
+    """
+    encoded = base64.urlsafe_b64encode(secrets.token_bytes(FILE_ID_BYTES * count)).decode('ascii')
+    ids = list(dict.fromkeys(encoded[i:i + FILE_ID_LENGTH] for i in range(0, len(encoded), FILE_ID_LENGTH)))
+    while len(ids) < count:
+        file_id = generate_file_id()
+        if file_id not in ids:
+            ids.append(file_id)
+    return ids
+
+def is_file_id(value):
+    """Whether value could be a share or collection ID at all"""
+    return isinstance(value, str) and FILE_ID_PATTERN.fullmatch(value) is not None
+
+def file_id_key(file_id):
+    """Binary form of a file ID as stored in the database; b'' for malformed IDs, which match nothing"""
+    if not is_file_id(file_id):
+        return b''
+    return base64.urlsafe_b64decode(file_id)
+
+def file_id_from_key(key):
+    """Inverse of file_id_key"""
+    return base64.urlsafe_b64encode(bytes(key)).decode('ascii')
 
 def secure_filename_with_timestamp(filename):
     """Generate a secure filename with timestamp"""
@@ -63,50 +99,31 @@ def validate_file_type(filename, allowed_extensions):
     extension = filename.rsplit('.', 1)[1].lower()
     return extension in allowed_extensions
 
-def clean_old_files(upload_folder, max_age_days=30):
-    """Clean up old files from upload folder"""
-    if not os.path.exists(upload_folder):
-        return
-    
-    now = datetime.now(timezone.utc)
-    cutoff_time = now.timestamp() - (max_age_days * 24 * 60 * 60)
-    
-    for filename in os.listdir(upload_folder):
-        file_path = os.path.join(upload_folder, filename)
-        if os.path.isfile(file_path):
-            file_time = os.path.getmtime(file_path)
-            if file_time < cutoff_time:
-                try:
-                    os.remove(file_path)
-                    print(f"Cleaned up old file: {filename}")
-                except OSError as e:
-                    print(f"Error cleaning up file {filename}: {e}")
+# MIME type served for each allowed extension
+MIME_TYPES = {
+    'txt': 'text/plain',
+    'pdf': 'application/pdf',
+    'doc': 'application/msword',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'xls': 'application/vnd.ms-excel',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'ppt': 'application/vnd.ms-powerpoint',
+    'pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'zip': 'application/zip',
+    'rar': 'application/x-rar-compressed',
+    '7z': 'application/x-7z-compressed',
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+    'mp3': 'audio/mpeg',
+    'wav': 'audio/wav',
+    'mp4': 'video/mp4',
+    'avi': 'video/x-msvideo',
+    'mov': 'video/quicktime'
+}
 
 def get_file_mime_type(filename):
-    """Get MIME type for file"""
+    """Get MIME type for file from its extension"""
     ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-    
-    mime_types = {
-        'txt': 'text/plain',
-        'pdf': 'application/pdf',
-        'doc': 'application/msword',
-        'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        'xls': 'application/vnd.ms-excel',
-        'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        'ppt': 'application/vnd.ms-powerpoint',
-        'pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-        'zip': 'application/zip',
-        'rar': 'application/x-rar-compressed',
-        '7z': 'application/x-7z-compressed',
-        'png': 'image/png',
-        'jpg': 'image/jpeg',
-        'jpeg': 'image/jpeg',
-        'gif': 'image/gif',
-        'mp3': 'audio/mpeg',
-        'wav': 'audio/wav',
-        'mp4': 'video/mp4',
-        'avi': 'video/x-msvideo',
-        'mov': 'video/quicktime'
-    }
-    
-    return mime_types.get(ext, 'application/octet-stream')
+    return MIME_TYPES.get(ext, 'application/octet-stream')
@@ -0,0 +1,254 @@
+import struct
+import zlib
+from collections import namedtuple
+from datetime import datetime
+from functools import partial
+
+from compression import INCOMPRESSIBLE_EXTENSIONS, select_representation
+from encryption import open_for_reading
+
+STORED = 0
+DEFLATED = 8
+
+# Sizes and offsets at or above this go into ZIP64 extra fields
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+# CRC and sizes follow the data in a descriptor (bit 3); names are UTF-8 (bit 11)
+FLAGS = 0x0008 | 0x0800
+
+# Made by: Unix, spec 4.5; external attributes: regular file, mode 0644
+MADE_BY = (3 << 8) | 45
+EXTERNAL_ATTR = 0o100644 << 16
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<4sHHHHHHIIIHHHHHII')
+DATA_DESCRIPTOR = struct.Struct('<4sIII')
+DATA_DESCRIPTOR64 = struct.Struct('<4sIQQ')
+END_RECORD = struct.Struct('<4sHHHHIIH')
+END_RECORD64 = struct.Struct('<4sQHHIIQQQQ')
+END_LOCATOR64 = struct.Struct('<4sIQI')
+
+# zlib's gzip wrapper (wbits=31) writes a 10-byte header and an 8-byte CRC/ISIZE trailer
+GZIP_HEADER_SIZE = 10
+GZIP_TRAILER = struct.Struct('<II')
+
+# One archive member. ``data`` returns a generator yielding the member's bytes
+# as they go into the archive and returning (crc32, compressed size);
+# compressed_size is None when it is only known after compressing
+ZipEntry = namedtuple('ZipEntry', ['name', 'modified', 'size', 'compressed_size', 'method', 'data'])
+
+
+def stored_data(chunks):
+    """Member data for a STORED entry: the bytes as they are"""
+    crc = 0
+    total = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        total += len(chunk)
+        yield chunk
+    return crc, total
+
+
+def deflated_data(chunks, level):
+    """Member data for a DEFLATED entry compressed on the fly"""
+    engine = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    total = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        packed = engine.compress(chunk)
+        if packed:
+            total += len(packed)
+            yield packed
+    packed = engine.flush()
+    total += len(packed)
+    yield packed
+    return crc, total
+
+
+def gzip_member_data(chunks, size):
+    """Member data for a DEFLATED entry copied out of a stored gzip stream
+
+    The raw deflate stream between gzip's header and trailer is exactly a
+    ZIP DEFLATED member, and the trailer carries its CRC, so compressed
+    blobs go into the archive without being decompressed or recompressed.
+    """
+    header = b''
+    held = b''
+    total = 0
+    for chunk in chunks:
+        if len(header) < GZIP_HEADER_SIZE:
+            needed = GZIP_HEADER_SIZE - len(header)
+            header += chunk[:needed]
+            chunk = chunk[needed:]
+            if len(header) == GZIP_HEADER_SIZE and header[:4] != b'\x1f\x8b\x08\x00':
+                raise ValueError('stored gzip stream has an unexpected header')
+        # Hold back the last trailer-sized bytes: they are not deflate data
+        held += chunk
+        if len(held) > GZIP_TRAILER.size:
+            out = held[:-GZIP_TRAILER.size]
+            held = held[-GZIP_TRAILER.size:]
+            total += len(out)
+            yield out
+    if len(held) != GZIP_TRAILER.size:
+        raise ValueError('stored gzip stream is truncated')
+    crc, isize = GZIP_TRAILER.unpack(held)
+    if isize != size & 0xFFFFFFFF:
+        raise ValueError('stored gzip stream does not match the recorded size')
+    return crc, total
+
+
+def _dos_datetime(modified):
+    if modified is None or modified.year < 1980:
+        modified = datetime(1980, 1, 1)
+    date = ((modified.year - 1980) << 9) | (modified.month << 5) | modified.day
+    time = (modified.hour << 11) | (modified.minute << 5) | (modified.second // 2)
+    return time, date
+
+
+def _max_compressed_size(entry):
+    if entry.compressed_size is not None:
+        return entry.compressed_size
+    # zlib's deflateBound for raw streams
+    size = entry.size
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13
+
+
+def _local_zip64(entry):
+    """Whether the entry's sizes may need 64 bits (decided before any data is sent)"""
+    return entry.size >= ZIP64_LIMIT or _max_compressed_size(entry) >= ZIP64_LIMIT
+
+
+def _local_header(entry, zip64):
+    name = entry.name.encode('utf-8')
+    time, date = _dos_datetime(entry.modified)
+    if zip64:
+        # Real sizes follow in the 64-bit data descriptor
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+        sizes = (ZIP64_LIMIT, ZIP64_LIMIT)
+    else:
+        extra = b''
+        sizes = (0, 0)
+    return LOCAL_HEADER.pack(
+        b'PK\x03\x04', 45 if zip64 else 20, FLAGS, entry.method, time, date,
+        0, *sizes, len(name), len(extra)
+    ) + name + extra
+
+
+def _data_descriptor(crc, compressed_size, size, zip64):
+    if zip64:
+        return DATA_DESCRIPTOR64.pack(b'PK\x07\x08', crc, compressed_size, size)
+    return DATA_DESCRIPTOR.pack(b'PK\x07\x08', crc, compressed_size, size)
+
+
+def _central_header(entry, crc, compressed_size, offset):
+    name = entry.name.encode('utf-8')
+    time, date = _dos_datetime(entry.modified)
+    # ZIP64 extra fields appear in this fixed order, only for values that overflow
+    wide = [value for value in (entry.size, compressed_size, offset) if value >= ZIP64_LIMIT]
+    extra = struct.pack(f'<HH{len(wide)}Q', 1, 8 * len(wide), *wide) if wide else b''
+    zip64 = bool(wide) or _local_zip64(entry)
+    return CENTRAL_HEADER.pack(
+        b'PK\x01\x02', MADE_BY, 45 if zip64 else 20, FLAGS, entry.method, time, date, crc,
+        min(compressed_size, ZIP64_LIMIT), min(entry.size, ZIP64_LIMIT),
+        len(name), len(extra), 0, 0, 0, EXTERNAL_ATTR, min(offset, ZIP64_LIMIT)
+    ) + name + extra
+
+
+def _end_records(count, directory_offset, directory_size):
+    records = b''
+    if (count >= ZIP64_COUNT_LIMIT or directory_offset >= ZIP64_LIMIT
+            or directory_size >= ZIP64_LIMIT):
+        end64_offset = directory_offset + directory_size
+        records += END_RECORD64.pack(b'PK\x06\x06', END_RECORD64.size - 12, MADE_BY, 45,
+                                     0, 0, count, count, directory_size, directory_offset)
+        records += END_LOCATOR64.pack(b'PK\x06\x07', 0, end64_offset, 1)
+    return records + END_RECORD.pack(
+        b'PK\x05\x06', 0, 0, min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+        min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0
+    )
+
+
+def iter_zip(entries):
+    """Yield a ZIP archive of ``entries`` without seeking or buffering members
+
+    Each member is written as local header, data, data descriptor, so no
+    size or CRC has to be known before its data has gone out. Only the
+    central directory (a few dozen bytes per member) is kept until the end.
+    """
+    offset = 0
+    directory = []
+    for entry in entries:
+        zip64 = _local_zip64(entry)
+        header = _local_header(entry, zip64)
+        yield header
+        crc, compressed_size = yield from entry.data()
+        if entry.compressed_size is not None and compressed_size != entry.compressed_size:
+            # Content-Length was promised from the recorded size; cut the response short
+            raise ValueError(f'{entry.name}: stored object does not match its recorded size')
+        descriptor = _data_descriptor(crc, compressed_size, entry.size, zip64)
+        yield descriptor
+        directory.append(_central_header(entry, crc, compressed_size, offset))
+        offset += len(header) + compressed_size + len(descriptor)
+    directory = b''.join(directory)
+    yield directory
+    yield _end_records(len(entries), offset, len(directory))
+
+
+def zip_length(entries):
+    """Exact size of the archive iter_zip will produce, or None if it can't be known
+
+    The length is unknown only when some member is compressed on the fly.
+    """
+    if any(entry.compressed_size is None for entry in entries):
+        return None
+    offset = 0
+    directory_size = 0
+    for entry in entries:
+        zip64 = _local_zip64(entry)
+        # CRCs are fixed width, so a placeholder gives the same layout
+        directory_size += len(_central_header(entry, 0, entry.compressed_size, offset))
+        offset += (len(_local_header(entry, zip64)) + entry.compressed_size
+                   + len(_data_descriptor(0, entry.compressed_size, entry.size, zip64)))
+    return offset + directory_size + len(_end_records(len(entries), offset, directory_size))
+
+
+def unique_name(filename, used):
+    """Archive member name for a share: no directories, and no duplicates"""
+    name = filename.replace('/', '_').replace('\\', '_').lstrip('.') or 'file'
+    stem, dot, ext = name.rpartition('.')
+    if not dot:
+        stem, ext = name, ''
+    candidate = name
+    n = 1
+    while candidate.lower() in used:
+        n += 1
+        candidate = f'{stem} ({n}){dot}{ext}'
+    used.add(candidate.lower())
+    return candidate
+
+
+def share_entry(storage, share, name, deflate_level):
+    """ZipEntry reading a share's plaintext from storage
+
+    Blobs stored gzip-compressed are copied into the archive as they are;
+    other compressible files are deflated at ``deflate_level`` (0 stores
+    them), and already-compressed formats are always stored.
+    """
+    view = open_for_reading(storage, share)
+    key = share.storage_key
+    size = share.file_size
+    if share.content_encoding == 'gzip':
+        chunks = partial(view.get_range_stream, key, 0, share.stored_size)
+        return ZipEntry(name, share.created_at, size,
+                        share.stored_size - GZIP_HEADER_SIZE - GZIP_TRAILER.size, DEFLATED,
+                        lambda: gzip_member_data(chunks(), size))
+
+    plain = select_representation(view, share, None, None)[0]
+    chunks = partial(plain.get_range_stream, key, 0, size)
+    ext = share.original_filename.rsplit('.', 1)[-1].lower() if '.' in share.original_filename else ''
+    if deflate_level == 0 or ext in INCOMPRESSIBLE_EXTENSIONS:
+        return ZipEntry(name, share.created_at, size, size, STORED, lambda: stored_data(chunks()))
+    return ZipEntry(name, share.created_at, size, None, DEFLATED,
+                    lambda: deflated_data(chunks(), deflate_level))